@@ -51,6 +51,41 @@ This package includes the following modules:
     also includes the "column_finders" dicitonary which is a dictionary of ColumnFinders 
     created to match the most common columns found in the Metabolomics Workbench datasets. 
     More information about this module can be found on the :doc:`metadata_column_matching` page.
+
+``mwindex``
+    This module provides the :class:`~mwtab.mwindex.MWTabIndex` class which is an on-disk 
+    SQLite index of the metabolites and metadata in a local collection of ``mwTab`` files. The index only 
+    reads new or changed files when it is updated and can be queried without reading the files.
+
+``httpsession``
+    This module provides the :class:`~mwtab.httpsession.HTTPSession` class which keeps HTTP 
+    connections open between requests and asks for gzip compressed responses. It is used to 
+    open every URL read by :mod:`~mwtab.fileio`.
+
+``mwmirror``
+    This module provides the :class:`~mwtab.mwmirror.MWTabMirror` class which keeps a local 
+    directory of every analysis in the Metabolomics Workbench up to date, using a manifest to 
+    only download analyses that are new or changed.
+
+``mwrefmet``
+    This module provides the :class:`~mwtab.mwrefmet.RefMetDictionary` class which is a local, 
+    indexed copy of the RefMet table of standardized metabolite names, used to resolve names 
+    without a request to the REST API for each one.
+
+``mwfeatures``
+    This module provides the :class:`~mwtab.mwfeatures.FeatureIndex` class which is an index of 
+    the m/z and retention time of the metabolites in a local collection of ``mwTab`` files, used to 
+    look up many m/z values at once within a ppm tolerance and retention time window.
+
+``mwduplicates``
+    This module provides the :class:`~mwtab.mwduplicates.MinHashLSH` class and the 
+    :func:`~mwtab.mwduplicates.find_near_duplicates` function, used to find analyses with nearly 
+    the same metabolites without comparing every pair of analyses.
+
+``mwserver``
+    This module provides the :class:`~mwtab.mwserver.MWTabServer` class, a long running local 
+    server that keeps worker processes with mwtab already imported, so validate, convert, and 
+    extract requests don't pay the startup cost each time.
 """
 from logging import getLogger, NullHandler
 from .fileio import read_files, read_mwrest
@@ -69,10 +104,19 @@ try:
     # import from _version.py generated by setuptools_scm during release
     from ._version import version as __version__
 except ImportError:
+    pass
+
+
+def __getattr__(name):
     # -- Source mode --
-    # use setuptools_scm to get the current version from src using git
-    from setuptools_scm import get_version as _gv
-    from os import path as _path
-    __version__ = _gv(_path.join(_path.dirname(__file__), _path.pardir))
+    # use setuptools_scm to get the current version from src using git, only when the version is 
+    # asked for, because importing setuptools_scm and running git is slow.
+    if name == "__version__":
+        global __version__
+        from setuptools_scm import get_version as _gv
+        from os import path as _path
+        __version__ = _gv(_path.join(_path.dirname(__file__), _path.pardir))
+        return __version__
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 
@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import sys
+
 import docopt
 
+import mwtab
 from . import cli
-from . import __version__
 
 
 def main():
     doc = [line for line in cli.__doc__.split('\n')]
     doc = doc[:3] + [line.lstrip() for line in doc[5:]]
     doc = '\n'.join(doc)
-    args = docopt.docopt(cli.__doc__, version=__version__)
+    # Getting the version can run setuptools_scm when mwtab isn't installed, so only do it when it is asked for.
+    args = docopt.docopt(cli.__doc__, version=mwtab.__version__ if "--version" in sys.argv[1:] else None)
     cli.cli(args)
 
 
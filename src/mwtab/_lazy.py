@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+mwtab._lazy
+~~~~~~~~~~~
+
+This module provides :class:`~mwtab._lazy.LazyModule`, used in place of the imports of large
+third party packages like pandas, pyarrow, numpy, and jsonschema, so ``import mwtab`` and
+commands that don't use them, like ``mwtab --help`` or ``mwtab download``, don't have to import them.
+"""
+
+import importlib
+
+
+class LazyModule:
+    """A stand in for a module that imports it the first time one of its attributes is used.
+
+    Modules that use it have ``from __future__ import annotations``, so annotations like
+    ``pandas.DataFrame`` don't import the module when functions are defined.
+
+    Parameters:
+        name: The name of the module to import.
+        submodules: Names of submodules to import along with it, such as "pyarrow.compute",
+          so they can be used as attributes of the module.
+
+    Examples:
+        Basic usage.
+
+        >>> pandas = LazyModule("pandas")
+        >>> pandas.DataFrame({"a": [1]})
+           a
+        0  1
+    """
+    def __init__(self, name: str, submodules: tuple[str, ...] = ()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def _load(self):
+        """Import the module and submodules if they haven't been yet, and return the module."""
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self._module is None:
+            return "<lazily imported module '" + self._name + "'>"
+        return repr(self._module)
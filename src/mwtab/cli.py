@@ -10,16 +10,25 @@ The mwtab Command Line Interface
     Usage:
         mwtab -h | --help
         mwtab --version
-        mwtab convert (<from-path> <to-path>) [--from-format=<format>] [--to-format=<format>] [--mw-rest=<url>] [--force] [--verbose]
-        mwtab validate <from-path> [--to-path=<path>] [--mw-rest=<url>] [--force] [--silent]
+        mwtab convert (<from-path> <to-path>) [--from-format=<format>] [--to-format=<format>] [--mw-rest=<url>] [--force] [--verbose] [--server=<address>]
+        mwtab validate <from-path> [--to-path=<path>] [--mw-rest=<url>] [--force] [--silent] [--profile=<profile>] [--include=<ids>] [--exclude=<ids>] [--max-errors=<n>] [--server=<address>]
         mwtab download url <url> [--to-path=<path>] [--verbose]
-        mwtab download study all [--to-path=<path>] [--input-item=<item>] [--output-format=<format>] [--mw-rest=<url>] [--verbose]
-        mwtab download study <input-value> [--to-path=<path>] [--input-item=<item>] [--output-item=<item>] [--output-format=<format>] [--mw-rest=<url>] [--verbose]
+        mwtab download study all [--to-path=<path>] [--input-item=<item>] [--output-format=<format>] [--mw-rest=<url>] [--workers=<n>] [--rate=<n>] [--burst=<n>] [--retries=<n>] [--verbose]
+        mwtab download study <input-value> [--to-path=<path>] [--input-item=<item>] [--output-item=<item>] [--output-format=<format>] [--mw-rest=<url>] [--workers=<n>] [--rate=<n>] [--burst=<n>] [--retries=<n>] [--verbose]
         mwtab download (study | compound | refmet | gene | protein) <input-item> <input-value> <output-item> [--output-format=<format>] [--to-path=<path>] [--mw-rest=<url>] [--verbose]
+        mwtab download batch (compound | refmet | gene | protein) <input-item> <values-path> <output-item> [--output-format=<format>] [--to-path=<path>] [--cache=<path>] [--refmet=<path>] [--mw-rest=<url>] [--workers=<n>] [--rate=<n>] [--burst=<n>] [--retries=<n>] [--verbose]
         mwtab download moverz <input-item> <m/z-value> <ion-type-value> <m/z-tolerance-value> [--to-path=<path>] [--mw-rest=<url>] [--verbose]
         mwtab download exactmass <LIPID-abbreviation> <ion-type-value> [--to-path=<path>] [--mw-rest=<url>] [--verbose]
-        mwtab extract metadata <from-path> <to-path> <key> ... [--to-format=<format>] [--no-header] [--force]
-        mwtab extract metabolites <from-path> <to-path> (<key> <value>) ... [--to-format=<format>] [--no-header] [--force]
+        mwtab extract metadata <from-path> <to-path> <key> ... [--to-format=<format>] [--no-header] [--index=<path>] [--match=<match>] [--jobs=<n>] [--force] [--server=<address>]
+        mwtab extract metabolites <from-path> <to-path> (<key> <value>) ... [--to-format=<format>] [--no-header] [--threshold=<value>] [--jobs=<n>] [--force] [--server=<address>]
+        mwtab index <from-path> <index-path> [--threshold=<value>] [--force] [--verbose]
+        mwtab query metabolite <index-path> <to-path> <metabolite> ... [--to-format=<format>] [--no-header] [--ignore-case]
+        mwtab query metadata <index-path> <to-path> <key> ... [--to-format=<format>] [--no-header] [--match=<match>]
+        mwtab query identifier <index-path> <to-path> <identifier> ... [--to-format=<format>] [--no-header] [--id-type=<type>]
+        mwtab query samples <index-path> <to-path> <query> [--to-format=<format>] [--no-header] [--ignore-case]
+        mwtab duplicates <from-path> <to-path> [--to-format=<format>] [--no-header] [--similarity=<value>] [--num-perm=<n>] [--include-samples] [--force] [--verbose]
+        mwtab serve [--socket=<path>] [--port=<n>] [--workers=<n>] [--verbose]
+        mwtab mirror <mirror-path> [--output-format=<format>] [--refresh-after=<days>] [--mw-rest=<url>] [--workers=<n>] [--rate=<n>] [--burst=<n>] [--retries=<n>] [--verbose]
     
     Options:
         -h, --help                           Show this screen.
@@ -31,13 +40,21 @@ The mwtab Command Line Interface
                                              Available formats for convert:
                                                  mwtab, json.
                                              Available formats for extract:
-                                                 json, csv.
+                                                 json, csv, jsonl.
+                                             jsonl writes results as they are extracted instead of 
+                                             keeping them all in memory, 1 line per file for metadata 
+                                             and 1 line per metabolite for metabolites.
         --mw-rest=<url>                      URL to MW REST interface
                                                 [default: https://www.metabolomicsworkbench.org/rest/].
         --to-path=<path>                     Directory to save outputs into. Defaults to the current working directory.
                                              For the validate command, if the given path ends in '.json', then 
                                              all JSON file outputs will be condensed into that 1 file. Also for 
                                              the validate command no output files are saved unless this option is given.
+        --profile=<profile>                  Validation profile to use, available profiles: quick, full [default: full].
+                                             quick only runs the schema and SUBJECT_SAMPLE_FACTORS checks.
+        --include=<ids>                      Comma separated list of validation IDs to check in addition to the profile.
+        --exclude=<ids>                      Comma separated list of validation IDs to skip.
+        --max-errors=<n>                     Stop validating a file after this many issues are found.
         --prefix=<prefix>                    Prefix to add at the beginning of the output file name. Defaults to no prefix.
         --suffix=<suffix>                    Suffix to add at the end of the output file name. Defaults to no suffix.
         --context=<context>                  Type of resource to access from MW REST interface, available contexts: study,
@@ -45,10 +62,52 @@ The mwtab Command Line Interface
         --input-item=<item>                  Item to search Metabolomics Workbench with.
         --output-item=<item>                 Item to be retrieved from Metabolomics Workbench.
         --output-format=<format>             Format for item to be retrieved in, available formats: mwtab, json.
+        --workers=<n>                        Number of files to download at the same time, or for serve, the number of 
+                                             worker processes [default: 4].
+        --rate=<n>                           Average number of download requests per second, so the Metabolomics Workbench 
+                                             isn't overloaded, e.g. 0.5 for 1 request every 2 seconds. Defaults to 1 
+                                             request every 3 seconds.
+        --burst=<n>                          Number of download requests that can be made at once [default: 1].
+        --retries=<n>                        Number of times to try a download again after a transient error, 
+                                             such as a timeout, with exponential backoff [default: 3].
+        --cache=<path>                       JSON file of previous batch download responses. Values already in it aren't 
+                                             downloaded again, and new responses are added to it.
+        --refmet=<path>                      Local copy of the RefMet table to look up refmet batch downloads in instead of 
+                                             the REST API. The table is downloaded to this path if it doesn't exist.
+        --refresh-after=<days>               Download analyses in the mirror again if they were downloaded more than this many 
+                                             days ago. Otherwise only new analyses, analyses that changed in the 
+                                             Metabolomics Workbench listing, and missing files are downloaded.
         --no-header                          Include header at the top of csv formatted files.
+        --threshold=<value>                  Only extract or index metabolites from samples whose value is greater than this [default: 0].
+        --ignore-case                        Match metabolite names, or sample factors and values, in the index without regard to case.
+        --index=<path>                       Update the index at this path from <from-path> and extract metadata from it instead 
+                                             of reading every file. Files that haven't changed since the last update aren't read.
+        --jobs=<n>                           Number of processes to read and extract files with in parallel. Defaults to 
+                                             reading files one at a time in a single process. Can't be used with --index.
+        --match=<match>                      How to match metadata keys in an index, available matches: exact, prefix, regex [default: exact].
+                                             Keys can be given as SECTION:KEY, e.g. SU:SUBJECT_TYPE, or KEY to look in every section.
+        --id-type=<type>                     Only look up identifiers of this type in an index, available types: inchi_key, 
+                                             kegg_id, hmdb_id, pubchem_id, chebi_id, lm_id. Defaults to every type.
+        --similarity=<value>                 Lowest estimated Jaccard similarity of the metabolites of 2 analyses, from 0 to 1, 
+                                             to report them as near duplicates [default: 0.9].
+        --num-perm=<n>                       Number of hash functions in the MinHash signature of each analysis. More is 
+                                             more accurate and slower [default: 128].
+        --include-samples                    Compare the sample IDs in SUBJECT_SAMPLE_FACTORS as well as the metabolites.
+        --socket=<path>                      Unix socket for serve to listen on, which only the user running it can use. 
+                                             Defaults to ~/.mwtab/server.sock.
+        --port=<n>                           Port on 127.0.0.1 for serve to listen on instead of a Unix socket. Requests must 
+                                             have the token serve writes to ~/.mwtab/server-<port>.token, which --server 
+                                             reads, so only the same user can use it.
+        --server=<address>                   Run the command in a running "mwtab serve" instead of this process, which 
+                                             skips starting Python and importing pandas and jsonschema. The address is 
+                                             the serve command's socket path, or http://127.0.0.1:<port>.
         --force                              Ignore non-dictionary values in METABOLITES_DATA, METABOLITES, and EXTENDED tables for JSON files.
     
-        For extraction <to-path> can take a "-" which will use stdout.
+        For extraction and queries <to-path> can take a "-" which will use stdout.
+        For sample queries <query> is terms written as FACTOR:VALUE combined with AND, OR, NOT, and parentheses, 
+        e.g. "Treatment:Control AND (Tissue:Plasma OR Tissue:Serum)". Put factors and values with spaces in double quotes.
+        For batch downloads <values-path> is a file with 1 value per line, or a JSON list of values, and the 
+        responses are saved together in 1 JSON file.
         All <from-path>'s can be single files, directories, or URLs.
     
     Documentation webpage: https://moseleybioinformaticslab.github.io/mwtab/
@@ -65,8 +124,11 @@ import sys
 import time
 import datetime
 import pathlib
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from . import fileio, mwextract, mwrest
+from . import fileio, mwextract, mwrest, mwindex, mwmirror, mwrefmet, mwduplicates
 from .converter import Converter
 from .validator import validate_file
 from .mwschema import ms_required_schema, nmr_required_schema
@@ -119,30 +181,45 @@ def save_mwrest_file(mwrestfile: mwrest.MWRESTFile, to_path: str|None = None, ou
     Returns:
         True if the mwrestfile had text and was therefore saved, False otherwise.
     """
-    if mwrestfile.text:  # if the text file isn't blank
-        filename = quote_plus(mwrestfile.source).replace(".", "_")
-        extension = OUTPUT_FORMATS[output_format]
-        if to_path:
-            fileio._create_save_path(to_path)
-            if pathlib.Path(to_path).suffix:
-                path_to_save = to_path
-            else:
-                path_to_save = join(to_path, filename + "." + extension)
-        else:
-            path_to_save = join(getcwd(), filename + "." + extension)
-        
-        with open(path_to_save, "w", encoding="utf-8") as fh:
-            mwrestfile.write(fh)
+    if mwrestfile.content:  # if the text file isn't blank
+        with open(mwrest_save_path(mwrestfile.source, to_path, output_format), "wb") as fh:
+            fh.write(mwrestfile.content)
         return True
     return False
 
 
+def mwrest_save_path(source: str, to_path: str|None = None, output_format: str = 'txt') -> str:
+    """Return the path to save a file downloaded from source to, creating directories that don't exist.
+    
+    Args:
+        source: The URL the file is downloaded from, used to name the file if to_path is a directory.
+        to_path: The path to save the file to. If it has a file extension it is used as is, otherwise it is 
+                 a directory. Defaults to the current working directory.
+        output_format: The format to save the file to. Should be 'txt', 'json', or 'mwtab'.
+    
+    Returns:
+        The path to save the file to.
+    """
+    filename = quote_plus(source).replace(".", "_")
+    extension = OUTPUT_FORMATS[output_format]
+    if to_path:
+        fileio._create_save_path(to_path)
+        if pathlib.Path(to_path).suffix:
+            return to_path
+        return join(to_path, filename + "." + extension)
+    return join(getcwd(), filename + "." + extension)
+
+
 def download_and_save_mwrest_file(rest_params: dict, to_path: str|None = None, 
                                   mwrest_base_url: str = mwrest.BASE_URL, full_url: str|None = None) -> None:
-    """DRY function to combine downloading, saving, and error printing."""
-    mwrestfile = download(rest_params, mwrest_base_url, full_url)
+    """DRY function to combine downloading, saving, and error printing.
+    
+    The download is streamed to the file in chunks, instead of being read into memory first, 
+    and is gzip compressed if to_path ends in ".gz".
+    """
+    url = full_url if full_url else mwrest.GenericMWURL(rest_params, mwrest_base_url).url
     extension = output_format if (output_format := rest_params.get('output_format')) else 'txt'
-    if not save_mwrest_file(mwrestfile, to_path, extension):
+    if not mwrest.download_to_file(url, mwrest_save_path(url, to_path, extension)):
         value = full_url if full_url else rest_params['input_value']
         print(f'When trying to download a file for the value, "{value}", '
               'a blank file or an error was returned, so no file was created for it.')
@@ -150,9 +227,14 @@ def download_and_save_mwrest_file(rest_params: dict, to_path: str|None = None,
 
 def download_and_save_ID_list(rest_params: dict, id_list: list[tuple[str, str]], verbose: bool,
                               to_path: str|None = None, 
-                              mwrest_base_url: str = mwrest.BASE_URL, full_url: str|None = None) -> None:
+                              mwrest_base_url: str = mwrest.BASE_URL, full_url: str|None = None, 
+                              workers: int = 1, rate: float = mwrest.DEFAULT_RATE, burst: int = 1, retries: int = 3) -> None:
     """Download and save a list of study and/or analysis IDs.
     
+    Files are downloaded by a pool of worker threads, but requests are limited to an average of rate 
+    per second so the Metabolomics Workbench isn't overloaded. Downloads that fail with a transient 
+    error, such as a timeout or a 503 status, are tried again with exponential backoff.
+    
     Args:
         rest_params: A dictionary with values corresponding to the keywords in the Metabolomics Workbench REST specification.
                      For instance <context> would correspond to 'context' and <input item> would correspond to 'input_item'.
@@ -162,19 +244,102 @@ def download_and_save_ID_list(rest_params: dict, id_list: list[tuple[str, str]],
         mwrest_base_url: String for the base URL to use for accessing the Metabolomics Workbench REST interface.
         full_url: String representing a fully constructed URL to a Metabolomics Workbench REST endpoint. 
                   If given, all other parameters are ignored and this URL is used to download.
+        workers: The number of files to download at the same time.
+        rate: The average number of requests per second, including retries.
+        burst: The number of requests that can be made at once.
+        retries: The number of times to try a download again after a transient error.
     """
-    for count, (input_id, input_item) in enumerate(id_list):
-        rest_params['input_value'] = input_id
-        rest_params['input_item'] = input_item
+    limiter = mwrest.TokenBucket(rate, burst)
+    print_lock = threading.Lock()
+    start_time = time.monotonic()
+    
+    def download_ID(count, input_id, input_item):
         if verbose:
-            print("[{:4}/{:4}]".format(count+1, len(id_list)), input_id, datetime.datetime.now())
+            with print_lock:
+                print("[{:4}/{:4}]".format(count+1, len(id_list)), input_id, datetime.datetime.now())
         try:
-            download_and_save_mwrest_file(rest_params, to_path, mwrest_base_url, full_url)
+            mwrest.call_with_retries(download_and_save_mwrest_file, 
+                                     dict(rest_params, input_value=input_id, input_item=input_item), 
+                                     to_path, mwrest_base_url, full_url, 
+                                     retries=retries, limiter=limiter)
         except Exception:
-            print("Something went wrong and " + input_id + " could not be downloaded.")
-            traceback.print_exc(file=sys.stdout)
-            print()
-        time.sleep(3)
+            with print_lock:
+                print("Something went wrong and " + input_id + " could not be downloaded.")
+                traceback.print_exc(file=sys.stdout)
+                print()
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for count, (input_id, input_item) in enumerate(id_list):
+            executor.submit(download_ID, count, input_id, input_item)
+    
+    if verbose:
+        print("Downloaded {} file(s) in {:.1f} seconds.".format(len(id_list), time.monotonic() - start_time))
+
+
+def download_and_save_batch(rest_params: dict, values: list[str], verbose: bool, to_path: str|None = None, 
+                            mwrest_base_url: str = mwrest.BASE_URL, cache_path: str|None = None, 
+                            workers: int = 4, rate: float = mwrest.DEFAULT_RATE, burst: int = 1, retries: int = 3, 
+                            refmet_path: str|None = None) -> None:
+    """Download many values with :func:`~mwtab.mwrest.batch_query` and save the responses to 1 JSON file.
+    
+    For the refmet context, if refmet_path is given the values are looked up in a local copy of the RefMet 
+    table with :class:`~mwtab.mwrefmet.RefMetDictionary` instead, which is downloaded to refmet_path first 
+    if it doesn't exist.
+    
+    Args:
+        rest_params: A dictionary with the 'context', 'input_item', 'output_item', and 'output_format' to use for every value.
+        values: The input values to download. Repeated values are only downloaded once.
+        verbose: If True, print how many values were downloaded.
+        to_path: The path to save the JSON file to. If it doesn't have a file extension it is used as a directory. 
+                 Defaults to the current working directory.
+        mwrest_base_url: String for the base URL to use for accessing the Metabolomics Workbench REST interface.
+        cache_path: If given, the path to a JSON file of responses to use instead of downloading, which new responses are added to.
+        workers: The number of values to download at the same time.
+        rate: The average number of requests per second, including retries.
+        burst: The number of requests that can be made at once.
+        retries: The number of times to try a download again after a transient error.
+        refmet_path: If given, the path to a local copy of the RefMet table to use for the refmet context.
+    """
+    cache = {}
+    if cache_path and isfile(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as fh:
+            cache = json.load(fh)
+    cached_count = len(cache)
+    start_time = time.monotonic()
+    
+    if refmet_path and rest_params['context'] == 'refmet':
+        if isfile(refmet_path):
+            refmet = mwrefmet.RefMetDictionary.load(refmet_path)
+        else:
+            refmet = mwrefmet.RefMetDictionary.download(refmet_path, mwrest_base_url)
+        results, errors = refmet.batch_query(rest_params['input_item'], values, rest_params['output_item'])
+    else:
+        results, errors = mwrest.batch_query(rest_params['context'], rest_params['input_item'], values, rest_params['output_item'], 
+                                             rest_params['output_format'], mwrest_base_url, cache, 
+                                             workers=workers, rate=rate, burst=burst, retries=retries)
+    for value, e in errors.items():
+        print("Something went wrong and " + value + " could not be downloaded.")
+        traceback.print_exception(e, file=sys.stdout)
+        print()
+    
+    if cache_path:
+        fileio._create_save_path(cache_path)
+        with open(cache_path, "w", encoding="utf-8") as fh:
+            json.dump(cache, fh)
+    
+    filename = "_".join([rest_params['context'], rest_params['input_item'], rest_params['output_item']]) + ".json"
+    if not to_path:
+        to_path = join(getcwd(), filename)
+    else:
+        fileio._create_save_path(to_path)
+        if not pathlib.Path(to_path).suffix:
+            to_path = join(to_path, filename)
+    with open(to_path, "w", encoding="utf-8") as fh:
+        json.dump(results, fh, indent=2)
+    
+    if verbose:
+        print("Downloaded {} new response(s) for {} distinct value(s) in {:.1f} seconds.".format(
+            len(cache) - cached_count, len(results) + len(errors), time.monotonic() - start_time))
 
 
 def classify_input_value(input_value: str) -> tuple[str, str]:
@@ -224,7 +389,26 @@ def cli(cmdargs):
     optional_to_path = cmdargs.get('--to-path')
     optional_output_item = cmdargs.get('--output-item')
     required_output_item = cmdargs.get('<output-item>')
+    # Options for downloading lists of IDs, only given to download_and_save_ID_list if they were given.
+    download_options = {name: convert(cmdargs[option]) 
+                        for option, name, convert in [("--workers", "workers", int), ("--rate", "rate", float), 
+                                                      ("--burst", "burst", int), ("--retries", "retries", int)]
+                        if cmdargs.get(option) is not None}
     
+    # Send the command to a running "mwtab serve" instead of running it here.
+    if cmdargs.get("--server") and any(cmdargs.get(command) for command in ("convert", "validate", "extract")):
+        # Imported here, like the serve command, so other commands don't import the HTTP server.
+        from . import mwserver
+        try:
+            result = mwserver.run_remote(cmdargs["--server"], cmdargs)
+        except OSError as e:
+            print("Could not connect to the mwtab server at " + cmdargs["--server"] + ": " + str(e), file=sys.stderr)
+            sys.exit(1)
+        sys.stdout.write(result["stdout"])
+        sys.stderr.write(result["stderr"])
+        if result["returncode"]:
+            sys.exit(result["returncode"])
+        return
 
     # mwtab convert ...
     if cmdargs["convert"]:
@@ -239,6 +423,9 @@ def cli(cmdargs):
     elif cmdargs["validate"]:
         save_files = False
         consolidate_files = False
+        include = cmdargs.get('--include').split(',') if cmdargs.get('--include') else None
+        exclude = cmdargs.get('--exclude').split(',') if cmdargs.get('--exclude') else None
+        max_errors = int(cmdargs.get('--max-errors')) if cmdargs.get('--max-errors') else None
         consolidated_json = {}
         if optional_to_path:
             save_files = True
@@ -261,7 +448,11 @@ def cli(cmdargs):
                                             mwtabfile = mwfile,
                                             ms_schema = ms_required_schema, 
                                             nmr_schema = nmr_required_schema,
-                                            verbose = not silent
+                                            verbose = not silent,
+                                            profile = cmdargs.get('--profile') if cmdargs.get('--profile') else 'full',
+                                            include = include,
+                                            exclude = exclude,
+                                            max_errors = max_errors
                                             )
             if save_files:
                 if consolidate_files:
@@ -298,7 +489,7 @@ def cli(cmdargs):
                     rest_params = {'context': 'study',
                                    'output_item': 'mwtab',
                                    'output_format': output_format}
-                    download_and_save_ID_list(rest_params, id_list, VERBOSE, optional_to_path, mwrest_base_url)
+                    download_and_save_ID_list(rest_params, id_list, VERBOSE, optional_to_path, mwrest_base_url, **download_options)
 
                 else:
                     raise ValueError("Unknown \"--input-item\" {}".format(optional_input_item))
@@ -330,7 +521,7 @@ def cli(cmdargs):
                     rest_params = {'context': 'study', 
                                     'output_item': optional_output_item if optional_output_item else 'mwtab',
                                     'output_format': output_format}
-                    download_and_save_ID_list(rest_params, id_list, VERBOSE, optional_to_path, mwrest_base_url)
+                    download_and_save_ID_list(rest_params, id_list, VERBOSE, optional_to_path, mwrest_base_url, **download_options)
 
                 # Assume input value is a single analysis or study id and use --input-item to decide which, default to analysis_id
                 else:
@@ -354,6 +545,26 @@ def cli(cmdargs):
                                'output_format': output_format}
                 download_and_save_mwrest_file(rest_params, optional_to_path, mwrest_base_url)
         
+        # mwtab download batch (compound | refmet | gene | protein) <input-item> <values-path> <output-item> ...
+        elif cmdargs.get("batch"):
+            with open(cmdargs["<values-path>"], "r", encoding="utf-8") as fh:
+                text = fh.read()
+            try:
+                values = json.loads(text)
+            except ValueError:
+                values = None
+            if isinstance(values, list):
+                values = [str(value) for value in values]
+            else:
+                values = [line.strip() for line in text.splitlines() if line.strip()]
+            
+            rest_params = {'context': context, 
+                           'input_item': required_input_item,
+                           'output_item': required_output_item,
+                           'output_format': OUTPUT_FORMATS[cmdargs["--output-format"]] if cmdargs.get("--output-format") else 'json'}
+            download_and_save_batch(rest_params, values, VERBOSE, optional_to_path, mwrest_base_url, 
+                                    cmdargs.get("--cache"), refmet_path = cmdargs.get("--refmet"), **download_options)
+        
         # mwtab download (... | compound | refmet | gene | protein) ...
         elif context in ['compound', 'refmet', 'gene', 'protein']:
             rest_params = {'context': context, 
@@ -381,19 +592,50 @@ def cli(cmdargs):
 
     # mwtab extract ...
     elif cmdargs["extract"]:
+        jobs = None
+        if cmdargs.get("--jobs"):
+            jobs = int(cmdargs["--jobs"]) if cmdargs["--jobs"].strip().isdigit() else 0
+            if jobs < 1:
+                print('--jobs must be a whole number of at least 1, not "' + cmdargs["--jobs"] + '".', file=sys.stderr)
+                sys.exit(1)
+            if cmdargs.get("--index"):
+                print("--jobs can't be used with --index, the index is updated in a single process.", file=sys.stderr)
+                sys.exit(1)
         mwfile_generator = fileio.read_with_class(cmdargs["<from-path>"], 
                                                   MWTabFile, 
                                                   {'duplicate_keys':True, "force": force}, 
                                                   return_exceptions=True)
         if cmdargs["metabolites"]:
-            metabolites_dict = mwextract.extract_metabolites(
-                mwfile_generator,
-                mwextract.generate_matchers(
-                    [(cmdargs["<key>"][i],
-                      cmdargs["<value>"][i] if not cmdargs["<value>"][i][:2] == "r'" else re.compile(cmdargs["<value>"][i][2:-1]))
-                     for i in range(len(cmdargs["<key>"]))]
-                )
-            )
+            matchers = list(mwextract.generate_matchers(
+                [(cmdargs["<key>"][i],
+                  cmdargs["<value>"][i] if not cmdargs["<value>"][i][:2] == "r'" else re.compile(cmdargs["<value>"][i][2:-1]))
+                 for i in range(len(cmdargs["<key>"]))]
+            ))
+            threshold = float(cmdargs.get("--threshold") or 0)
+            metabolites_written = 0
+            if jobs:
+                rows = mwextract.metabolite_rows_parallel(cmdargs["<from-path>"], 
+                                                          matchers, 
+                                                          threshold, 
+                                                          jobs, 
+                                                          {'duplicate_keys':True, "force": force})
+            else:
+                # Only parse the data of files that match, the metadata is checked first.
+                mwfile_generator = fileio.read_with_class(cmdargs["<from-path>"], 
+                                                          mwextract.MatcherFilteredMWTabFile, 
+                                                          {'matchers': matchers, 'duplicate_keys':True, "force": force}, 
+                                                          return_exceptions=True)
+                rows = mwextract.metabolite_rows(mwfile_generator, matchers, threshold)
+            
+            if cmdargs["--to-format"] == "jsonl":
+                # The rows are merged through temporary files, so every metabolite doesn't have to be in memory at once.
+                records = ({"metabolite": metabolite, "studies": studies} 
+                           for metabolite, studies in mwextract.merge_metabolite_rows(rows))
+                metabolites_dict = {}
+                metabolites_written = mwextract.write_jsonl(cmdargs["<to-path>"], records)
+            else:
+                # Much smaller than nested dictionaries and sets, it is converted when written.
+                metabolites_dict = mwextract.MetaboliteTable.from_rows(rows)
             
             if metabolites_dict:
                 if cmdargs["<to-path>"] != "-":
@@ -403,30 +645,170 @@ def cli(cmdargs):
                         mwextract.write_json(cmdargs["<to-path>"], metabolites_dict)
                 else:
                     print(json.dumps(metabolites_dict, indent=4, cls=mwextract.SetEncoder))
-            else:
+            elif not metabolites_written:
                 print("No metabolites extracted. No file was saved. " 
                       "This is likely due to key value pairs filtering all of the studies out. "
                       "Check your key value pairs and data.")
 
         elif cmdargs["metadata"]:
             metadata = dict()
-            for mwtabfile, e in mwfile_generator:
-                if e is not None:
-                    file_source = mwtabfile if isinstance(mwtabfile, str) else cmdargs["<from-path>"]
-                    print("Something went wrong when trying to read " + file_source)
-                    traceback.print_exception(e, file=sys.stdout)
-                    print()
-                    continue
-                extracted_values = mwextract.extract_metadata(mwtabfile, cmdargs["<key>"])
-                [metadata.setdefault(key, set()).update(val) for (key, val) in extracted_values.items()]
+            metadata_written = 0
+            if cmdargs.get("--index"):
+                # extract metadata has no --threshold, so keep the one the index was built with.
+                with mwindex.MWTabIndex(cmdargs["--index"]) as index:
+                    index.update(cmdargs["<from-path>"], force, VERBOSE)
+                    metadata = index.query_metadata(cmdargs["<key>"], cmdargs.get("--match") or "exact")
+            elif cmdargs["--to-format"] == "jsonl":
+                # Each file's record is written as soon as the file is read.
+                if jobs:
+                    records = mwextract.metadata_records_parallel(cmdargs["<from-path>"], 
+                                                                  cmdargs["<key>"], 
+                                                                  jobs, 
+                                                                  {'duplicate_keys':True, "force": force})
+                else:
+                    records = mwextract.metadata_records(mwfile_generator, cmdargs["<key>"])
+                metadata_written = mwextract.write_jsonl(cmdargs["<to-path>"], records)
+            elif jobs:
+                metadata = mwextract.extract_metadata_parallel(cmdargs["<from-path>"], 
+                                                               cmdargs["<key>"], 
+                                                               jobs, 
+                                                               {'duplicate_keys':True, "force": force})
+            else:
+                for mwtabfile, e in mwfile_generator:
+                    if e is not None:
+                        file_source = mwtabfile if isinstance(mwtabfile, str) else cmdargs["<from-path>"]
+                        print("Something went wrong when trying to read " + file_source)
+                        traceback.print_exception(e, file=sys.stdout)
+                        print()
+                        continue
+                    extracted_values = mwextract.extract_metadata(mwtabfile, cmdargs["<key>"])
+                    [metadata.setdefault(key, set()).update(val) for (key, val) in extracted_values.items()]
             if metadata:
-                if cmdargs["<to-path>"] != "-":
+                if cmdargs["--to-format"] == "jsonl":
+                    # The index combines the values of every file, so they are written as 1 record.
+                    mwextract.write_jsonl(cmdargs["<to-path>"], [{"metadata": metadata}])
+                elif cmdargs["<to-path>"] != "-":
                     if cmdargs["--to-format"] == "csv":
                         mwextract.write_metadata_csv(cmdargs["<to-path>"], metadata, cmdargs["--no-header"])
                     else:
                         mwextract.write_json(cmdargs["<to-path>"], metadata)
                 else:
                     print(metadata)
-            else:
+            elif not metadata_written:
                 print("No metadata extracted. No file was saved.")
 
+    # mwtab index ...
+    elif cmdargs["index"]:
+        with mwindex.MWTabIndex(cmdargs["<index-path>"], float(cmdargs.get("--threshold") or 0)) as index:
+            counts = index.update(cmdargs["<from-path>"], force, VERBOSE)
+        print("Indexed {indexed} file(s), {unchanged} file(s) unchanged, {removed} file(s) removed.".format(**counts))
+
+    # mwtab query ...
+    elif cmdargs["query"]:
+        if cmdargs["metabolite"]:
+            with mwindex.MWTabIndex(cmdargs["<index-path>"]) as index:
+                metabolites_dict = index.query_metabolites(cmdargs["<metabolite>"], cmdargs["--ignore-case"])
+            
+            if metabolites_dict:
+                if cmdargs["<to-path>"] != "-":
+                    if cmdargs["--to-format"] == "csv":
+                        mwextract.write_metabolites_csv(cmdargs["<to-path>"], metabolites_dict, cmdargs["--no-header"])
+                    else:
+                        mwextract.write_json(cmdargs["<to-path>"], metabolites_dict)
+                else:
+                    print(json.dumps(metabolites_dict, indent=4, cls=mwextract.SetEncoder))
+            else:
+                print("None of the metabolites were found in the index. No file was saved.")
+        
+        elif cmdargs["metadata"]:
+            with mwindex.MWTabIndex(cmdargs["<index-path>"]) as index:
+                metadata = index.query_metadata(cmdargs["<key>"], cmdargs.get("--match") or "exact")
+            
+            if metadata:
+                if cmdargs["<to-path>"] != "-":
+                    if cmdargs["--to-format"] == "csv":
+                        mwextract.write_metadata_csv(cmdargs["<to-path>"], metadata, cmdargs["--no-header"])
+                    else:
+                        mwextract.write_json(cmdargs["<to-path>"], metadata)
+                else:
+                    print(metadata)
+            else:
+                print("None of the metadata keys were found in the index. No file was saved.")
+        
+        elif cmdargs.get("identifier"):
+            with mwindex.MWTabIndex(cmdargs["<index-path>"]) as index:
+                identifiers = index.query_identifiers(cmdargs["<identifier>"], cmdargs.get("--id-type"))
+            
+            if identifiers:
+                if cmdargs["<to-path>"] != "-":
+                    if cmdargs["--to-format"] == "csv":
+                        mwextract.write_identifiers_csv(cmdargs["<to-path>"], identifiers, cmdargs["--no-header"])
+                    else:
+                        mwextract.write_json(cmdargs["<to-path>"], identifiers)
+                else:
+                    print(json.dumps(identifiers, indent=4))
+            else:
+                print("None of the identifiers were found in the index. No file was saved.")
+        
+        elif cmdargs.get("samples"):
+            with mwindex.MWTabIndex(cmdargs["<index-path>"]) as index:
+                try:
+                    samples = index.query_samples(cmdargs["<query>"], cmdargs.get("--ignore-case", False))
+                except ValueError as e:
+                    print(e, file=sys.stderr)
+                    sys.exit(1)
+            
+            if samples:
+                if cmdargs["<to-path>"] != "-":
+                    if cmdargs["--to-format"] == "csv":
+                        mwextract.write_samples_csv(cmdargs["<to-path>"], samples, cmdargs["--no-header"])
+                    else:
+                        mwextract.write_json(cmdargs["<to-path>"], samples)
+                else:
+                    print(json.dumps(samples, indent=4, cls=mwextract.SetEncoder))
+            else:
+                print("No samples matched the query in the index. No file was saved.")
+
+    # mwtab duplicates ...
+    elif cmdargs.get("duplicates"):
+        duplicates = mwduplicates.find_near_duplicates(cmdargs["<from-path>"], float(cmdargs.get("--similarity") or 0.9),
+                                                       int(cmdargs.get("--num-perm") or 128), cmdargs.get("--include-samples", False),
+                                                       force, VERBOSE)
+        duplicates = [{"analysis_id_1": key1, "analysis_id_2": key2, "similarity": similarity}
+                      for key1, key2, similarity in duplicates]
+        
+        if duplicates:
+            if cmdargs["<to-path>"] != "-":
+                if cmdargs["--to-format"] == "csv":
+                    mwextract.write_duplicates_csv(cmdargs["<to-path>"], duplicates, cmdargs["--no-header"])
+                else:
+                    mwextract.write_json(cmdargs["<to-path>"], duplicates)
+            else:
+                print(json.dumps(duplicates, indent=4))
+        else:
+            print("No near duplicate analyses were found. No file was saved.")
+
+    # mwtab serve ...
+    elif cmdargs.get("serve"):
+        from . import mwserver
+        server = mwserver.MWTabServer(socket_path=cmdargs.get("--socket"),
+                                      port=int(cmdargs["--port"]) if cmdargs.get("--port") else None,
+                                      workers=int(cmdargs.get("--workers") or 4),
+                                      verbose=VERBOSE)
+        # Stop cleanly, removing the socket file, when terminated.
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+        print("Serving on " + server.address, flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+
+    # mwtab mirror ...
+    elif cmdargs["mirror"]:
+        mirror = mwmirror.MWTabMirror(cmdargs["<mirror-path>"], output_format, mwrest_base_url)
+        refresh_after = float(cmdargs["--refresh-after"]) if cmdargs.get("--refresh-after") else None
+        counts = mirror.sync(refresh_after=refresh_after, verbose=VERBOSE, **download_options)
+        print("Downloaded {downloaded} analyses, {unchanged} unchanged, {failed} failed, "
+              "{unlisted} no longer listed.".format(**counts))
@@ -29,7 +29,6 @@ from functools import partial
 from . import mwtab
 from . import mwrest
 
-from urllib.request import urlopen
 from urllib.parse import urlparse
 
 
@@ -37,6 +36,19 @@ VERBOSE = False
 MWREST_URL = mwrest.BASE_URL
 
 
+def urlopen(url):
+    """Open url with :func:`mwtab.httpsession.urlopen`.
+    
+    httpsession is imported the first time a URL is opened, because http.client and urllib.request
+    take most of the time to import mwtab, and most commands only read local files.
+    
+    :param str url: The URL to request.
+    :return: A file-like response to read the body from.
+    """
+    from . import httpsession
+    return httpsession.urlopen(url)
+
+
 def _create_save_path(path):
     """Create directories in the path that don't already exist.
     
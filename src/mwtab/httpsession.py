@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+mwtab.httpsession
+~~~~~~~~~~~~~~~~~
+
+This module provides the :class:`~mwtab.httpsession.HTTPSession` class, which keeps connections to
+web servers open between requests and asks for gzip compressed responses. Downloading many files from
+the Metabolomics Workbench then doesn't need a new TCP and TLS handshake for every file. The module
+level :func:`~mwtab.httpsession.urlopen` function uses a shared session and is what :mod:`mwtab.fileio`
+uses to open URLs.
+"""
+
+import gzip
+import http.client
+import io
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+#: Status codes that redirect to the Location header.
+_REDIRECT_CODES = {301, 302, 303, 307, 308}
+
+
+class HTTPSession:
+    """A pool of kept alive HTTP and HTTPS connections, shared by the threads that use it.
+
+    Each request takes an idle connection to the host, or opens a new one, and the connection is
+    put back once the response has been read and closed. If the server closed an idle connection,
+    the request is sent again on a new one. Responses are requested with gzip compression and
+    decompressed when read. Errors are raised the same way as :func:`urllib.request.urlopen`, as
+    :class:`urllib.error.HTTPError` and :class:`urllib.error.URLError`.
+
+    URLs that aren't HTTP or HTTPS, and requests when a proxy is set in the environment, are passed
+    to :func:`urllib.request.urlopen`.
+
+    Parameters:
+        max_idle: The most idle connections to keep open for each host.
+        timeout: Seconds to wait for a server to connect or respond.
+        max_redirects: The most redirects to follow for 1 request.
+
+    Attributes:
+        requests: The number of requests sent, including redirects.
+        connections_opened: The number of new connections opened.
+    """
+    def __init__(self, max_idle: int = 8, timeout: float = 60, max_redirects: int = 10):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.requests = 0
+        self.connections_opened = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def urlopen(self, url: str, headers: dict|None = None) -> io.BufferedIOBase:
+        """Send a GET request for url and return the response.
+
+        Args:
+            url: The URL to request.
+            headers: Additional request headers.
+
+        Returns:
+            A file-like response to read the body from, with status, reason, headers, and url attributes.
+            Closing it lets the connection be used again.
+
+        Raises:
+            urllib.error.HTTPError: If the response status is 400 or above, or there are too many redirects.
+            urllib.error.URLError: If the server can't be reached.
+        """
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme not in ("http", "https") or scheme in urllib.request.getproxies():
+            return urllib.request.urlopen(url, timeout=self.timeout)
+
+        for _ in range(self.max_redirects + 1):
+            response = self._request(url, headers or {})
+            if response.status in _REDIRECT_CODES and response.getheader("Location"):
+                response.read()
+                response.close()
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                body = response.read()
+                response.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+            return response
+        raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, None)
+
+    def _request(self, url: str, headers: dict) -> '_PooledResponse':
+        """Send 1 GET request on a pooled connection without following redirects."""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        request_headers = {"Accept-Encoding": "gzip", "User-Agent": "mwtab", **headers}
+
+        for attempt in range(2):
+            connection, reused = self._connection(key)
+            try:
+                connection.request("GET", path, headers=request_headers)
+                raw_response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                # The server may have closed an idle connection, so try once more on a new one.
+                if reused and attempt == 0:
+                    continue
+                raise urllib.error.URLError(e)
+            except OSError as e:
+                connection.close()
+                raise urllib.error.URLError(e)
+            except Exception:
+                connection.close()
+                raise
+            with self._lock:
+                self.requests += 1
+            return _PooledResponse(self, key, connection, raw_response, url)
+
+    def _connection(self, key: tuple) -> tuple[http.client.HTTPConnection, bool]:
+        """Return an idle connection for key, or a new one, and whether it was idle."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections_opened += 1
+        scheme, host, port = key
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connection_class(host, port, timeout=self.timeout), False
+
+    def _release(self, key: tuple, connection: http.client.HTTPConnection):
+        """Put a connection back in the pool, or close it if the pool for key is full."""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+class _PooledResponse(io.BufferedIOBase):
+    """The response from :meth:`HTTPSession.urlopen`, which gives its connection back to the session when closed."""
+    def __init__(self, session: HTTPSession, key: tuple, connection: http.client.HTTPConnection,
+                 raw_response: http.client.HTTPResponse, url: str):
+        self._session = session
+        self._key = key
+        self._connection = connection
+        self._raw_response = raw_response
+        self.status = raw_response.status
+        self.reason = raw_response.reason
+        self.headers = raw_response.headers
+        self.url = url
+        if (raw_response.getheader("Content-Encoding") or "").lower() == "gzip":
+            self._body = gzip.GzipFile(fileobj=raw_response)
+        else:
+            self._body = raw_response
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        # HTTPResponse.read(-1) reads until the socket closes, instead of to the end of the response.
+        if size is None or size < 0:
+            return self._body.read()
+        return self._body.read(size)
+
+    def read1(self, size=-1):
+        return self._body.read1(size)
+
+    def getheader(self, name, default=None):
+        return self._raw_response.getheader(name, default)
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        if self.closed:
+            return
+        # The connection can only be used again if the whole response was read and the server is keeping it open.
+        if self._raw_response.isclosed() and not self._raw_response.will_close:
+            self._session._release(self._key, self._connection)
+        else:
+            self._raw_response.close()
+            self._connection.close()
+        super().close()
+
+
+#: The session used by :func:`~mwtab.httpsession.urlopen`.
+SESSION = HTTPSession()
+
+
+def urlopen(url: str) -> io.BufferedIOBase:
+    """Open url with the shared :data:`SESSION`, a replacement for :func:`urllib.request.urlopen`.
+
+    Args:
+        url: The URL to request.
+
+    Returns:
+        A file-like response to read the body from.
+    """
+    return SESSION.urlopen(url)
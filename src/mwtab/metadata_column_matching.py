@@ -7,9 +7,17 @@ Regular expressions, functions, and classes to match column names and values in
 More information can be found on the :doc:`metadata_column_matching` page.
 """
 
+from __future__ import annotations
+
 import re
+import json
+import hashlib
+from collections import OrderedDict
+
+from ._lazy import LazyModule
 
-import pandas
+pandas = LazyModule("pandas")
+pyarrow = LazyModule("pyarrow", ("pyarrow.compute",))
 
 
 
@@ -162,6 +170,9 @@ class NameMatcher():
         can be modified if necessary for easier matching, but then still be linked back to the original 
         name in the dataframe. 
 
+    The regular expressions are compiled when the NameMatcher is created. If any of the attributes 
+    are modified afterwards, call :meth:`compile` so the changes are used for matching.
+
     Attributes:
         regex_search_strings (list[str]): The current list of strings used for regex searching.
         not_regex_search_strings (list[str]): The current list of strings used for regex searching to exclude names.
@@ -183,6 +194,17 @@ class NameMatcher():
         self.not_in_strings = not_in_strings if not_in_strings else []
         self.in_string_sets = in_string_sets if in_string_sets else []
         self.exact_strings = exact_strings if exact_strings else []
+        self.compile()
+    
+    def compile(self):
+        """Compile the regular expressions used for matching from the current attributes.
+        
+        This is done automatically when the NameMatcher is created, so it only needs to be 
+        called again if the attributes are modified.
+        """
+        self._search_regex = re.compile(_create_column_regex_any(self.regex_search_strings)) if self.regex_search_strings else None
+        self._search_regex_sets = re.compile(_create_column_regex_all(self.regex_search_sets)) if self.regex_search_sets else None
+        self._not_search_regex = re.compile(_create_column_regex_any(self.not_regex_search_strings)) if self.not_regex_search_strings else None
         
     def dict_match(self, name_map: dict[str, str]) -> list[str]:
         """Return a list of names that match based on the NameMatcher attributes.
@@ -199,26 +221,115 @@ class NameMatcher():
         Returns:
             A list of names that match based on the NameMatcher attributes.
         """
-        search_regex = _create_column_regex_any(self.regex_search_strings)
-        search_regex_sets = _create_column_regex_all(self.regex_search_sets)
-        not_search_regex = _create_column_regex_any(self.not_regex_search_strings)
-        has_regex_search_strings = len(self.regex_search_strings) > 0
-        has_regex_search_sets = len(self.regex_search_sets) > 0
+        search_regex = self._search_regex
+        search_regex_sets = self._search_regex_sets
+        not_search_regex = self._not_search_regex
         has_in_string_sets = len(self.in_string_sets) > 0
-        has_no_not_regex_search_strings = len(self.not_regex_search_strings) == 0
         has_no_not_in_strings = len(self.not_in_strings) == 0
         columns_of_interest = [original_name for original_name, modified_name in name_map.items() if \
                                 (
-                                 (has_regex_search_strings and re.search(search_regex, modified_name)) or \
-                                 (has_regex_search_sets and re.search(search_regex_sets, modified_name)) or \
+                                 (search_regex and search_regex.search(modified_name)) or \
+                                 (search_regex_sets and search_regex_sets.search(modified_name)) or \
                                  any([word in modified_name for word in self.in_strings]) or \
                                  (has_in_string_sets and any([all([word in modified_name for word in word_set]) for word_set in self.in_string_sets])) or \
                                  any([word == modified_name for word in self.exact_strings])
                                 ) and \
-                                (has_no_not_regex_search_strings or not re.search(not_search_regex, modified_name)) and \
+                                (not not_search_regex or not not_search_regex.search(modified_name)) and \
                                 (has_no_not_in_strings or all([word not in modified_name for word in self.not_in_strings]))]
         return columns_of_interest
 
+class PreparedColumn():
+    """A column of values preprocessed once so that many ValueMatchers can be applied to it cheaply.
+    
+    ValueMatcher.series_match needs the stripped values, which values are NA, which values are 
+    numeric, and which values contain a decimal point. When one column is matched against several 
+    ValueMatchers, for instance because the column name matched more than one standard name, 
+    computing these again for every ValueMatcher is wasted work. PreparedColumn strips the values 
+    once using pyarrow.compute and computes each of the masks the first time it is needed. 
+    ValueMatcher.series_match accepts a PreparedColumn anywhere it accepts a Series.
+    
+    Parameters:
+        series: The column of values to prepare. Values that are not strings are treated as NA.
+    
+    Examples:
+        Basic usage.
+        
+        >>> column = PreparedColumn(pandas.Series(['1', ' 2.5 ', 'foo']))
+        >>> ValueMatcher(values_type = 'integer').series_match(column)
+        0     True
+        1    False
+        2    False
+        dtype: bool
+        >>> ValueMatcher(values_type = 'numeric').series_match(column)
+        0     True
+        1     True
+        2    False
+        dtype: bool
+    
+    Attributes:
+        index: The index of the original series, used for the index of the masks returned by ValueMatcher.
+        stripped: A pyarrow string array of the values with whitespace and left-to-right marks stripped.
+        stripped_series: The same values as stripped, as a pandas Series. The dtype is 'string[pyarrow]' 
+          if series had that dtype, otherwise object.
+    """
+    def __init__(self, series: pandas.Series):
+        self.index = series.index
+        if isinstance(series.dtype, pandas.StringDtype) and series.dtype.storage == 'pyarrow':
+            values = pyarrow.array(series.array)
+        else:
+            values = pyarrow.array([value if isinstance(value, str) else None for value in series], type=pyarrow.string())
+        stripped = pyarrow.compute.utf8_trim_whitespace(values)
+        self.stripped = pyarrow.compute.utf8_trim(stripped, characters='\u200e')
+        # Regular expressions behave a little differently between pyarrow and Python, so keep the kind of strings that were given.
+        if isinstance(series.dtype, pandas.StringDtype) and series.dtype.storage == 'pyarrow':
+            self.stripped_series = pandas.Series(self.stripped, index=self.index, dtype='string[pyarrow]')
+        else:
+            self.stripped_series = pandas.Series(self.stripped.to_pylist(), index=self.index, dtype=object)
+        self._na_masks = {}
+        self._numeric_na_mask = None
+        self._decimal_point_mask = None
+    
+    def na_mask(self, na_values: list):
+        """Return a mask of the values that are null or in na_values.
+        
+        Args:
+            na_values: list of values to consider NA values.
+        
+        Returns:
+            A numpy array with Boolean values, True where the stripped value is NA.
+        """
+        key = tuple(na_values)
+        if key not in self._na_masks:
+            mask = pyarrow.compute.or_(pyarrow.compute.is_null(self.stripped), 
+                                       pyarrow.compute.is_in(self.stripped, value_set=pyarrow.array(key, type=pyarrow.string())))
+            self._na_masks[key] = mask.to_numpy(zero_copy_only=False)
+        return self._na_masks[key]
+    
+    def numeric_na_mask(self):
+        """Return a mask of the values that can't be converted to a number.
+        
+        Conversion is done with pandas.to_numeric, so what is considered numeric is the same as for pandas.
+        
+        Returns:
+            A numpy array with Boolean values, True where the stripped value is not numeric.
+        """
+        if self._numeric_na_mask is None:
+            self._numeric_na_mask = pandas.to_numeric(self.stripped_series, errors='coerce').isna().to_numpy(bool)
+        return self._numeric_na_mask
+    
+    def decimal_point_mask(self):
+        """Return a mask of the values that contain a ".".
+        
+        Returns:
+            A numpy array with Boolean values, True where the stripped value contains a ".", False for NA values.
+        """
+        if self._decimal_point_mask is None:
+            mask = pyarrow.compute.fill_null(pyarrow.compute.match_substring(self.stripped, '.'), False)
+            self._decimal_point_mask = mask.to_numpy(zero_copy_only=False)
+        return self._decimal_point_mask
+
+
+
 class ValueMatcher():
     """Used to find a mask for certain values in a column.
     
@@ -291,7 +402,7 @@ class ValueMatcher():
         self.values_regex = values_regex if isinstance(values_regex, str) else ''
         self.values_inverse_regex = values_inverse_regex if isinstance(values_inverse_regex, str) else ''
     
-    def series_match(self, series: pandas.Series, na_values: list|None = None, match_na_values: bool = True) -> pandas.Series:
+    def series_match(self, series: pandas.Series|PreparedColumn, na_values: list|None = None, match_na_values: bool = True) -> pandas.Series:
         """Return a mask for the series based on type and regex matching.
         
         "values_regex" and "values_inverse_regex" are mutually exclusive and "values_regex" will take precedence if both are given. 
@@ -299,7 +410,8 @@ class ValueMatcher():
         "values_type" can only be "integer", "numeric", or "non-numeric" to match those types, respectively.
         
         Args:
-            series: series to match values based on type and/or regex.
+            series: series to match values based on type and/or regex. A PreparedColumn can be given 
+              instead to reuse the preprocessing when matching the same column several times.
             na_values: list of values to consider NA values.
             match_na_values: if True, NA values will be consider a match and return True, False otherwise.
         
@@ -309,37 +421,33 @@ class ValueMatcher():
         if na_values is None:
             na_values = []
         
-        stripped_series = series.str.strip()
-        stripped_series = stripped_series.str.strip('\u200e')
-        old_NAs = (stripped_series.isna()) | (stripped_series.isin(na_values))
+        column = series if isinstance(series, PreparedColumn) else PreparedColumn(series)
+        old_NAs = column.na_mask(na_values)
         
         if self.values_regex:
-            regex_match = stripped_series.str.fullmatch(self.values_regex, na=False)
+            regex_match = column.stripped_series.str.fullmatch(self.values_regex, na=False).to_numpy(bool)
         elif self.values_inverse_regex:
-            regex_match = ~stripped_series.str.fullmatch(self.values_inverse_regex, na=True)
+            regex_match = ~column.stripped_series.str.fullmatch(self.values_inverse_regex, na=True).to_numpy(bool)
         else:
-            regex_match = pandas.Series([True]*len(series), index=series.index)
+            regex_match = True
         
         if match_na_values:
             regex_match = regex_match | old_NAs
         
         
-        column_to_numeric = pandas.to_numeric(stripped_series, errors='coerce')
-        column_to_numeric_NAs = column_to_numeric.isna()
-        new_NAs = column_to_numeric_NAs ^ old_NAs
+        new_NAs = column.numeric_na_mask() ^ old_NAs
         
         if self.values_type == "integer":
-            # The top line will return True for values like '1.0', but the bottom line won't.
-            # type_match = (column_to_numeric % 1 == 0) & ~new_NAs
-            type_match = ~stripped_series.str.contains('.', regex=False, na=False) & ~new_NAs
+            # Checking the numeric values modulo 1 would return True for values like '1.0', but this won't.
+            type_match = ~column.decimal_point_mask() & ~new_NAs
         elif self.values_type == "numeric":
             type_match = ~new_NAs
         elif self.values_type == "non-numeric":
             type_match = new_NAs | old_NAs
         else:
-            type_match = pandas.Series([True]*len(series), index=series.index)
+            type_match = True
         
-        return regex_match & type_match
+        return pandas.Series(regex_match & type_match, index=column.index, dtype=bool)
 
 class ColumnFinder:
     """Used to find columns in a DataFrame that match a NameMatcher and values in the column that match a ValueMatcher.
@@ -400,6 +508,202 @@ class ColumnFinder:
 
 
 
+class ColumnFinderSet:
+    """Used to match many ColumnFinders against the same column names at once.
+    
+    Matching each ColumnFinder's NameMatcher separately repeats the same work, because 
+    many of them share strings, such as "id" or "type". ColumnFinderSet collects the 
+    distinct strings from all of the NameMatchers, checks each column name against each 
+    distinct string only once, and then decides which standard names match using set 
+    operations. The results are the same as calling name_dict_match on each ColumnFinder.
+    
+    The same column names show up in many files, so the standard names matched for each 
+    name are kept in a least recently used cache. The cache can be saved to and loaded 
+    from a file with save_cache and load_cache to reuse it between processes.
+    
+    Parameters:
+        column_finders: The ColumnFinders to match. Their standard names should be unique.
+        cache_size: The maximum number of names to keep in the cache. 0 turns off caching.
+    
+    Examples:
+        Basic usage.
+        
+        >>> finder_set = ColumnFinderSet(column_finders.values())
+        >>> modified_columns = {column_name: column_name.lower().strip() for column_name in ['Retention Time', 'KEGG ID']}
+        >>> finder_set.dict_match(modified_columns)
+        {'retention_time': ['Retention Time'], 'kegg_id': ['KEGG ID']}
+    
+    Attributes:
+        column_finders: A dictionary of standard names to ColumnFinders, in the order they were given.
+        cache_size: The maximum number of names to keep in the cache.
+        cache_hits: The number of names that were found in the cache.
+        cache_misses: The number of names that had to be matched.
+    """
+    def __init__(self, column_finders: list[ColumnFinder], cache_size: int = 4096):
+        self.column_finders = {finder.standard_name: finder for finder in column_finders}
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._name_cache = OrderedDict()
+        self.compile()
+    
+    def compile(self):
+        """Collect the distinct strings from the ColumnFinders and compile their regular expressions.
+        
+        This is done automatically when the ColumnFinderSet is created, so it only needs to be 
+        called again if the ColumnFinders are modified. The cache is cleared.
+        """
+        regex_words = {}
+        in_words = set()
+        finder_specs = []
+        # Which finders could match when a word is found, so the others don't have to be checked.
+        regex_triggers = {}
+        in_triggers = {}
+        exact_triggers = {}
+        always_check = set()
+        for index, (name, finder) in enumerate(self.column_finders.items()):
+            name_matcher = finder.name_matcher
+            for word in name_matcher.regex_search_strings + [word for word_set in name_matcher.regex_search_sets for word in word_set]:
+                regex_triggers.setdefault(word, set()).add(index)
+            for word in name_matcher.in_strings + [word for word_set in name_matcher.in_string_sets for word in word_set]:
+                in_triggers.setdefault(word, set()).add(index)
+            for word in name_matcher.exact_strings:
+                exact_triggers.setdefault(word, set()).add(index)
+            if any(len(word_set) == 0 for word_set in name_matcher.regex_search_sets + name_matcher.in_string_sets):
+                always_check.add(index)
+            
+            for word in name_matcher.regex_search_strings + name_matcher.not_regex_search_strings + \
+                        [word for word_set in name_matcher.regex_search_sets for word in word_set]:
+                if word not in regex_words:
+                    # Words without special characters can't match unless they are in the name, which is much faster to check.
+                    literal = None if any(character in word for character in '.^$*+?{}[]\\|()') else word
+                    regex_words[word] = (re.compile(_create_column_regex_any([word])), literal)
+            in_words.update(name_matcher.in_strings, name_matcher.not_in_strings, 
+                            *name_matcher.in_string_sets)
+            finder_specs.append((name,
+                                 frozenset(name_matcher.regex_search_strings),
+                                 [frozenset(word_set) for word_set in name_matcher.regex_search_sets],
+                                 frozenset(name_matcher.not_regex_search_strings),
+                                 frozenset(name_matcher.in_strings),
+                                 [frozenset(word_set) for word_set in name_matcher.in_string_sets],
+                                 frozenset(name_matcher.not_in_strings),
+                                 frozenset(name_matcher.exact_strings)))
+        self._regex_words = regex_words
+        self._in_words = list(in_words)
+        self._finder_specs = finder_specs
+        self._regex_triggers = regex_triggers
+        self._in_triggers = in_triggers
+        self._exact_triggers = exact_triggers
+        self._always_check = always_check
+        # Identifies the matching rules, so a saved cache isn't used with different ColumnFinders.
+        signature = json.dumps([[sorted(spec) if isinstance(spec, frozenset) else [sorted(word_set) for word_set in spec] if isinstance(spec, list) else spec 
+                                 for spec in finder_spec] for finder_spec in finder_specs])
+        self._signature = hashlib.blake2b(signature.encode('utf-8'), digest_size=16).hexdigest()
+        self.clear_cache()
+    
+    def clear_cache(self):
+        """Remove all names from the cache and reset the hit and miss counts."""
+        self._name_cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
+    def save_cache(self, path: str):
+        """Save the cache to a JSON file.
+        
+        Args:
+            path: The path to the file to save to.
+        """
+        with open(path, 'w', encoding='utf-8') as open_file:
+            json.dump({'signature': self._signature, 'names': self._name_cache}, open_file)
+    
+    def load_cache(self, path: str) -> bool:
+        """Add the names from a cache saved with save_cache.
+        
+        The saved cache is ignored if it was made with different ColumnFinders.
+        
+        Args:
+            path: The path to the file to load from.
+        
+        Returns:
+            True if the saved cache was loaded, False if it was ignored.
+        """
+        with open(path, 'r', encoding='utf-8') as open_file:
+            saved_cache = json.load(open_file)
+        if saved_cache.get('signature') != self._signature:
+            return False
+        for modified_name, standard_names in saved_cache['names'].items():
+            self._cache_names(modified_name, standard_names)
+        return True
+    
+    def _cache_names(self, modified_name: str, standard_names: list[str]):
+        if self.cache_size <= 0:
+            return
+        self._name_cache[modified_name] = standard_names
+        self._name_cache.move_to_end(modified_name)
+        while len(self._name_cache) > self.cache_size:
+            self._name_cache.popitem(last=False)
+    
+    def name_match(self, modified_name: str) -> list[str]:
+        """Return the standard names that match a single name.
+        
+        Args:
+            modified_name: The name to match, modified for matching the same way as the values given to dict_match.
+        
+        Returns:
+            A list of the standard names whose NameMatcher matches modified_name, in the order of the ColumnFinders.
+        """
+        if modified_name in self._name_cache:
+            self.cache_hits += 1
+            self._name_cache.move_to_end(modified_name)
+            return list(self._name_cache[modified_name])
+        self.cache_misses += 1
+        standard_names = self._match_name(modified_name)
+        self._cache_names(modified_name, standard_names)
+        return list(standard_names)
+    
+    def _match_name(self, modified_name: str) -> list[str]:
+        # The lookaheads used for regex_search_sets don't cross new lines, so fall back to the NameMatchers to get the same result.
+        if '\n' in modified_name:
+            return [name for name, finder in self.column_finders.items() if finder.name_dict_match({name: modified_name})]
+        
+        regex_found = {word for word, (regex, literal) in self._regex_words.items() 
+                       if (literal is None or literal in modified_name) and regex.search(modified_name)}
+        in_found = {word for word in self._in_words if word in modified_name}
+        candidates = set(self._always_check)
+        candidates.update(*[self._regex_triggers[word] for word in regex_found if word in self._regex_triggers])
+        candidates.update(*[self._in_triggers[word] for word in in_found if word in self._in_triggers])
+        candidates.update(self._exact_triggers.get(modified_name, ()))
+        
+        standard_names = []
+        for index in sorted(candidates):
+            name, regex_strings, regex_sets, not_regex_strings, in_strings, in_sets, not_in_strings, exact_strings = self._finder_specs[index]
+            if (not regex_found.isdisjoint(regex_strings) or \
+                any(word_set <= regex_found for word_set in regex_sets) or \
+                not in_found.isdisjoint(in_strings) or \
+                any(word_set <= in_found for word_set in in_sets) or \
+                modified_name in exact_strings) and \
+               regex_found.isdisjoint(not_regex_strings) and \
+               in_found.isdisjoint(not_in_strings):
+                standard_names.append(name)
+        return standard_names
+    
+    def dict_match(self, name_map: dict[str, str]) -> dict[str, list[str]]:
+        """Return the names that match each standard name.
+        
+        Args:
+            name_map: a dictionary of original names to the modified version of that name to use for matching.
+        
+        Returns:
+            A dictionary of standard names to the list of original names that match it. Only standard names 
+            with at least 1 match are included, and they are in the order of the ColumnFinders.
+        """
+        matches = {}
+        for original_name, modified_name in name_map.items():
+            for standard_name in self.name_match(modified_name):
+                matches.setdefault(standard_name, []).append(original_name)
+        return {name: matches[name] for name in self.column_finders if name in matches}
+
+
 
 def make_list_regex(element_regex: str, delimiter: str , quoted_elements: bool = False, empty_string: bool = False) -> str:
     r"""Creates a regular expression that will match a list of element_regex delimited by delimiter.
@@ -1051,6 +1355,9 @@ column_finders = [
 
 column_finders = {finder.standard_name: finder for finder in column_finders}
 
+#: A ColumnFinderSet of all of the column_finders to match them in a single pass.
+column_finder_set = ColumnFinderSet(column_finders.values())
+
 
 implied_pairs = {'other_id': ['other_id_type'], 'retention_index': ['retention_index_type']}
 
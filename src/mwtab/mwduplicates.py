@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+mwtab.mwduplicates
+~~~~~~~~~~~~~~~~~~
+
+This module provides the :class:`~mwtab.mwduplicates.MinHashLSH` class and the
+:func:`~mwtab.mwduplicates.find_near_duplicates` function, which find analyses that were deposited
+more than once or are nearly identical. Each analysis's set of metabolites is summarized by a short
+MinHash signature, and signatures are put in buckets by locality sensitive hashing (LSH), so only
+analyses that share a bucket are compared instead of every pair of analyses.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import sys
+
+from . import fileio
+from .mwtab import MWTabFile
+from .mwindex import _print_read_error
+from ._lazy import LazyModule
+
+numpy = LazyModule("numpy")
+
+
+#: The Mersenne prime 2**31 - 1. Hashes are taken modulo it, so products of 2 of them fit in 64 bits.
+_PRIME = (1 << 31) - 1
+
+
+def _item_hashes(items) -> numpy.ndarray:
+    """Return a stable 64 bit hash of each item, reduced modulo _PRIME.
+
+    Python's hash() of a string changes between processes, so blake2b is used instead, so
+    signatures are the same every time they are computed.
+    """
+    return numpy.fromiter((int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "little") % _PRIME
+                           for item in items), dtype=numpy.uint64)
+
+
+class MinHashLSH:
+    """Find pairs of sets with a Jaccard similarity at or above a threshold using MinHash and LSH.
+
+    Each set is reduced to a signature of num_perm minimum hash values. The fraction of positions where
+    2 signatures are equal estimates the Jaccard similarity of the sets. The signatures are split into
+    bands of rows, and 2 sets are compared only if all of the rows of at least 1 band are equal. The
+    number of bands is chosen so sets with a similarity at the threshold are very likely to share a band,
+    which makes finding the pairs about linear in the number of sets instead of quadratic.
+
+    Parameters:
+        threshold: The lowest estimated Jaccard similarity, from 0 to 1, to report a pair.
+        num_perm: The number of hash functions, the length of each signature. More is more accurate and slower.
+        seed: The seed for the hash functions. Signatures are only comparable if they use the same seed and num_perm.
+
+    Examples:
+        Basic usage.
+
+        >>> lsh = MinHashLSH(threshold=0.8)
+        >>> lsh.add('AN000001', ['Glucose', 'Fructose', 'Citric acid', 'Alanine', 'Leucine'])
+        >>> lsh.add('AN000002', ['Glucose', 'Fructose', 'Citric acid', 'Alanine', 'Leucine'])
+        >>> lsh.add('AN000003', ['Cortisol', 'Estrone'])
+        >>> lsh.duplicates()
+        [('AN000001', 'AN000002', 1.0)]
+
+    Attributes:
+        threshold: The lowest estimated Jaccard similarity to report a pair.
+        num_perm: The length of each signature.
+        bands: The number of LSH bands.
+        rows: The number of signature values in each band.
+        signatures: A dictionary of keys to their signatures.
+    """
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, seed: int = 1):
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold must be greater than 0 and at most 1.")
+        if num_perm < 1:
+            raise ValueError("num_perm must be at least 1.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        generator = numpy.random.default_rng(seed)
+        self._a = generator.integers(1, _PRIME, num_perm, dtype=numpy.uint64)
+        self._b = generator.integers(0, _PRIME, num_perm, dtype=numpy.uint64)
+
+        # The similarity at which a pair is as likely as not to share a band is about (1/bands)**(1/rows).
+        # Use the most rows that put that at or below the threshold, so pairs above it are rarely missed.
+        self.rows = 1
+        for rows in range(1, num_perm + 1):
+            if num_perm % rows == 0 and (rows / num_perm) ** (1 / rows) <= threshold:
+                self.rows = rows
+        self.bands = num_perm // self.rows
+        self.signatures = {}
+        self._buckets = [{} for _ in range(self.bands)]
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def signature(self, items) -> numpy.ndarray:
+        """Return the MinHash signature of a set of strings.
+
+        Args:
+            items: The strings in the set. Repeated strings are the same as 1.
+
+        Returns:
+            An array of num_perm hash values.
+
+        Raises:
+            ValueError: If items is empty.
+        """
+        hashes = _item_hashes(set(items))
+        if not len(hashes):
+            raise ValueError("Can't make a signature of an empty set.")
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def add(self, key: str, items):
+        """Add a set of strings to the index.
+
+        Args:
+            key: The name to report the set by, such as an analysis ID.
+            items: The strings in the set.
+
+        Raises:
+            ValueError: If key was already added or items is empty.
+        """
+        self.add_signature(key, self.signature(items))
+
+    def add_signature(self, key: str, signature: numpy.ndarray):
+        """Add a signature made by :meth:`signature` to the index.
+
+        Args:
+            key: The name to report the set by, such as an analysis ID.
+            signature: The signature of the set.
+
+        Raises:
+            ValueError: If key was already added.
+        """
+        if key in self.signatures:
+            raise ValueError('The key, "' + key + '", was already added.')
+        self.signatures[key] = signature
+        for band, buckets in enumerate(self._buckets):
+            buckets.setdefault(signature[band*self.rows:(band+1)*self.rows].tobytes(), []).append(key)
+
+    def similarity(self, key1: str, key2: str) -> float:
+        """Return the estimated Jaccard similarity of 2 sets in the index.
+
+        Args:
+            key1: The key of the first set.
+            key2: The key of the second set.
+
+        Returns:
+            The fraction of the signatures that are equal.
+        """
+        return float(numpy.mean(self.signatures[key1] == self.signatures[key2]))
+
+    def candidates(self) -> set[tuple[str, str]]:
+        """Return the pairs of keys that share at least 1 band, each pair in the order they were added."""
+        order = {key: position for position, key in enumerate(self.signatures)}
+        pairs = set()
+        for buckets in self._buckets:
+            for keys in buckets.values():
+                for i, key1 in enumerate(keys):
+                    for key2 in keys[i+1:]:
+                        pairs.add((key1, key2) if order[key1] < order[key2] else (key2, key1))
+        return pairs
+
+    def query(self, items) -> list[tuple[str, float]]:
+        """Return the sets in the index that are similar to items.
+
+        Args:
+            items: The strings in the set to compare.
+
+        Returns:
+            A list of the keys with an estimated similarity at or above the threshold and their similarity,
+            most similar first.
+        """
+        signature = self.signature(items)
+        keys = {key for band, buckets in enumerate(self._buckets)
+                for key in buckets.get(signature[band*self.rows:(band+1)*self.rows].tobytes(), ())}
+        matches = [(key, float(numpy.mean(self.signatures[key] == signature))) for key in keys]
+        return sorted([match for match in matches if match[1] >= self.threshold], key=lambda match: (-match[1], match[0]))
+
+    def duplicates(self) -> list[tuple[str, str, float]]:
+        """Return the pairs of sets with an estimated similarity at or above the threshold.
+
+        Returns:
+            A list of tuples of 2 keys and their estimated similarity, most similar first.
+        """
+        pairs = [(key1, key2, self.similarity(key1, key2)) for key1, key2 in self.candidates()]
+        return sorted([pair for pair in pairs if pair[2] >= self.threshold], key=lambda pair: (-pair[2], pair[0], pair[1]))
+
+
+def analysis_items(mwtabfile: MWTabFile, include_samples: bool = False) -> set[str]:
+    """Return the set of metabolites, and optionally samples, of an analysis to compare it to others with.
+
+    Metabolite names are taken from the Data table, and are compared without regard to case or surrounding
+    whitespace. Sample IDs are taken from SUBJECT_SAMPLE_FACTORS.
+
+    Args:
+        mwtabfile: The analysis.
+        include_samples: If True, include the sample IDs.
+
+    Returns:
+        The metabolites, prefixed with "metabolite:", and samples, prefixed with "sample:".
+    """
+    items = set()
+    data_section_key = mwtabfile.data_section_key
+    if data_section_key and "Data" in mwtabfile[data_section_key]:
+        # DuplicatesDict doesn't support get(), so check for keys with "in".
+        items.update("metabolite:" + str(row["Metabolite"]).strip().casefold()
+                     for row in mwtabfile[data_section_key]["Data"] if "Metabolite" in row and row["Metabolite"] is not None)
+    if include_samples and "SUBJECT_SAMPLE_FACTORS" in mwtabfile:
+        items.update("sample:" + str(factors["Sample ID"]).strip()
+                     for factors in mwtabfile["SUBJECT_SAMPLE_FACTORS"] if "Sample ID" in factors)
+    return items
+
+
+def find_near_duplicates(sources: str|list[str], threshold: float = 0.9, num_perm: int = 128, include_samples: bool = False,
+                         force: bool = False, verbose: bool = False) -> list[tuple[str, str, float]]:
+    """Find pairs of analyses in sources with nearly the same metabolites.
+
+    Each file is read once and only its signature is kept, so this works on large collections of files.
+    Analyses without any metabolites are skipped. If the same analysis ID is in more than 1 file, the later
+    ones are named by their analysis ID followed by their source in parentheses.
+
+    Args:
+        sources: A path or list of paths to files, directories, archives, or URLs to read.
+        threshold: The lowest estimated Jaccard similarity, from 0 to 1, to report a pair.
+        num_perm: The length of the MinHash signatures.
+        include_samples: If True, compare the sample IDs as well as the metabolites.
+        force: Ignore non-dictionary values in METABOLITES_DATA, METABOLITES, and EXTENDED tables for JSON files.
+        verbose: If True, print the files as they are read.
+
+    Returns:
+        A list of tuples of 2 analysis IDs and their estimated similarity, most similar first.
+    """
+    sources = [sources] if not isinstance(sources, list) else sources
+    lsh = MinHashLSH(threshold, num_perm)
+    for mwtabfile, e in fileio.read_with_class(sources, MWTabFile, {'duplicate_keys': True, 'force': force}, return_exceptions=True):
+        if e is not None:
+            _print_read_error(mwtabfile, e)
+            continue
+        items = analysis_items(mwtabfile, include_samples)
+        if not items:
+            continue
+        key = mwtabfile.analysis_id
+        if key in lsh.signatures:
+            key = "{} ({})".format(key, mwtabfile.source)
+        lsh.add(key, items)
+        if verbose:
+            print("Read file: {}".format(mwtabfile.source), file=sys.stdout)
+    return lsh.duplicates()
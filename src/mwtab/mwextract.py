@@ -8,14 +8,26 @@ mwtab.mwextract
 This module provides a number of functions and classes for extracting and saving data and metadata
 stored in ``mwTab`` formatted files in the form of :class:`~mwtab.mwtab.MWTabFile`.
 """
+from __future__ import annotations
+
 import csv
 import json
 import os
 import re
 import traceback
 import sys
+import heapq
+import itertools
+import tempfile
+import array
+from collections.abc import Mapping
 
 from mwtab import fileio
+from mwtab.mwtab import MWTabFile
+from mwtab._lazy import LazyModule
+
+numpy = LazyModule("numpy")
+pyarrow = LazyModule("pyarrow", ("pyarrow.compute",))
 
 
 class ItemMatcher(object):
@@ -101,37 +113,178 @@ def generate_matchers(items):
             yield ItemMatcher(item[0], item[1])
 
 
-def extract_metabolites(sources, matcher_generator):
+def _metadata_str(mwtab_str, sections):
+    """Return only the header and the given sections from an ``mwTab`` formatted string.
+
+    :param str mwtab_str: String in ``mwTab`` format.
+    :param set sections: Names of the sections to keep, as they appear in the section headers, e.g. "SUBJECT".
+    :return: String in ``mwTab`` format with only the header and the given sections.
+    :rtype: :py:class:`str`
+    """
+    lines = mwtab_str.split("\n")
+    kept_lines = lines[:1]
+    keep = False
+    for line in lines[1:]:
+        if line.startswith("#"):
+            keep = line[1:].split(":")[0].strip() in sections or line.strip() == "#END"
+        if keep:
+            kept_lines.append(line)
+    return "\n".join(kept_lines)
+
+
+class MatcherFilteredMWTabFile(MWTabFile):
+    """:class:`~mwtab.mwtab.MWTabFile` that only parses the whole file if it matches all of the given matchers.
+
+    The sections the matchers use are parsed first and the matchers are tested on them. If the matchers
+    don't all match, the rest of the file, including the data tables, is not parsed, and the instance only
+    has the header and those sections. This makes filtering a large number of files much faster. JSON
+    files, and matchers that aren't :class:`~mwtab.mwextract.ItemMatcher` instances, always parse the
+    whole file.
+    """
+
+    def __init__(self, source, matchers=None, *args, **kwds):
+        """MatcherFilteredMWTabFile initializer.
+
+        :param str source: Source a `MWTabFile` instance was created from.
+        :param list matchers: Matcher objects (:class:`~mwtab.mwextract.ItemMatcher` or
+                              :class:`~mwtab.mwextract.ReGeXMatcher`) that must match to parse the whole file.
+        """
+        super(MatcherFilteredMWTabFile, self).__init__(source, *args, **kwds)
+        self.matchers = list(matchers) if matchers else []
+        self.fully_parsed = False
+
+    def read(self, filehandle):
+        """Read data into a :class:`~mwtab.mwextract.MatcherFilteredMWTabFile` instance.
+
+        :param filehandle: file-like object.
+        :type filehandle: :py:class:`io.TextIOWrapper`, :py:class:`gzip.GzipFile`,
+                          :py:class:`bz2.BZ2File`, :py:class:`zipfile.ZipFile`
+        :return: None
+        :rtype: :py:obj:`None`
+        """
+        input_str = filehandle.read()
+        filehandle.close()
+
+        if input_str and self.matchers and all(isinstance(matcher, ItemMatcher) for matcher in self.matchers) and \
+           (mwtab_str := self._is_mwtab(input_str)):
+            metadata_str = _metadata_str(mwtab_str, {matcher.section for matcher in self.matchers})
+            metadata_mwtabfile = MWTabFile(self.source, duplicate_keys=self._duplicate_keys, force=self._force)
+            try:
+                metadata_mwtabfile.read_from_str(metadata_str)
+                matched = all([matcher(metadata_mwtabfile) for matcher in self.matchers])
+            # If there is any problem, parse the whole file so it is handled the same way as without filtering.
+            except Exception:
+                matched = True
+            if not matched:
+                self.read_from_str(metadata_str)
+                return
+
+        self.read_from_str(input_str)
+        self.fully_parsed = True
+
+
+def extract_metabolites(sources, matcher_generator, threshold=0):
     """Extract metabolite data from ``mwTab`` formatted files in the form of :class:`~mwtab.mwtab.MWTabFile`.
 
+    A metabolite is considered present in a sample if its value in the Data table is a number
+    greater than ``threshold``. The values in each Data table are converted to numbers all at
+    once, and values that aren't numbers are ignored.
+
     :param generator sources: Generator of mwtab file objects (:class:`~mwtab.mwtab.MWTabFile`).
     :param generator matcher_generator: Generator of matcher objects (:class:`~mwtab.mwextract.ItemMatcher` or
                                                                       :class:`~mwtab.mwextract.ReGeXMatcher`).
+    :param threshold: Values must be greater than this for the sample to be included.
+    :type threshold: :py:class:`int` or :py:class:`float`
     :return: Extracted metabolites dictionary.
     :rtype: :py:class:`dict`
     """
-    matchers = [matcher for matcher in matcher_generator]
     metabolites = dict()
+    for metabolite, study_id, analysis_id, samples in metabolite_rows(sources, matcher_generator, threshold):
+        metabolites.setdefault(metabolite, dict())\
+            .setdefault(study_id, dict())\
+            .setdefault(analysis_id, set())\
+            .update(samples)
+    return metabolites
+
+
+def metabolite_rows(sources, matcher_generator, threshold=0):
+    """Generate the metabolites in ``mwTab`` formatted files 1 row at a time, as the files are read.
+
+    This is what :func:`~mwtab.mwextract.extract_metabolites` collects into a dictionary. Use it with
+    :func:`~mwtab.mwextract.merge_metabolite_rows` to combine the rows without keeping them all in memory.
+
+    :param generator sources: Generator of mwtab file objects (:class:`~mwtab.mwtab.MWTabFile`).
+    :param generator matcher_generator: Generator of matcher objects (:class:`~mwtab.mwextract.ItemMatcher` or
+                                                                      :class:`~mwtab.mwextract.ReGeXMatcher`).
+    :param threshold: Values must be greater than this for the sample to be included.
+    :type threshold: :py:class:`int` or :py:class:`float`
+    :return: Yields a tuple of the metabolite, study ID, analysis ID, and list of samples for each row in the Data tables.
+    :rtype: :py:class:`tuple`
+    """
+    matchers = [matcher for matcher in matcher_generator]
     for mwtabfile, e in sources:
         if e is not None:
-            file_source = mwtabfile if isinstance(mwtabfile, str) else "from the given input."
-            print("Something went wrong when trying to read " + file_source)
-            traceback.print_exception(e, file=sys.stdout)
-            print()
+            print(_read_error_text(mwtabfile, e))
             continue
         if all([matcher(mwtabfile) for matcher in matchers]):
-            data_section_key = mwtabfile.data_section_key
-            for data_dict in mwtabfile[data_section_key]["Data"]:
-                for test_key in (key for key in data_dict.keys() if key != "Metabolite"):
-                    try:
-                        if float(data_dict[test_key]) > 0:
-                            metabolites.setdefault(data_dict["Metabolite"], dict())\
-                                .setdefault(mwtabfile.study_id, dict())\
-                                .setdefault(mwtabfile.analysis_id, set())\
-                                .add(test_key)
-                    except Exception:
-                        pass
-    return metabolites
+            for metabolite, samples in _metabolite_samples(mwtabfile, threshold):
+                yield metabolite, mwtabfile.study_id, mwtabfile.analysis_id, samples
+
+
+#: Matches the strings that :py:class:`float` can convert, except for ones with underscores.
+NUMBER_REGEX = r'^[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|inf|infinity|nan)$'
+
+
+def _metabolite_samples(mwtabfile, threshold):
+    """Generate the samples with a value greater than threshold for each metabolite in the Data table.
+
+    All of the values in the Data table are converted to numbers at once using pyarrow, instead of
+    one at a time, and values that aren't numbers are treated as missing.
+
+    :param mwtabfile: mwTab file object to get the Data table from.
+    :type mwtabfile: :class:`~mwtab.mwtab.MWTabFile`
+    :param threshold: Values must be greater than this for the sample to be included.
+    :type threshold: :py:class:`int` or :py:class:`float`
+    :return: Yields a tuple of the metabolite name and a list of samples for each row with at least 1 sample.
+    :rtype: :py:class:`tuple`
+    """
+    data_section_key = mwtabfile.data_section_key
+    if not data_section_key or "Data" not in mwtabfile[data_section_key]:
+        return
+    # DuplicatesDict doesn't support get(), so check for keys with "in".
+    rows = [row for row in mwtabfile[data_section_key]["Data"] if "Metabolite" in row and row["Metabolite"] is not None]
+    if not rows:
+        return
+    first_keys = list(rows[0].keys())
+    if all(list(row.keys()) == first_keys for row in rows):
+        # Usually every row has the same columns, so the values can be taken in order without looking up each key.
+        keys = first_keys
+        values = [value for row in rows for value in row.values()]
+    else:
+        keys = list(dict.fromkeys(key for row in rows for key in row.keys()))
+        values = [row[key] if key in row else None for row in rows for key in keys]
+    # Duplicate sample names only use the first column with that name, the same as looking the value up by name.
+    first_indexes = {}
+    for index, key in enumerate(keys):
+        first_indexes.setdefault(key, index)
+    sample_columns = [index for key, index in first_indexes.items() if key != "Metabolite"]
+    if not sample_columns:
+        return
+
+    try:
+        values = pyarrow.array(values, type=pyarrow.string())
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        values = pyarrow.array([value if value is None or isinstance(value, str) else str(value) for value in values],
+                               type=pyarrow.string())
+    values = pyarrow.compute.utf8_trim_whitespace(values)
+    is_number = pyarrow.compute.match_substring_regex(values, NUMBER_REGEX, ignore_case=True)
+    numbers = pyarrow.compute.cast(pyarrow.compute.if_else(is_number, values, None), pyarrow.float64())
+    above_threshold = pyarrow.compute.fill_null(pyarrow.compute.greater(numbers, threshold), False)
+    sample_mask = above_threshold.to_numpy(zero_copy_only=False).reshape(len(rows), len(keys))[:, sample_columns]
+    sample_names = [keys[index] for index in sample_columns]
+    for row, row_mask in zip(rows, sample_mask):
+        if row_mask.any():
+            yield row["Metabolite"], [sample_names[index] for index in row_mask.nonzero()[0]]
 
 
 def extract_metadata(mwtabfile, keys):
@@ -153,6 +306,433 @@ def extract_metadata(mwtabfile, keys):
     return extracted_values
 
 
+def metadata_records(sources, keys):
+    """Generate the extracted metadata of ``mwTab`` formatted files 1 file at a time, as the files are read.
+
+    Example record:
+    {"study_id": "ST000001", "analysis_id": "AN000001", "metadata": {"SUBJECT_TYPE": {"Human"}}}
+
+    :param generator sources: Generator of mwtab file objects (:class:`~mwtab.mwtab.MWTabFile`).
+    :param list keys: List of metadata field keys for metadata values to be extracted.
+    :return: Yields a record for each file with at least 1 of the keys.
+    :rtype: :py:class:`dict`
+    """
+    for mwtabfile, e in sources:
+        if e is not None:
+            print(_read_error_text(mwtabfile, e))
+            continue
+        record = _metadata_record(mwtabfile, keys)
+        if record is not None:
+            yield record
+
+
+def _metadata_record(mwtabfile, keys):
+    """Return the record for :func:`~mwtab.mwextract.metadata_records`, or None if the file doesn't have any of the keys.
+
+    :param mwtabfile: mwTab file object for metadata to be extracted from.
+    :type mwtabfile: :class:`~mwtab.mwtab.MWTabFile`
+    :param list keys: List of metadata field keys for metadata values to be extracted.
+    :return: The metadata record.
+    :rtype: :py:class:`dict` or :py:obj:`None`
+    """
+    extracted_values = extract_metadata(mwtabfile, keys)
+    if not extracted_values:
+        return None
+    return {"study_id": mwtabfile.study_id, "analysis_id": mwtabfile.analysis_id, "metadata": extracted_values}
+
+
+def _read_error_text(source, e):
+    """Return the message printed when a file can't be read, so it can be passed between processes.
+
+    :param source: The source that couldn't be read.
+    :param Exception e: The exception raised when reading the source.
+    :return: The message to print.
+    :rtype: :py:class:`str`
+    """
+    file_source = source if isinstance(source, str) else "from the given input."
+    return "Something went wrong when trying to read " + file_source + "\n" + "".join(traceback.format_exception(e))
+
+
+def _extract_source_metabolites(source, matchers, threshold, class_kwds):
+    """Extract metabolites from 1 source, used by the workers in :func:`~mwtab.mwextract.metabolite_rows_parallel`.
+
+    The results are integer coded to keep them small when they are sent back to the main process. Each string
+    is replaced by its index in a list of the unique strings.
+
+    :param str source: Path or URL to read files from.
+    :param list matchers: Matcher objects the files must match.
+    :param threshold: Values must be greater than this for the sample to be included.
+    :param dict class_kwds: Keyword arguments for :class:`~mwtab.mwextract.MatcherFilteredMWTabFile`.
+    :return: A tuple of the list of strings, a list of (metabolite, study, analysis, samples) tuples of
+             indexes into the strings, and a list of error messages.
+    :rtype: :py:class:`tuple`
+    """
+    string_codes = {}
+    rows = []
+    errors = []
+    for mwtabfile, e in fileio.read_with_class(source, MatcherFilteredMWTabFile, dict(class_kwds, matchers=matchers), return_exceptions=True):
+        if e is not None:
+            errors.append(_read_error_text(mwtabfile, e))
+            continue
+        if all([matcher(mwtabfile) for matcher in matchers]):
+            study_code = string_codes.setdefault(mwtabfile.study_id, len(string_codes))
+            analysis_code = string_codes.setdefault(mwtabfile.analysis_id, len(string_codes))
+            for metabolite, samples in _metabolite_samples(mwtabfile, threshold):
+                rows.append((string_codes.setdefault(metabolite, len(string_codes)), study_code, analysis_code,
+                             tuple(string_codes.setdefault(sample, len(string_codes)) for sample in samples)))
+    return list(string_codes), rows, errors
+
+
+def _extract_source_metadata(source, keys, class_kwds):
+    """Extract metadata from 1 source, used by the workers in :func:`~mwtab.mwextract.metadata_records_parallel`.
+
+    :param str source: Path or URL to read files from.
+    :param list keys: List of metadata field keys for metadata values to be extracted.
+    :param dict class_kwds: Keyword arguments for :class:`~mwtab.mwtab.MWTabFile`.
+    :return: A tuple of the list of metadata records and a list of error messages.
+    :rtype: :py:class:`tuple`
+    """
+    records = []
+    errors = []
+    for mwtabfile, e in fileio.read_with_class(source, MWTabFile, class_kwds, return_exceptions=True):
+        if e is not None:
+            errors.append(_read_error_text(mwtabfile, e))
+            continue
+        record = _metadata_record(mwtabfile, keys)
+        if record is not None:
+            records.append(record)
+    return records, errors
+
+
+def _map_sources(function, sources, jobs, *args):
+    """Run function on each file in sources in a pool of processes and yield the results in order.
+
+    :param function: The function to run, called with the source followed by args. It must return a tuple
+                     whose last item is a list of error messages.
+    :param sources: A path or list of paths to files, directories, archives, or URLs.
+    :param jobs: The number of processes to use. If None, the number of CPUs is used.
+    :type jobs: :py:class:`int` or :py:obj:`None`
+    :return: Yields the result for each file without its error messages, which are printed.
+    :rtype: :py:class:`tuple`
+    """
+    # Imported here because it imports multiprocessing, which most commands don't need.
+    from concurrent.futures import ProcessPoolExecutor
+
+    sources = [sources] if not isinstance(sources, list) else sources
+    filenames = list(fileio._generate_filenames(sources, True))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(function, filename, *args) if e is None else None for filename, e in filenames]
+        for (filename, e), future in zip(filenames, futures):
+            if e is not None:
+                print(_read_error_text(filename, e))
+                continue
+            *result, errors = future.result()
+            for error in errors:
+                print(error)
+            yield result
+
+
+def metabolite_rows_parallel(sources, matchers, threshold=0, jobs=None, class_kwds=None):
+    """Generate the metabolites in ``mwTab`` formatted files 1 row at a time, reading the files in multiple processes.
+
+    The rows are the same, and in the same order, as :func:`~mwtab.mwextract.metabolite_rows`, but the files
+    are given as paths instead of already read :class:`~mwtab.mwtab.MWTabFile` instances, because the reading
+    is what is done in parallel. Files that can't be read are reported the same way.
+
+    :param sources: A path or list of paths to files, directories, archives, or URLs.
+    :type sources: :py:class:`str` or :py:class:`list`
+    :param list matchers: Matcher objects (:class:`~mwtab.mwextract.ItemMatcher` or
+                          :class:`~mwtab.mwextract.ReGeXMatcher`). They must be picklable.
+    :param threshold: Values must be greater than this for the sample to be included.
+    :type threshold: :py:class:`int` or :py:class:`float`
+    :param jobs: The number of processes to use. If None, the number of CPUs is used.
+    :type jobs: :py:class:`int` or :py:obj:`None`
+    :param dict class_kwds: Keyword arguments for :class:`~mwtab.mwtab.MWTabFile`, defaults to {"duplicate_keys": True}.
+    :return: Yields a tuple of the metabolite, study ID, analysis ID, and list of samples for each row in the Data tables.
+    :rtype: :py:class:`tuple`
+    """
+    class_kwds = {"duplicate_keys": True} if class_kwds is None else class_kwds
+    for strings, rows in _map_sources(_extract_source_metabolites, sources, jobs, list(matchers), threshold, class_kwds):
+        for metabolite_code, study_code, analysis_code, sample_codes in rows:
+            yield (strings[metabolite_code], strings[study_code], strings[analysis_code],
+                   [strings[sample_code] for sample_code in sample_codes])
+
+
+def metadata_records_parallel(sources, keys, jobs=None, class_kwds=None):
+    """Generate the extracted metadata of ``mwTab`` formatted files 1 file at a time, reading the files in multiple processes.
+
+    The records are the same, and in the same order, as :func:`~mwtab.mwextract.metadata_records`.
+
+    :param sources: A path or list of paths to files, directories, archives, or URLs.
+    :type sources: :py:class:`str` or :py:class:`list`
+    :param list keys: List of metadata field keys for metadata values to be extracted.
+    :param jobs: The number of processes to use. If None, the number of CPUs is used.
+    :type jobs: :py:class:`int` or :py:obj:`None`
+    :param dict class_kwds: Keyword arguments for :class:`~mwtab.mwtab.MWTabFile`, defaults to {"duplicate_keys": True}.
+    :return: Yields a record for each file with at least 1 of the keys.
+    :rtype: :py:class:`dict`
+    """
+    class_kwds = {"duplicate_keys": True} if class_kwds is None else class_kwds
+    for records, in _map_sources(_extract_source_metadata, sources, jobs, list(keys), class_kwds):
+        yield from records
+
+
+def extract_metabolites_parallel(sources, matchers, threshold=0, jobs=None, class_kwds=None):
+    """Extract metabolite data from ``mwTab`` formatted files using multiple processes.
+
+    Each file is read and extracted in a separate process (map), and the main process merges the results
+    into 1 dictionary (reduce). The result is the same as :func:`~mwtab.mwextract.extract_metabolites`, but
+    the files are given as paths instead of already read :class:`~mwtab.mwtab.MWTabFile` instances, because
+    the reading is what is done in parallel. Files that can't be read are reported the same way.
+
+    :param sources: A path or list of paths to files, directories, archives, or URLs.
+    :type sources: :py:class:`str` or :py:class:`list`
+    :param list matchers: Matcher objects (:class:`~mwtab.mwextract.ItemMatcher` or
+                          :class:`~mwtab.mwextract.ReGeXMatcher`). They must be picklable.
+    :param threshold: Values must be greater than this for the sample to be included.
+    :type threshold: :py:class:`int` or :py:class:`float`
+    :param jobs: The number of processes to use. If None, the number of CPUs is used.
+    :type jobs: :py:class:`int` or :py:obj:`None`
+    :param dict class_kwds: Keyword arguments for :class:`~mwtab.mwtab.MWTabFile`, defaults to {"duplicate_keys": True}.
+    :return: Extracted metabolites dictionary.
+    :rtype: :py:class:`dict`
+    """
+    metabolites = dict()
+    for metabolite, study_id, analysis_id, samples in metabolite_rows_parallel(sources, matchers, threshold, jobs, class_kwds):
+        metabolites.setdefault(metabolite, dict())\
+            .setdefault(study_id, dict())\
+            .setdefault(analysis_id, set())\
+            .update(samples)
+    return metabolites
+
+
+def extract_metadata_parallel(sources, keys, jobs=None, class_kwds=None):
+    """Extract metadata from ``mwTab`` formatted files using multiple processes.
+
+    Each file is read and extracted in a separate process (map), and the main process merges the results
+    into 1 dictionary (reduce). The result is the same as combining :func:`~mwtab.mwextract.extract_metadata`
+    for every file. Files that can't be read are reported.
+
+    :param sources: A path or list of paths to files, directories, archives, or URLs.
+    :type sources: :py:class:`str` or :py:class:`list`
+    :param list keys: List of metadata field keys for metadata values to be extracted.
+    :param jobs: The number of processes to use. If None, the number of CPUs is used.
+    :type jobs: :py:class:`int` or :py:obj:`None`
+    :param dict class_kwds: Keyword arguments for :class:`~mwtab.mwtab.MWTabFile`, defaults to {"duplicate_keys": True}.
+    :return: Extracted metadata dictionary.
+    :rtype: :py:class:`dict`
+    """
+    metadata = dict()
+    for record in metadata_records_parallel(sources, keys, jobs, class_kwds):
+        for key, values in record["metadata"].items():
+            metadata.setdefault(key, set()).update(values)
+    return metadata
+
+
+class MetaboliteTable(Mapping):
+    """MetaboliteTable class that stores extracted metabolites compactly, with the same lookups as the
+    dictionary from :func:`~mwtab.mwextract.extract_metabolites`.
+
+    Every string (metabolite, study ID, analysis ID, and sample) is stored once in a string table and
+    replaced by its index. The rows are (metabolite, study, analysis) index arrays, and the samples for
+    each row are a slice of 1 array of sample indexes, given by an array of offsets. Looking up a
+    metabolite returns the same {study: {analysis: set of samples}} dictionary as the metabolites
+    dictionary, made when it is looked up.
+
+    Rows with the same metabolite, study, and analysis are combined, like adding samples to the set in
+    the dictionary.
+
+    Example:
+
+    >>> table = MetaboliteTable.from_rows([("Glucose", "ST000001", "AN000001", ["sample1", "sample2"])])
+    >>> table["Glucose"]
+    {'ST000001': {'AN000001': {'sample1', 'sample2'}}}
+    >>> table == {"Glucose": {"ST000001": {"AN000001": {"sample1", "sample2"}}}}
+    True
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._string_codes = {}
+        # Rows added since the arrays were last combined, see _compact().
+        self._new_keys = array.array("i")
+        self._new_lengths = array.array("q")
+        self._new_samples = array.array("i")
+        self._keys = numpy.empty((0, 3), dtype=numpy.intc)
+        self._offsets = numpy.zeros(1, dtype=numpy.int64)
+        self._samples = numpy.empty(0, dtype=numpy.intc)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Create a table from metabolite rows.
+
+        :param rows: Iterable of (metabolite, study ID, analysis ID, samples) tuples, such as from
+                     :func:`~mwtab.mwextract.metabolite_rows`.
+        :return: The table.
+        :rtype: :class:`~mwtab.mwextract.MetaboliteTable`
+        """
+        table = cls()
+        for metabolite, study_id, analysis_id, samples in rows:
+            table.add(metabolite, study_id, analysis_id, samples)
+        return table
+
+    def add(self, metabolite, study_id, analysis_id, samples):
+        """Add samples for a metabolite in an analysis.
+
+        :param str metabolite: The metabolite name.
+        :param str study_id: The study ID.
+        :param str analysis_id: The analysis ID.
+        :param samples: The sample names.
+        :return: None
+        :rtype: :py:obj:`None`
+        """
+        self._new_keys.extend((self._code(metabolite), self._code(study_id), self._code(analysis_id)))
+        sample_count = len(self._new_samples)
+        self._new_samples.extend(self._code(sample) for sample in samples)
+        self._new_lengths.append(len(self._new_samples) - sample_count)
+
+    def _code(self, string):
+        """Return the index of string in the string table, adding it if it is new."""
+        code = self._string_codes.get(string)
+        if code is None:
+            code = self._string_codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+    def _compact(self):
+        """Combine the added rows with the existing ones, sorted by metabolite, study, and analysis, and
+        with the samples of rows that have the same ones combined."""
+        if not self._new_lengths:
+            return
+        keys = numpy.concatenate([self._keys, numpy.frombuffer(self._new_keys, dtype=numpy.intc).reshape(-1, 3)])
+        lengths = numpy.concatenate([numpy.diff(self._offsets), numpy.frombuffer(self._new_lengths, dtype=numpy.int64)])
+        samples = numpy.concatenate([self._samples, numpy.frombuffer(self._new_samples, dtype=numpy.intc)])
+        self._new_keys = array.array("i")
+        self._new_lengths = array.array("q")
+        self._new_samples = array.array("i")
+
+        order = numpy.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))
+        sorted_keys = keys[order]
+        is_first = numpy.ones(len(sorted_keys), dtype=bool)
+        is_first[1:] = (sorted_keys[1:] != sorted_keys[:-1]).any(axis=1)
+        row_groups = numpy.empty(len(keys), dtype=numpy.int64)
+        row_groups[order] = numpy.cumsum(is_first) - 1
+
+        # Each (group, sample) pair is coded as 1 number, so numpy.unique removes duplicate samples and sorts by group.
+        string_count = len(self.strings)
+        pairs = numpy.unique(numpy.repeat(row_groups, lengths) * string_count + samples)
+        self._keys = sorted_keys[is_first]
+        self._samples = (pairs % string_count).astype(numpy.intc)
+        self._offsets = numpy.zeros(len(self._keys) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(pairs // string_count, minlength=len(self._keys)), out=self._offsets[1:])
+
+    def _row_range(self, metabolite):
+        """Return the start and end of the rows for metabolite, which are equal if there aren't any."""
+        self._compact()
+        code = self._string_codes.get(metabolite)
+        if code is None:
+            return 0, 0
+        start, end = numpy.searchsorted(self._keys[:, 0], [code, code + 1])
+        return int(start), int(end)
+
+    def __getitem__(self, metabolite):
+        start, end = self._row_range(metabolite)
+        if start == end:
+            raise KeyError(metabolite)
+        studies = dict()
+        offsets = self._offsets[start:end + 1].tolist()
+        for index, (_, study_code, analysis_code) in enumerate(self._keys[start:end].tolist()):
+            studies.setdefault(self.strings[study_code], dict())[self.strings[analysis_code]] = \
+                {self.strings[code] for code in self._samples[offsets[index]:offsets[index + 1]].tolist()}
+        return studies
+
+    def __contains__(self, metabolite):
+        start, end = self._row_range(metabolite)
+        return start != end
+
+    def __iter__(self):
+        self._compact()
+        for code in numpy.unique(self._keys[:, 0]).tolist():
+            yield self.strings[code]
+
+    def __len__(self):
+        self._compact()
+        return len(numpy.unique(self._keys[:, 0]))
+
+    def __repr__(self):
+        return "{}({} metabolites, {} strings, {} samples)".format(type(self).__name__, len(self), 
+                                                                 len(self.strings), len(self._samples))
+
+    def to_dict(self):
+        """Convert to the dictionary from :func:`~mwtab.mwextract.extract_metabolites`.
+
+        :return: Extracted metabolites dictionary.
+        :rtype: :py:class:`dict`
+        """
+        return {metabolite: self[metabolite] for metabolite in self}
+
+
+def merge_metabolite_rows(rows, max_rows=1000000, temp_dir=None):
+    """Merge metabolite rows into 1 entry per metabolite without keeping all of the rows in memory.
+
+    This is an external merge sort. Rows are collected until there are max_rows of them, then they are sorted
+    and written to a temporary file. At the end the files are merged together in sorted order, so only 1 row
+    from each file and the entry for 1 metabolite are in memory at a time.
+
+    :param rows: Iterable of (metabolite, study ID, analysis ID, samples) tuples, such as from
+                 :func:`~mwtab.mwextract.metabolite_rows`.
+    :param int max_rows: The most rows to keep in memory before writing them to a temporary file.
+    :param temp_dir: Directory to create the temporary files in. If None, the system default is used.
+    :type temp_dir: :py:class:`str` or :py:obj:`None`
+    :return: Yields a tuple of the metabolite and its dictionary of studies to analyses to sets of samples,
+             the same as the values from :func:`~mwtab.mwextract.extract_metabolites`, in metabolite order.
+    :rtype: :py:class:`tuple`
+    """
+    runs = []
+    buffer = []
+    try:
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= max_rows:
+                runs.append(_write_run(buffer, temp_dir))
+                buffer = []
+        buffer.sort(key=_row_sort_key)
+        merged_rows = heapq.merge(*[_read_run(run) for run in runs], buffer, key=_row_sort_key)
+        for metabolite, metabolite_rows in itertools.groupby(merged_rows, key=lambda row: row[0]):
+            studies = dict()
+            for _, study_id, analysis_id, samples in metabolite_rows:
+                studies.setdefault(study_id, dict()).setdefault(analysis_id, set()).update(samples)
+            yield metabolite, studies
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _row_sort_key(row):
+    """Sort metabolite rows by metabolite, study, and analysis. Study and analysis IDs can be None."""
+    return tuple("" if value is None else value for value in row[:3])
+
+
+def _write_run(rows, temp_dir):
+    """Sort rows and write them to a temporary file as JSON Lines, which is deleted when it is closed.
+
+    :param list rows: Metabolite rows to write.
+    :param temp_dir: Directory to create the temporary file in.
+    :return: The temporary file, positioned at the beginning.
+    """
+    run = tempfile.TemporaryFile(mode="w+", encoding="utf-8", dir=temp_dir)
+    for row in sorted(rows, key=_row_sort_key):
+        run.write(json.dumps(row) + "\n")
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    """Yield the rows written by :func:`~mwtab.mwextract._write_run` back as tuples."""
+    for line in run:
+        yield tuple(json.loads(line))
+
+
 def write_metadata_csv(to_path, extracted_values, no_header=False):
     """Write extracted metadata :py:class:`dict` into csv file.
 
@@ -194,23 +774,25 @@ def write_metabolites_csv(to_path, extracted_values, no_header=False):
     ...
 
     :param str to_path: Path to output file.
-    :param dict extracted_values: Metabolites data dictionary to be saved.
+    :param extracted_values: Metabolites data dictionary to be saved.
+    :type extracted_values: :py:class:`dict` or :class:`~mwtab.mwextract.MetaboliteTable`
     :param bool no_header: If true header is not included, otherwise header is included.
     :return: None
     :rtype: :py:obj:`None`
     """
     csv_list = []
-    for metabolite_key in extracted_values.keys():
+    # items() only looks each metabolite up once, which matters for a MetaboliteTable.
+    for metabolite_key, studies in extracted_values.items():
         num_analyses = 0
         num_samples = 0
-        for study_key in extracted_values[metabolite_key]:
-            num_analyses += len(extracted_values[metabolite_key][study_key])
-            for analysis_key in extracted_values[metabolite_key][study_key]:
-                num_samples += len(extracted_values[metabolite_key][study_key][analysis_key])
+        for study_key in studies:
+            num_analyses += len(studies[study_key])
+            for analysis_key in studies[study_key]:
+                num_samples += len(studies[study_key][analysis_key])
 
         csv_list.append([
             metabolite_key,
-            len(extracted_values[metabolite_key]),
+            len(studies),
             num_analyses,
             num_samples
         ])
@@ -228,8 +810,95 @@ def write_metabolites_csv(to_path, extracted_values, no_header=False):
             wr.writerow(line_list)
 
 
+def write_identifiers_csv(to_path, identifiers, no_header=False):
+    """Write the matches from :meth:`~mwtab.mwindex.MWTabIndex.query_identifiers` into csv file, 1 match per line.
+
+    Example:
+    "query","id_type","identifier","study_id","analysis_id","metabolite","row"
+    "hmdb63","hmdb_id","HMDB0000063","ST000001","AN000001","Cortisol","8"
+    ...
+
+    :param str to_path: Path to output file.
+    :param dict identifiers: Dictionary of queried identifiers to their list of matches.
+    :param bool no_header: If true header is not included, otherwise header is included.
+    :return: None
+    :rtype: :py:obj:`None`
+    """
+    fileio._create_save_path(to_path)
+
+    if not os.path.splitext(to_path)[1]:
+        to_path += ".csv"
+
+    fields = ["id_type", "identifier", "study_id", "analysis_id", "metabolite", "row"]
+    with open(to_path, "w", newline="") as outfile:
+        wr = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+        if not no_header:
+            wr.writerow(["query"] + fields)
+        for query, matches in identifiers.items():
+            for match in matches:
+                wr.writerow([query] + [match[field] for field in fields])
+
+
+def write_samples_csv(to_path, samples, no_header=False):
+    """Write the samples from :meth:`~mwtab.mwindex.MWTabIndex.query_samples` into csv file, 1 sample per line.
+
+    Example:
+    "study_id","analysis_id","sample_id"
+    "ST000001","AN000001","LabF_115816"
+    ...
+
+    :param str to_path: Path to output file.
+    :param dict samples: Dictionary of study IDs to analysis IDs to sets of sample IDs.
+    :param bool no_header: If true header is not included, otherwise header is included.
+    :return: None
+    :rtype: :py:obj:`None`
+    """
+    fileio._create_save_path(to_path)
+
+    if not os.path.splitext(to_path)[1]:
+        to_path += ".csv"
+
+    with open(to_path, "w", newline="") as outfile:
+        wr = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+        if not no_header:
+            wr.writerow(["study_id", "analysis_id", "sample_id"])
+        for study_id, analyses in samples.items():
+            for analysis_id, sample_ids in analyses.items():
+                for sample_id in sorted(sample_ids):
+                    wr.writerow([study_id, analysis_id, sample_id])
+
+
+def write_duplicates_csv(to_path, duplicates, no_header=False):
+    """Write the near duplicate analyses from :func:`~mwtab.mwduplicates.find_near_duplicates` into csv file, 1 pair per line.
+
+    Example:
+    "analysis_id_1","analysis_id_2","similarity"
+    "AN000001","AN000002","0.96875"
+    ...
+
+    :param str to_path: Path to output file.
+    :param list duplicates: List of dictionaries with the 2 analysis IDs and their estimated similarity.
+    :param bool no_header: If true header is not included, otherwise header is included.
+    :return: None
+    :rtype: :py:obj:`None`
+    """
+    fileio._create_save_path(to_path)
+
+    if not os.path.splitext(to_path)[1]:
+        to_path += ".csv"
+
+    fields = ["analysis_id_1", "analysis_id_2", "similarity"]
+    with open(to_path, "w", newline="") as outfile:
+        wr = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+        if not no_header:
+            wr.writerow(fields)
+        for duplicate in duplicates:
+            wr.writerow([duplicate[field] for field in fields])
+
+
 class SetEncoder(json.JSONEncoder):
     """SetEncoder class for encoding Python sets :py:class:`set` into json serializable objects :py:class:`list`.
+    :class:`~mwtab.mwextract.MetaboliteTable` instances are encoded as their dictionary.
     """
 
     def default(self, obj):
@@ -245,6 +914,8 @@ class SetEncoder(json.JSONEncoder):
         """
         if isinstance(obj, set):
             return list(obj)
+        if isinstance(obj, MetaboliteTable):
+            return obj.to_dict()
         return json.JSONEncoder.default(self, obj)
 
 
@@ -274,7 +945,8 @@ def write_json(to_path, extracted_dict):
         }
 
     :param str to_path: Path to output file.
-    :param dict extracted_dict: Metabolites data or metadata dictionary to be saved.
+    :param extracted_dict: Metabolites data or metadata dictionary to be saved.
+    :type extracted_dict: :py:class:`dict` or :class:`~mwtab.mwextract.MetaboliteTable`
     :return: None
     :rtype: :py:obj:`None`
     """
@@ -285,3 +957,42 @@ def write_json(to_path, extracted_dict):
 
     with open(to_path, "w") as outfile:
         json.dump(extracted_dict, outfile, sort_keys=True, indent=4, cls=SetEncoder)
+
+
+def write_jsonl(to_path, records):
+    """Write records into a JSON Lines file, 1 record per line, as they are generated.
+
+    Records are written as soon as they are given, so they don't all have to be kept in memory. The file
+    isn't created until there is a record to write.
+
+    .. code-block:: text
+    
+        Metabolites example:
+        {"metabolite": "1,2,4-benzenetriol", "studies": {"ST000001": {"AN000001": ["LabF_115816", ...]}}}
+    
+        Metadata example:
+        {"analysis_id": "AN000001", "metadata": {"SUBJECT_TYPE": ["Human"]}, "study_id": "ST000001"}
+
+    :param str to_path: Path to output file, or "-" to write to stdout.
+    :param records: Iterable of JSON serializable records, such as from :func:`~mwtab.mwextract.metadata_records`.
+    :return: The number of records written.
+    :rtype: :py:class:`int`
+    """
+    outfile = None
+    count = 0
+    try:
+        for record in records:
+            if outfile is None:
+                if to_path == "-":
+                    outfile = sys.stdout
+                else:
+                    fileio._create_save_path(to_path)
+                    if not os.path.splitext(to_path)[1]:
+                        to_path += ".jsonl"
+                    outfile = open(to_path, "w")
+            outfile.write(json.dumps(record, sort_keys=True, cls=SetEncoder) + "\n")
+            count += 1
+    finally:
+        if outfile is not None and outfile is not sys.stdout:
+            outfile.close()
+    return count
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+mwtab.mwfeatures
+~~~~~~~~~~~~~~~~
+
+This module provides the :class:`~mwtab.mwfeatures.FeatureIndex` class, an in memory index of the
+m/z and retention time of the metabolites in the METABOLITES tables of a local collection of
+``mwTab`` files. It answers the same kind of question as the moverz context of the REST API,
+"which metabolites have an m/z within this tolerance", for many m/z values at once without a
+request for each one.
+"""
+
+from __future__ import annotations
+
+from . import fileio
+from .mwtab import MWTabFile
+from .mwindex import _print_read_error
+from .metadata_column_matching import column_finder_set
+from ._lazy import LazyModule
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
+
+
+class FeatureIndex:
+    """An index of the m/z and retention time of every metabolite in a collection of mwTab files.
+
+    The m/z and retention time columns of each METABOLITES table are found with the "moverz_quant"
+    and "retention_time" :data:`~mwtab.metadata_column_matching.column_finders`. If more than 1
+    column matches, the one with the most numbers is used. Rows whose m/z isn't a single number are
+    left out, and rows whose retention time isn't a single number have a retention time of NaN.
+    Retention times are stored as they are in the files, so they can be in minutes or seconds.
+
+    The m/z values are kept in a sorted NumPy array, so a query is 2 binary searches for each m/z,
+    and all of the m/z values in a query are searched at once.
+
+    Examples:
+        Basic usage.
+
+        >>> index = FeatureIndex()
+        >>> index.add_files('path/to/mwtab/files')
+        2
+        >>> index.query([180.0634, 132.0768], ppm=10, rt=[5.2, 1.1], rt_window=0.5)
+           query  query_mz         mz  ppm_error   rt  study_id analysis_id metabolite
+        0      0  180.0634  180.06339  -0.055536  5.1  ST000001    AN000001    Glucose
+        >>> index.save('features.npz')
+        >>> index = FeatureIndex.load('features.npz')
+
+    Attributes:
+        analyses: The (study ID, analysis ID) of each analysis with features in the index.
+        metabolites: The distinct metabolite names in the index.
+    """
+    def __init__(self):
+        self.analyses = []
+        self.metabolites = []
+        self._metabolite_codes = {}
+        self._mz = numpy.empty(0)
+        self._rt = numpy.empty(0)
+        self._analysis = numpy.empty(0, dtype=numpy.int32)
+        self._metabolite = numpy.empty(0, dtype=numpy.int32)
+        self._pending = []
+
+    def __len__(self):
+        self._compact()
+        return len(self._mz)
+
+    def add(self, mwtabfile: MWTabFile) -> int:
+        """Add the features in the METABOLITES table of mwtabfile to the index.
+
+        Args:
+            mwtabfile: The file to add.
+
+        Returns:
+            The number of features added.
+        """
+        df = mwtabfile.get_metabolites_as_pandas()
+        if df.empty or "Metabolite" not in df.columns:
+            return 0
+        mz = _numeric_column(df, "moverz_quant")
+        if mz is None:
+            return 0
+        rt = _numeric_column(df, "retention_time")
+        rt = numpy.full(len(df), numpy.nan) if rt is None else rt
+
+        mask = ~numpy.isnan(mz) & df["Metabolite"].notna().to_numpy()
+        if not mask.any():
+            return 0
+        codes = []
+        for name in df["Metabolite"][mask].astype(str).str.strip():
+            if name not in self._metabolite_codes:
+                self._metabolite_codes[name] = len(self.metabolites)
+                self.metabolites.append(name)
+            codes.append(self._metabolite_codes[name])
+        self.analyses.append((mwtabfile.study_id, mwtabfile.analysis_id))
+        self._pending.append((mz[mask], rt[mask], numpy.full(mask.sum(), len(self.analyses) - 1, dtype=numpy.int32),
+                              numpy.array(codes, dtype=numpy.int32)))
+        return int(mask.sum())
+
+    def add_files(self, sources: str|list[str], force: bool = False, verbose: bool = False) -> int:
+        """Add the features in the files from sources to the index.
+
+        Files that can't be read are reported and skipped.
+
+        Args:
+            sources: A path or list of paths to files, directories, archives, or URLs to read.
+            force: Ignore non-dictionary values in METABOLITES_DATA, METABOLITES, and EXTENDED tables for JSON files.
+            verbose: If True, print the files as they are added.
+
+        Returns:
+            The number of files that had features.
+        """
+        sources = [sources] if not isinstance(sources, list) else sources
+        count = 0
+        for mwtabfile, e in fileio.read_with_class(sources, MWTabFile, {'duplicate_keys': True, 'force': force}, return_exceptions=True):
+            if e is not None:
+                _print_read_error(mwtabfile, e)
+                continue
+            features = self.add(mwtabfile)
+            count += features > 0
+            if verbose:
+                print("Added {} features from file: {}".format(features, mwtabfile.source))
+        return count
+
+    def _compact(self):
+        """Merge the features added since the last query into the sorted arrays."""
+        if not self._pending:
+            return
+        mz, rt, analysis, metabolite = (numpy.concatenate([current] + [pending[i] for pending in self._pending])
+                                        for i, current in enumerate((self._mz, self._rt, self._analysis, self._metabolite)))
+        order = numpy.argsort(mz, kind="stable")
+        self._mz, self._rt, self._analysis, self._metabolite = mz[order], rt[order], analysis[order], metabolite[order]
+        self._pending = []
+
+    def query(self, mz, ppm: float = 10, rt=None, rt_window: float|None = None) -> pandas.DataFrame:
+        """Return the features within a tolerance of each m/z, and optionally a retention time window.
+
+        Args:
+            mz: An m/z value or array of m/z values to look up.
+            ppm: The tolerance in parts per million. A feature matches if its m/z is within mz * ppm / 1e6 of the query m/z.
+            rt: If given, a retention time or array of retention times, 1 for each m/z. Features only match if their
+              retention time is within rt_window of it, so features without a retention time don't match.
+            rt_window: The retention time tolerance, in the same units as the files. Required if rt is given.
+
+        Returns:
+            A DataFrame with a row for each match and the columns "query", the position of the m/z in mz,
+            "query_mz", "mz", "ppm_error", "rt", "study_id", "analysis_id", and "metabolite". Rows are ordered by
+            query and then m/z.
+
+        Raises:
+            ValueError: If rt is given without rt_window.
+        """
+        if rt is not None and rt_window is None:
+            raise ValueError("rt_window must be given to query by retention time.")
+        self._compact()
+        query_mz = numpy.atleast_1d(numpy.asarray(mz, dtype=float))
+        tolerance = query_mz * ppm * 1e-6
+        starts = numpy.searchsorted(self._mz, query_mz - tolerance, side="left")
+        ends = numpy.searchsorted(self._mz, query_mz + tolerance, side="right")
+
+        # Expand each query's [start, end) range of the sorted arrays without a Python loop.
+        counts = numpy.maximum(ends - starts, 0)
+        query_index = numpy.repeat(numpy.arange(len(query_mz)), counts)
+        feature_index = numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts) + numpy.arange(counts.sum())
+
+        if rt is not None:
+            query_rt = numpy.broadcast_to(numpy.asarray(rt, dtype=float), query_mz.shape)
+            with numpy.errstate(invalid="ignore"):
+                keep = numpy.abs(self._rt[feature_index] - query_rt[query_index]) <= rt_window
+            query_index, feature_index = query_index[keep], feature_index[keep]
+
+        analyses = numpy.array(self.analyses + [("", "")], dtype=object)
+        metabolites = numpy.array(self.metabolites + [""], dtype=object)
+        feature_mz = self._mz[feature_index]
+        return pandas.DataFrame({"query": query_index,
+                                 "query_mz": query_mz[query_index],
+                                 "mz": feature_mz,
+                                 "ppm_error": (feature_mz - query_mz[query_index]) / query_mz[query_index] * 1e6,
+                                 "rt": self._rt[feature_index],
+                                 "study_id": analyses[self._analysis[feature_index], 0],
+                                 "analysis_id": analyses[self._analysis[feature_index], 1],
+                                 "metabolite": metabolites[self._metabolite[feature_index]]})
+
+    def save(self, path: str):
+        """Save the index to a NumPy .npz file.
+
+        Args:
+            path: The path to save to. NumPy adds ".npz" if it doesn't end with it.
+        """
+        self._compact()
+        numpy.savez_compressed(path, mz=self._mz, rt=self._rt, analysis=self._analysis, metabolite=self._metabolite,
+                               analyses=numpy.array(self.analyses, dtype=str).reshape(-1, 2),
+                               metabolites=numpy.array(self.metabolites, dtype=str))
+
+    @classmethod
+    def load(cls, path: str) -> 'FeatureIndex':
+        """Load an index saved with :meth:`save`.
+
+        Args:
+            path: The path to the .npz file.
+
+        Returns:
+            The loaded index.
+        """
+        index = cls()
+        with numpy.load(path, allow_pickle=False) as saved:
+            index._mz, index._rt = saved["mz"], saved["rt"]
+            index._analysis, index._metabolite = saved["analysis"], saved["metabolite"]
+            index.analyses = [tuple(analysis) for analysis in saved["analyses"].tolist()]
+            index.metabolites = saved["metabolites"].tolist()
+        index._metabolite_codes = {name: code for code, name in enumerate(index.metabolites)}
+        return index
+
+
+def _numeric_column(df: pandas.DataFrame, standard_name: str) -> numpy.ndarray|None:
+    """Return the values of the column in df that matches standard_name as floats, with NaN for values that aren't numbers.
+
+    If more than 1 column matches, the one with the most numbers is used. None if no column matches.
+    """
+    columns = {column: column.lower().strip() for column in df.columns}
+    best = None
+    for column in column_finder_set.dict_match(columns).get(standard_name, []):
+        values = pandas.to_numeric(df[column].astype("string").str.strip(), errors="coerce").to_numpy(dtype=float, na_value=numpy.nan)
+        if best is None or numpy.count_nonzero(~numpy.isnan(values)) > numpy.count_nonzero(~numpy.isnan(best)):
+            best = values
+    return best
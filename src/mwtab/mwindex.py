@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+mwtab.mwindex
+~~~~~~~~~~~~~
+
+This module provides the :class:`~mwtab.mwindex.MWTabIndex` class, an on-disk SQLite index of a local
+collection of ``mwTab`` formatted files. The index is built once from the files and can then answer
+questions like "which studies, analyses, and samples have metabolite X", "what values does
+SUBJECT:SUBJECT_TYPE have", "which metabolites have InChIKey Y", or "which samples have
+Treatment:Control and Tissue:Plasma" without reading the files again.
+"""
+
+import os
+import re
+import json
+import sqlite3
+import sys
+import traceback
+
+from . import fileio
+from .mwtab import MWTabFile
+from .mwextract import _metabolite_samples, ItemMatcher
+from .metadata_column_matching import column_finder_set
+
+
+#: Changed when the tables in the index change, so older indexes are rebuilt.
+INDEX_VERSION = 5
+
+
+def _normalize_hmdb_id(value: str) -> list[str]:
+    """Return the HMDB IDs in value, with the number padded to 7 digits like current HMDB IDs."""
+    value = value.strip()
+    numbers = [match.group(1) for match in re.finditer(r"HMDB(\d+)", value, re.IGNORECASE)]
+    if not numbers and value.isdigit():
+        numbers = [value]
+    return ["HMDB" + number.zfill(7) for number in numbers]
+
+
+def _numbers_with_prefix(prefix: str):
+    """Return a function that returns the numbers in a value that are on their own or after prefix, like "CID5793".
+
+    Digits that are part of another ID, like the 122 in HMDB0000122 or the 31 in C00031, or a decimal, aren't returned.
+    """
+    pattern = re.compile(r"(?<![A-Za-z0-9.\-])(?:" + prefix + r"[:\s]*)?(\d+)(?![A-Za-z0-9.\-])", re.IGNORECASE)
+    return lambda value: [str(int(match)) for match in pattern.findall(value)]
+
+
+#: The METABOLITES table columns that are indexed as identifiers, by their standard name in
+#: :data:`~mwtab.metadata_column_matching.column_finders`, and a function that returns the 
+#: normalized identifiers in a value. A value can have more than 1 identifier, like "C00031/C00221".
+IDENTIFIER_TYPES = {
+    "inchi_key": lambda value: [match.upper() for match in re.findall(r"\b[A-Za-z]{14}-[A-Za-z]{10}-[A-Za-z]\b", value)],
+    "kegg_id": lambda value: [match.upper() for match in re.findall(r"(?<![A-Za-z0-9])[CDGcdg]\d{5}(?!\d)", value)],
+    "hmdb_id": _normalize_hmdb_id,
+    "pubchem_id": _numbers_with_prefix("CID"),
+    "chebi_id": _numbers_with_prefix("CHEBI"),
+    "lm_id": lambda value: [match.upper() for match in re.findall(r"\bLM[A-Za-z]{2}[0-9A-Za-z]{8,10}\b", value)],
+}
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS metabolites (metabolite TEXT, study_id TEXT, analysis_id TEXT, samples TEXT, path TEXT);
+CREATE INDEX IF NOT EXISTS metabolites_metabolite ON metabolites (metabolite);
+CREATE INDEX IF NOT EXISTS metabolites_metabolite_nocase ON metabolites (metabolite COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS metabolites_path ON metabolites (path);
+CREATE TABLE IF NOT EXISTS metadata (item TEXT, section TEXT, key TEXT, value TEXT, study_id TEXT, analysis_id TEXT, path TEXT);
+CREATE INDEX IF NOT EXISTS metadata_item ON metadata (item);
+CREATE INDEX IF NOT EXISTS metadata_key ON metadata (key);
+CREATE INDEX IF NOT EXISTS metadata_path ON metadata (path);
+CREATE TABLE IF NOT EXISTS identifiers (id_type TEXT, identifier TEXT, metabolite TEXT, row INTEGER, study_id TEXT, analysis_id TEXT, path TEXT);
+CREATE INDEX IF NOT EXISTS identifiers_identifier ON identifiers (identifier, id_type);
+CREATE INDEX IF NOT EXISTS identifiers_analysis_id ON identifiers (analysis_id);
+CREATE INDEX IF NOT EXISTS identifiers_path ON identifiers (path);
+CREATE TABLE IF NOT EXISTS sample_factors (factor TEXT, value TEXT, study_id TEXT, analysis_id TEXT, sample_id TEXT, path TEXT);
+CREATE INDEX IF NOT EXISTS sample_factors_factor_value ON sample_factors (factor, value);
+CREATE INDEX IF NOT EXISTS sample_factors_factor_value_nocase ON sample_factors (factor COLLATE NOCASE, value COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS sample_factors_path ON sample_factors (path);
+"""
+
+#: The tables in _SCHEMA with rows from the indexed files, all of which have a path column.
+_FILE_TABLES = ("files", "metabolites", "metadata", "identifiers", "sample_factors")
+
+
+class MWTabIndex:
+    """An on-disk index of the metabolites and metadata in a collection of mwTab files.
+
+    The index is stored in a SQLite database. For each metabolite it stores the studies, analyses,
+    and samples that have a value greater than the threshold for that metabolite, the same as
+    :func:`~mwtab.mwextract.extract_metabolites`. For metadata it stores every key and value in the
+    sections of the files, such as SUBJECT:SUBJECT_TYPE, except for SUBJECT_SAMPLE_FACTORS and the
+    data sections. For identifiers it stores the database IDs in the METABOLITES table columns found
+    for the :data:`~mwtab.mwindex.IDENTIFIER_TYPES`, normalized so the same ID written differently
+    in different files matches, such as HMDB00001 and HMDB0000001. For samples it stores every factor
+    and additional sample data item in SUBJECT_SAMPLE_FACTORS, so samples can be found with boolean
+    queries of factors by :meth:`query_samples`. Updating the index only reads files that are new or 
+    have changed since the last update, and removes files that no longer exist.
+
+    Parameters:
+        path: The path to the SQLite database file. It is created if it doesn't exist.
+        threshold: Values must be greater than this for a sample to be included. If the index was
+          built with a different threshold, every file is read again on the next update. If None, 
+          the threshold the index was built with is used, or 0 for a new index.
+
+    Examples:
+        Basic usage.
+
+        >>> index = MWTabIndex('mwtab_index.sqlite')
+        >>> index.update('path/to/mwtab/files')
+        {'indexed': 2, 'unchanged': 0, 'removed': 0}
+        >>> index.query_metabolites(['Glucose'])
+        {'Glucose': {'ST000001': {'AN000001': {'sample1', 'sample2'}}}}
+        >>> index.query_metadata(['SU:SUBJECT_TYPE'])
+        {'SUBJECT:SUBJECT_TYPE': {'Human', 'Plant'}}
+        >>> index.query_identifiers(['hmdb00122'])
+        {'hmdb00122': [{'id_type': 'hmdb_id', 'identifier': 'HMDB0000122', 'study_id': 'ST000001', 'analysis_id': 'AN000001', 'metabolite': 'Glucose', 'row': 3}]}
+        >>> index.query_samples('Treatment:Control AND (Tissue:Plasma OR Tissue:Serum)')
+        {'ST000001': {'AN000001': {'sample1'}}}
+        >>> index.close()
+
+    Attributes:
+        path: The path to the SQLite database file.
+        threshold: Values must be greater than this for a sample to be included.
+        connection: The sqlite3 connection to the database.
+    """
+    def __init__(self, path: str, threshold: float|None = None):
+        self.path = path
+        fileio._create_save_path(os.path.dirname(os.path.abspath(path)))
+        self.connection = sqlite3.connect(path)
+        self.connection.create_function("REGEXP", 2, _regexp, deterministic=True)
+        self.connection.executescript(_SCHEMA)
+        stored_properties = dict(self.connection.execute("SELECT * FROM properties"))
+        if threshold is None:
+            threshold = float(stored_properties.get('threshold', 0))
+        self.threshold = threshold
+
+        # Every file has to be read again if the index was made differently. Everything from the files is
+        # dropped, not just the list of files, so files that are gone before the next update don't leave
+        # rows behind, and the tables are made again in case the version changed them.
+        properties = {'threshold': str(float(threshold)), 'version': str(INDEX_VERSION)}
+        if stored_properties != properties:
+            self.connection.executescript("BEGIN;" +
+                                          "".join("DROP TABLE {};".format(table) for table in _FILE_TABLES) +
+                                          "DELETE FROM properties;" + 
+                                          "".join("INSERT INTO properties VALUES ('{}', '{}');".format(*item) for item in properties.items()) +
+                                          _SCHEMA + "COMMIT;")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """Close the connection to the database."""
+        self.connection.close()
+
+    def update(self, sources: str|list[str], force: bool = False, verbose: bool = False) -> dict[str, int]:
+        """Add new and changed files from sources to the index and remove files that no longer exist.
+
+        Files are identified by their path, and a file is considered changed if its size or
+        modification time has changed. Sources that aren't local files, like URLs, are always read.
+        Files that can't be read are reported and left out of the index.
+
+        Args:
+            sources: A path or list of paths to files, directories, or archives to index.
+            force: Ignore non-dictionary values in METABOLITES_DATA, METABOLITES, and EXTENDED tables for JSON files.
+            verbose: If True, print the files as they are indexed.
+
+        Returns:
+            A dictionary with the number of files "indexed", "unchanged", and "removed".
+        """
+        sources = [sources] if not isinstance(sources, list) else sources
+        indexed_files = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute("SELECT * FROM files")}
+        counts = {'indexed': 0, 'unchanged': 0, 'removed': 0}
+
+        for path, e in fileio._generate_filenames(sources, True):
+            if e is not None:
+                _print_read_error(path, e)
+                continue
+
+            file_stat = (os.stat(path).st_size, os.stat(path).st_mtime_ns) if os.path.isfile(path) else None
+            if file_stat is not None and indexed_files.get(path) == file_stat:
+                counts['unchanged'] += 1
+                continue
+
+            metabolite_rows = []
+            metadata_rows = []
+            identifier_rows = []
+            sample_factor_rows = []
+            for mwtabfile, e in fileio.read_with_class(path, MWTabFile, {'duplicate_keys': True, 'force': force}, return_exceptions=True):
+                if e is not None:
+                    _print_read_error(mwtabfile, e)
+                    continue
+                metabolite_rows.extend(self._metabolite_rows(mwtabfile, path))
+                metadata_rows.extend(self._metadata_rows(mwtabfile, path))
+                identifier_rows.extend(self._identifier_rows(mwtabfile, path))
+                sample_factor_rows.extend(self._sample_factor_rows(mwtabfile, path))
+
+            with self.connection:
+                self._remove_path(path)
+                self.connection.executemany("INSERT INTO metabolites VALUES (?, ?, ?, ?, ?)", metabolite_rows)
+                self.connection.executemany("INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)", metadata_rows)
+                self.connection.executemany("INSERT INTO identifiers VALUES (?, ?, ?, ?, ?, ?, ?)", identifier_rows)
+                self.connection.executemany("INSERT INTO sample_factors VALUES (?, ?, ?, ?, ?, ?)", sample_factor_rows)
+                if file_stat is not None:
+                    self.connection.execute("INSERT INTO files VALUES (?, ?, ?)", (path, *file_stat))
+            counts['indexed'] += 1
+            if verbose:
+                print("Indexed file: {}".format(path))
+
+        with self.connection:
+            for path in indexed_files:
+                if not os.path.exists(path):
+                    self._remove_path(path)
+                    counts['removed'] += 1
+        return counts
+
+    def _metabolite_rows(self, mwtabfile: MWTabFile, path: str) -> list[tuple]:
+        """Return the rows to insert into the metabolites table for the file read from path."""
+        return [(metabolite, mwtabfile.study_id, mwtabfile.analysis_id, json.dumps(samples), path)
+                for metabolite, samples in _metabolite_samples(mwtabfile, self.threshold)]
+
+    def _metadata_rows(self, mwtabfile: MWTabFile, path: str) -> list[tuple]:
+        """Return the rows to insert into the metadata table for the file read from path."""
+        rows = []
+        for section, section_value in mwtabfile.items():
+            if section in MWTabFile.data_section_keys or not isinstance(section_value, dict):
+                continue
+            for key, value in section_value.items():
+                # Things like RESULTS_FILE are dictionaries, so they are saved as JSON.
+                value = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+                rows.append((section + ":" + key, section, key, value, mwtabfile.study_id, mwtabfile.analysis_id, path))
+        return rows
+
+    def _identifier_rows(self, mwtabfile: MWTabFile, path: str) -> list[tuple]:
+        """Return the rows to insert into the identifiers table for the file read from path."""
+        df = mwtabfile.get_metabolites_as_pandas()
+        if df.empty or "Metabolite" not in df.columns:
+            return []
+        columns = {column: column.lower().strip() for column in df.columns}
+        rows = []
+        for id_type, matched_columns in column_finder_set.dict_match(columns).items():
+            if id_type not in IDENTIFIER_TYPES:
+                continue
+            normalize = IDENTIFIER_TYPES[id_type]
+            for column in matched_columns:
+                for row, (metabolite, value) in enumerate(zip(df["Metabolite"], df[column])):
+                    # JSON files can have numbers for IDs like PubChem CIDs, and missing values are NaN.
+                    # pandas can make a column of numbers floats, so 5793 is 5793.0.
+                    if not isinstance(value, str):
+                        if value is None or value != value:
+                            continue
+                        if isinstance(value, float) and value.is_integer():
+                            value = int(value)
+                        value = str(value)
+                    for identifier in dict.fromkeys(normalize(value)):
+                        rows.append((id_type, identifier, metabolite, row, mwtabfile.study_id, mwtabfile.analysis_id, path))
+        return rows
+
+    def _sample_factor_rows(self, mwtabfile: MWTabFile, path: str) -> list[tuple]:
+        """Return the rows to insert into the sample_factors table for the file read from path."""
+        if "SUBJECT_SAMPLE_FACTORS" not in mwtabfile:
+            return []
+        rows = []
+        for subject_sample_factors in mwtabfile["SUBJECT_SAMPLE_FACTORS"]:
+            if "Sample ID" not in subject_sample_factors:
+                continue
+            sample_id = subject_sample_factors["Sample ID"]
+            for group in ("Factors", "Additional sample data"):
+                if group not in subject_sample_factors or not isinstance(subject_sample_factors[group], dict):
+                    continue
+                # Factors are DuplicatesDicts, whose items() gives repeated factors under their original name.
+                for factor, value in subject_sample_factors[group].items():
+                    value = value if isinstance(value, str) else json.dumps(value)
+                    rows.append((factor.strip(), value.strip(), mwtabfile.study_id, mwtabfile.analysis_id, sample_id, path))
+        return rows
+
+    def _remove_path(self, path: str):
+        """Remove everything indexed from path."""
+        for table in _FILE_TABLES:
+            self.connection.execute("DELETE FROM {} WHERE path = ?".format(table), (path,))
+
+    def query_metabolites(self, metabolites: list[str], ignore_case: bool = False) -> dict[str, dict[str, dict[str, set[str]]]]:
+        """Return the studies, analyses, and samples that have the given metabolites.
+
+        Args:
+            metabolites: The names of the metabolites to look up.
+            ignore_case: If True, match metabolite names without regard to case.
+
+        Returns:
+            A dictionary in the same form as :func:`~mwtab.mwextract.extract_metabolites`, with only the metabolites
+            that were found. With ignore_case, the names are the ones found in the files.
+        """
+        collation = " COLLATE NOCASE" if ignore_case else ""
+        results = {}
+        for metabolite in metabolites:
+            rows = self.connection.execute("SELECT metabolite, study_id, analysis_id, samples FROM metabolites "
+                                           "WHERE metabolite = ?" + collation, (metabolite,))
+            for name, study_id, analysis_id, samples in rows:
+                results.setdefault(name, dict())\
+                    .setdefault(study_id, dict())\
+                    .setdefault(analysis_id, set())\
+                    .update(json.loads(samples))
+        return results
+
+
+    def query_metadata(self, items: list[str], match: str = 'exact') -> dict[str, set[str]]:
+        """Return the values of the given metadata items.
+
+        Items are written as "SECTION:KEY", such as "SUBJECT:SUBJECT_TYPE". The 2 letter section
+        abbreviations used by :class:`~mwtab.mwextract.ItemMatcher` can also be used, such as
+        "SU:SUBJECT_TYPE". For "exact" and "prefix" matching, an item without a section, such as
+        "SUBJECT_TYPE", is matched against the key in every section, like
+        :func:`~mwtab.mwextract.extract_metadata`.
+
+        Args:
+            items: The metadata items to look up.
+            match: How to match the items. "exact" matches the whole item, "prefix" matches items that
+              start with the given item, and "regex" matches items that the given regular expression
+              matches anywhere in "SECTION:KEY".
+
+        Returns:
+            A dictionary of the matched items to the set of values found for them. The matched items are 
+            "SECTION:KEY" if the given item had a section or was a regular expression, and just the key otherwise.
+
+        Raises:
+            ValueError: If match is not one of "exact", "prefix", or "regex".
+        """
+        if match not in ('exact', 'prefix', 'regex'):
+            raise ValueError('Unknown metadata match, "' + match + '". It must be one of "exact", "prefix", or "regex".')
+
+        results = {}
+        for item in items:
+            if match == 'regex':
+                column, condition, parameters = 'item', 'item REGEXP ?', (item,)
+            else:
+                if ':' in item:
+                    section, key = item.split(':', 1)
+                    item = ItemMatcher.section_conversion.get(section, section) + ':' + key
+                    column = 'item'
+                else:
+                    column = 'key'
+                if match == 'exact':
+                    condition, parameters = column + ' = ?', (item,)
+                else:
+                    # A range can use the table index, unlike LIKE, which also ignores case.
+                    condition, parameters = column + ' >= ? AND ' + column + ' < ?', (item, item + '\U0010ffff')
+
+            rows = self.connection.execute("SELECT DISTINCT " + column + ", value FROM metadata WHERE " + condition, parameters)
+            for name, value in rows:
+                results.setdefault(name, set()).add(value)
+        return results
+
+    def query_identifiers(self, identifiers: list[str], id_type: str|None = None) -> dict[str, list[dict]]:
+        """Return the metabolites in every file that have the given database identifiers.
+
+        The identifiers are normalized the same way as when they were indexed, so "hmdb00122" finds
+        "HMDB0000122". Without id_type, an identifier is looked up as every type it could be, so a 
+        number can match both PubChem and ChEBI IDs. Only a number on its own, or after "CID" or "CHEBI:", is
+        a PubChem or ChEBI ID, so "HMDB0000122" isn't also looked up as PubChem CID 122.
+
+        Args:
+            identifiers: The identifiers to look up.
+            id_type: If given, only look up identifiers of this type, one of the keys of :data:`~mwtab.mwindex.IDENTIFIER_TYPES`.
+
+        Returns:
+            A dictionary of the given identifiers that were found to a list of matches. Each match is a 
+            dictionary with the "id_type", normalized "identifier", "study_id", "analysis_id", "metabolite",
+            and "row", the position of the metabolite in the METABOLITES table starting from 0.
+
+        Raises:
+            ValueError: If id_type is not one of the keys of IDENTIFIER_TYPES.
+        """
+        if id_type is not None and id_type not in IDENTIFIER_TYPES:
+            raise ValueError('Unknown identifier type, "' + id_type + '". It must be one of ' + 
+                             ', '.join('"' + name + '"' for name in IDENTIFIER_TYPES) + '.')
+        id_types = [id_type] if id_type else list(IDENTIFIER_TYPES)
+        results = {}
+        for identifier in identifiers:
+            for current_type in id_types:
+                for normalized in IDENTIFIER_TYPES[current_type](identifier):
+                    rows = self.connection.execute("SELECT id_type, identifier, study_id, analysis_id, metabolite, row FROM identifiers "
+                                                   "WHERE identifier = ? AND id_type = ? ORDER BY study_id, analysis_id, row", 
+                                                   (normalized, current_type))
+                    for row in rows:
+                        results.setdefault(identifier, []).append(dict(zip(("id_type", "identifier", "study_id", 
+                                                                            "analysis_id", "metabolite", "row"), row)))
+        return results
+
+    def shared_identifiers(self, analysis_id: str, id_type: str|None = None) -> dict[str, set[str]]:
+        """Return the other analyses that have metabolites with the same identifiers as analysis_id.
+
+        Args:
+            analysis_id: The analysis to compare the others to.
+            id_type: If given, only compare identifiers of this type.
+
+        Returns:
+            A dictionary of the other analysis IDs to the set of identifiers they share with analysis_id.
+        """
+        condition, parameters = "", (analysis_id, analysis_id)
+        if id_type:
+            condition, parameters = " AND given.id_type = ?", (analysis_id, analysis_id, id_type)
+        rows = self.connection.execute("SELECT DISTINCT other.analysis_id, other.identifier FROM identifiers AS given "
+                                       "JOIN identifiers AS other ON other.identifier = given.identifier AND other.id_type = given.id_type "
+                                       "WHERE given.analysis_id = ? AND other.analysis_id != ?" + condition, parameters)
+        results = {}
+        for other_analysis_id, identifier in rows:
+            results.setdefault(other_analysis_id, set()).add(identifier)
+        return results
+
+    def query_samples(self, query: str, ignore_case: bool = False) -> dict[str, dict[str, set[str]]]:
+        """Return the samples whose factors match a boolean query.
+
+        A query is made of terms written as "FACTOR:VALUE", such as "Treatment:Control", which match samples
+        with that value for that factor in their Factors or Additional sample data in SUBJECT_SAMPLE_FACTORS.
+        A VALUE of "*" matches samples with any value for the factor. Factors and values with spaces, 
+        parentheses, or quotes in them are put in double quotes, like 'Treatment:"High fat diet"'. Terms are 
+        combined with AND, OR, and NOT, and grouped with parentheses. Terms next to each other without an 
+        operator are combined with AND, and NOT comes before AND, which comes before OR. NOT matches every 
+        indexed sample that doesn't match, and samples without any factors are never matched.
+
+        Args:
+            query: The query, such as "Treatment:Control AND (Tissue:Plasma OR Tissue:Serum) AND NOT Sex:Male".
+            ignore_case: If True, match factors and values without regard to case.
+
+        Returns:
+            A dictionary of study IDs to analysis IDs to the set of matching sample IDs, in order of study and analysis ID.
+
+        Raises:
+            ValueError: If the query can't be parsed.
+        """
+        collation = " COLLATE NOCASE" if ignore_case else ""
+
+        def postings(factor, value):
+            if value == "*":
+                rows = self.connection.execute("SELECT study_id, analysis_id, sample_id FROM sample_factors "
+                                               "WHERE factor = ?" + collation, (factor,))
+            else:
+                rows = self.connection.execute("SELECT study_id, analysis_id, sample_id FROM sample_factors "
+                                               "WHERE factor = ?" + collation + " AND value = ?" + collation, (factor, value))
+            return set(rows)
+
+        def every_sample():
+            return set(self.connection.execute("SELECT DISTINCT study_id, analysis_id, sample_id FROM sample_factors"))
+
+        results = {}
+        for study_id, analysis_id, sample_id in sorted(_SampleQuery(query).evaluate(postings, every_sample)):
+            results.setdefault(study_id, dict()).setdefault(analysis_id, set()).add(sample_id)
+        return results
+
+    def sample_factors(self, factors: list[str]|None = None, ignore_case: bool = False) -> dict[str, dict[str, int]]:
+        """Return the values of sample factors in the index and how many samples have each one.
+
+        Args:
+            factors: The factors to look up. If None, every factor is returned.
+            ignore_case: If True, match the given factors without regard to case.
+
+        Returns:
+            A dictionary of factors to dictionaries of their values to the number of samples with that value.
+        """
+        # The same sample can be in more than 1 file, such as the txt and JSON files of an analysis, so count distinct samples.
+        condition, parameters = "", ()
+        if factors is not None:
+            collation = " COLLATE NOCASE" if ignore_case else ""
+            condition, parameters = " WHERE factor" + collation + " IN (" + ", ".join("?" * len(factors)) + ")", factors
+        rows = self.connection.execute("SELECT factor, value, COUNT(*) FROM (SELECT DISTINCT factor, value, study_id, analysis_id, sample_id "
+                                       "FROM sample_factors" + condition + ") GROUP BY factor, value", parameters)
+        results = {}
+        for factor, value, count in rows:
+            results.setdefault(factor, dict())[value] = count
+        return results
+
+
+class _SampleQuery:
+    """A parsed boolean query of sample factors for :meth:`MWTabIndex.query_samples`."""
+    _token_regex = re.compile(r'\s*(?:(?P<term>(?P<factor>"[^"]*"|[^\s():"]+)\s*:\s*(?P<value>"[^"]*"|[^\s()"]+))'
+                              r'|(?P<operator>AND|OR|NOT)(?![^\s()])|(?P<parenthesis>[()]))')
+
+    def __init__(self, query: str):
+        self.query = query
+        self.tokens = []
+        position = 0
+        query = query.rstrip()
+        while position < len(query):
+            match = self._token_regex.match(query, position)
+            if match is None:
+                raise ValueError('Could not parse the sample query, "' + self.query + '", at "' + query[position:].strip() + '". '
+                                 'Terms must be written as FACTOR:VALUE.')
+            if match.group("term"):
+                self.tokens.append(("term", match.group("factor").strip('"'), match.group("value").strip('"')))
+            else:
+                self.tokens.append((match.group("operator") or match.group("parenthesis"),))
+            position = match.end()
+        if not self.tokens:
+            raise ValueError("The sample query is empty.")
+
+    def evaluate(self, postings, every_sample) -> set[tuple]:
+        """Evaluate the query, getting the set of samples for each term from postings(factor, value) and every sample from every_sample()."""
+        self._position = 0
+        self._postings = postings
+        self._every_sample = every_sample
+        self._all = None
+        result = self._or()
+        if self._position < len(self.tokens):
+            raise ValueError('Unexpected "' + _token_text(self.tokens[self._position]) + '" in the sample query, "' + self.query + '".')
+        return result
+
+    def _peek(self):
+        return self.tokens[self._position][0] if self._position < len(self.tokens) else None
+
+    def _or(self):
+        result = self._and()
+        while self._peek() == "OR":
+            self._position += 1
+            result = result | self._and()
+        return result
+
+    def _and(self):
+        result = self._not()
+        while self._peek() in ("AND", "NOT", "term", "("):
+            if self._peek() == "AND":
+                self._position += 1
+            result = result & self._not()
+        return result
+
+    def _not(self):
+        if self._peek() == "NOT":
+            self._position += 1
+            if self._all is None:
+                self._all = self._every_sample()
+            return self._all - self._not()
+        return self._atom()
+
+    def _atom(self):
+        token = self.tokens[self._position] if self._position < len(self.tokens) else None
+        if token is None:
+            raise ValueError('The sample query, "' + self.query + '", ended unexpectedly.')
+        self._position += 1
+        if token[0] == "term":
+            return self._postings(token[1], token[2])
+        if token[0] == "(":
+            result = self._or()
+            if self._peek() != ")":
+                raise ValueError('Missing ")" in the sample query, "' + self.query + '".')
+            self._position += 1
+            return result
+        raise ValueError('Unexpected "' + _token_text(token) + '" in the sample query, "' + self.query + '".')
+
+
+def _token_text(token: tuple) -> str:
+    """Return a token of a sample query as it was written, for error messages."""
+    return token[1] + ":" + token[2] if token[0] == "term" else token[0]
+
+
+def _regexp(pattern, string):
+    """The REGEXP function for SQLite, Python's re.search."""
+    return string is not None and re.search(pattern, string) is not None
+
+
+def _print_read_error(source, e):
+    """Print an error for a file that couldn't be read, the same way as extraction does."""
+    file_source = source if isinstance(source, str) else "from the given input."
+    print("Something went wrong when trying to read " + file_source)
+    traceback.print_exception(e, file=sys.stdout)
+    print()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+mwtab.mwmirror
+~~~~~~~~~~~~~~
+
+This module provides the :class:`~mwtab.mwmirror.MWTabMirror` class, which keeps a local directory
+of every analysis in the Metabolomics Workbench up to date. A manifest in the directory records what
+was downloaded, so each sync only downloads analyses that are new, have changed in the Workbench's
+listing, or are missing or different on disk.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from . import fileio
+from . import mwrest
+
+
+#: The name of the manifest file in the mirror directory.
+MANIFEST_NAME = "manifest.json"
+
+#: The file extension for each output format.
+_EXTENSIONS = {"txt": ".txt", "json": ".json"}
+
+
+class MWTabMirror:
+    """A local mirror of the mwTab files of every analysis in the Metabolomics Workbench.
+
+    Files are saved as STUDYID_ANALYSISID.txt (or .json) in the directory, and the manifest, manifest.json,
+    has an entry for each downloaded analysis with its study ID, file name, size, SHA-256 hash, the time it
+    was fetched, and a hash of the analysis's record in the Workbench's listing of analyses. An analysis
+    is downloaded again if its listing record changes, its file is missing or a different size, or it was
+    fetched longer ago than refresh_after. Files and the manifest are written to a temporary file first and
+    then renamed, so an interrupted sync never leaves a partial file, and the next sync picks up where it
+    stopped.
+
+    Parameters:
+        directory: The directory to keep the files and manifest in. It is created if it doesn't exist.
+        output_format: The format to download the files in, "txt" or "json".
+        base_url: The base URL of the Metabolomics Workbench REST API.
+
+    Examples:
+        Basic usage.
+
+        >>> mirror = MWTabMirror('mwtab_mirror')
+        >>> mirror.sync(workers=4, rate=2)
+        {'downloaded': 10, 'unchanged': 0, 'failed': 0, 'unlisted': 0}
+        >>> mirror.sync(workers=4, rate=2)
+        {'downloaded': 0, 'unchanged': 10, 'failed': 0, 'unlisted': 0}
+
+    Attributes:
+        directory: The directory the files and manifest are kept in.
+        output_format: The format the files are downloaded in.
+        base_url: The base URL of the Metabolomics Workbench REST API.
+        manifest: A dictionary of analysis IDs to their manifest entries.
+    """
+    def __init__(self, directory: str, output_format: str = "txt", base_url: str = mwrest.BASE_URL):
+        if output_format not in _EXTENSIONS:
+            raise ValueError('Unknown output format, "' + output_format + '". It must be "txt" or "json".')
+        self.directory = directory
+        self.output_format = output_format
+        self.base_url = base_url
+        fileio._create_save_path(directory)
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as fh:
+                self.manifest = json.load(fh)
+        else:
+            self.manifest = {}
+        self._lock = threading.Lock()
+
+    def plan(self, records: dict, refresh_after: float|None = None) -> tuple[list[dict], list[str], list[str]]:
+        """Compare the listing of analyses to the manifest and files on disk.
+
+        Args:
+            records: The analysis records from the Metabolomics Workbench listing, such as from
+              :func:`~mwtab.mwrest._pull_analysis_records`.
+            refresh_after: If given, analyses fetched more than this many days ago are downloaded again.
+
+        Returns:
+            A tuple of the records to download, the IDs of the analyses that are up to date, and the IDs of
+            the analyses in the manifest that are no longer listed.
+        """
+        refresh_before = None
+        if refresh_after is not None:
+            refresh_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=refresh_after)
+
+        to_download = []
+        unchanged = []
+        listed = set()
+        for record in records.values():
+            analysis_id = record["analysis_id"]
+            listed.add(analysis_id)
+            entry = self.manifest.get(analysis_id)
+            if entry is not None and self._is_current(entry, record, refresh_before):
+                unchanged.append(analysis_id)
+            else:
+                to_download.append(record)
+        unlisted = [analysis_id for analysis_id in self.manifest if analysis_id not in listed]
+        return to_download, unchanged, unlisted
+
+    def _is_current(self, entry: dict, record: dict, refresh_before: datetime.datetime|None) -> bool:
+        """Return True if the file for entry doesn't need to be downloaded again."""
+        path = os.path.join(self.directory, entry["file"])
+        return (entry["listing_hash"] == _record_hash(record)
+                and os.path.splitext(entry["file"])[1] == _EXTENSIONS[self.output_format]
+                and os.path.isfile(path)
+                and os.path.getsize(path) == entry["size"]
+                and (refresh_before is None or datetime.datetime.fromisoformat(entry["fetched_at"]) >= refresh_before))
+
+    def sync(self, workers: int = 1, rate: float = mwrest.DEFAULT_RATE, burst: int = 1, retries: int = 3,
+             refresh_after: float|None = None, verbose: bool = False) -> dict[str, int]:
+        """Download the analyses that are new or changed since the last sync.
+
+        Analyses are downloaded concurrently, limited to an average of rate requests per second, and
+        downloads that fail with a transient error are tried again, the same as
+        :func:`~mwtab.cli.download_and_save_ID_list`. Analyses that can't be downloaded are reported and
+        tried again on the next sync. Analyses that are no longer listed are left alone.
+
+        Args:
+            workers: The number of analyses to download at the same time.
+            rate: The average number of requests per second, including retries.
+            burst: The number of requests that can be made at once.
+            retries: The number of times to try a download again after a transient error.
+            refresh_after: If given, analyses fetched more than this many days ago are downloaded again.
+            verbose: If True, print each analysis as it is downloaded.
+
+        Returns:
+            A dictionary with the number of analyses "downloaded", "unchanged", "failed", and "unlisted".
+        """
+        records = mwrest._pull_analysis_records(self.base_url)
+        to_download, unchanged, unlisted = self.plan(records, refresh_after)
+        if verbose:
+            print("Found {} analyses, {} to download.".format(len(records), len(to_download)))
+
+        limiter = mwrest.TokenBucket(rate, burst)
+        counts = {"downloaded": 0, "unchanged": len(unchanged), "failed": 0, "unlisted": len(unlisted)}
+
+        def download_record(count, record):
+            if verbose:
+                with self._lock:
+                    print("[{:4}/{:4}]".format(count+1, len(to_download)), record["analysis_id"], datetime.datetime.now())
+            try:
+                entry = mwrest.call_with_retries(self._download, record, retries=retries, limiter=limiter)
+            except Exception:
+                with self._lock:
+                    counts["failed"] += 1
+                    print("Something went wrong and " + record["analysis_id"] + " could not be downloaded.")
+                    traceback.print_exc(file=sys.stdout)
+                    print()
+                return
+            with self._lock:
+                self.manifest[record["analysis_id"]] = entry
+                counts["downloaded"] += 1
+                # Save the progress regularly, so an interrupted sync doesn't download everything again.
+                if counts["downloaded"] % 100 == 0:
+                    self.save_manifest()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for count, record in enumerate(to_download):
+                    executor.submit(download_record, count, record)
+        finally:
+            with self._lock:
+                self.save_manifest()
+        return counts
+
+    def _download(self, record: dict) -> dict:
+        """Download the file for an analysis record, save it, and return its manifest entry."""
+        url = mwrest.GenericMWURL({"context": "study",
+                                   "input_item": "analysis_id",
+                                   "input_value": record["analysis_id"],
+                                   "output_item": "mwtab",
+                                   "output_format": self.output_format}, self.base_url).url
+        file_name = "{}_{}{}".format(record["study_id"], record["analysis_id"], _EXTENSIONS[self.output_format])
+        downloaded = mwrest.download_to_file(url, os.path.join(self.directory, file_name))
+        if downloaded is None:
+            raise ValueError("A blank file or an error was returned for " + record["analysis_id"] + ".")
+        size, sha256 = downloaded
+        return {"study_id": record["study_id"],
+                "analysis_id": record["analysis_id"],
+                "file": file_name,
+                "size": size,
+                "sha256": sha256,
+                "fetched_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "listing_hash": _record_hash(record)}
+
+    def save_manifest(self):
+        """Write the manifest to the directory."""
+        content = json.dumps(self.manifest, indent=2, sort_keys=True).encode("utf-8")
+        _write_atomic(os.path.join(self.directory, MANIFEST_NAME), content)
+
+
+def _record_hash(record: dict) -> str:
+    """Return a hash of an analysis record from the listing, to tell if it changed."""
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _write_atomic(path: str, content: bytes):
+    """Write content to a temporary file next to path and rename it to path, so path is never partially written."""
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as fh:
+            fh.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
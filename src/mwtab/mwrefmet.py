@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+mwtab.mwrefmet
+~~~~~~~~~~~~~~
+
+This module provides the :class:`~mwtab.mwrefmet.RefMetDictionary` class, a local copy of the
+RefMet table of standardized metabolite names from the Metabolomics Workbench. The table is
+downloaded once and saved to a file, and names are then resolved from in memory indexes instead
+of a request to the REST API for each name.
+"""
+
+import datetime
+import gzip
+import json
+import math
+import re
+import unicodedata
+
+from . import mwrest
+from .mwmirror import _write_atomic
+
+
+#: Greek letters that are spelled out when normalizing names, so "α-Tocopherol" matches "alpha-Tocopherol".
+_GREEK_LETTERS = {"α": "alpha", "β": "beta", "γ": "gamma", "δ": "delta", "ε": "epsilon", "κ": "kappa",
+                  "λ": "lambda", "μ": "mu", "σ": "sigma", "τ": "tau", "ω": "omega"}
+
+#: Characters that are removed when normalizing names. Punctuation like "," and ":" is kept because
+#: it is meaningful in names like "1,2-Diacylglycerol" and "PC 34:1".
+_IGNORED_CHARACTERS = re.compile(r"[\s\-‐-―−_'\"‘’“”′″()\[\]{}]+")
+
+
+def normalize_name(name: str) -> str:
+    """Return a normalized form of a metabolite name for matching.
+
+    The name is Unicode normalized and case folded, Greek letters are spelled out, and whitespace,
+    hyphens, quotes, primes, and brackets are removed.
+
+    Args:
+        name: The metabolite name to normalize.
+
+    Returns:
+        The normalized name.
+
+    Examples:
+        >>> normalize_name("L-Glutamic acid")
+        'lglutamicacid'
+        >>> normalize_name("α-D-Glucose")
+        'alphadglucose'
+    """
+    name = unicodedata.normalize("NFKC", name).casefold()
+    for letter, spelled_out in _GREEK_LETTERS.items():
+        name = name.replace(letter, spelled_out)
+    return _IGNORED_CHARACTERS.sub("", name)
+
+
+def _ngrams(normalized_name: str, n: int = 3) -> set[str]:
+    """Return the set of character n-grams of a normalized name, padded so short names have n-grams too."""
+    padded = " " + normalized_name + " "
+    return {padded[i:i+n] for i in range(max(len(padded) - n + 1, 1))}
+
+
+class RefMetDictionary:
+    """A local, indexed copy of the RefMet table of standardized metabolite names.
+
+    Names are resolved by trying, in order, an exact match, a case insensitive match, and a match
+    of the names normalized by :func:`~mwtab.mwrefmet.normalize_name`, each of which is 1 dictionary
+    lookup. If fuzzy matching is allowed, names that still don't match are compared to the RefMet
+    names that share the most character trigrams with them, and the most similar is used if its
+    similarity is at least the threshold. The trigram index is only built the first time it is needed.
+    When more than 1 RefMet entry matches at the same step, the first one in the table is used.
+
+    Parameters:
+        records: The RefMet entries, each a dictionary with at least a "name" key, such as
+          "name", "refmet_id", "formula", "exactmass", "inchi_key", "pubchem_cid", and "main_class".
+
+    Examples:
+        Basic usage.
+
+        >>> refmet = RefMetDictionary.download('refmet.json')
+        >>> refmet = RefMetDictionary.load('refmet.json')
+        >>> refmet.resolve('l-glutamic acid')['name']
+        'Glutamic acid'
+        >>> refmet.standardize(['D-Glucose', 'Citric acid'], fuzzy=True)
+        {'D-Glucose': 'Glucose', 'Citric acid': 'Citric acid'}
+
+    Attributes:
+        records: The RefMet entries.
+        fetched_at: When the table was downloaded, as an ISO 8601 string, or None if it is unknown.
+    """
+    #: The indexes used by :meth:`resolve`, in the order they are tried.
+    match_types = ("exact", "casefold", "normalized")
+
+    def __init__(self, records: list[dict], fetched_at: str|None = None):
+        self.records = records
+        self.fetched_at = fetched_at
+        self._name_indexes = {match_type: {} for match_type in self.match_types}
+        for record_id, record in enumerate(records):
+            name = record.get("name")
+            if not name:
+                continue
+            for match_type, key in zip(self.match_types, (name, name.casefold(), normalize_name(name))):
+                self._name_indexes[match_type].setdefault(key, record_id)
+        self._field_indexes = {}
+        self._ngram_index = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def download(cls, path: str|None = None, base_url: str = mwrest.BASE_URL) -> 'RefMetDictionary':
+        """Download the whole RefMet table from the Metabolomics Workbench, and save it to path if given.
+
+        Args:
+            path: The path to save the table to, which can be loaded with :meth:`load`. It is gzip
+              compressed if it ends in ".gz".
+            base_url: The base URL of the Metabolomics Workbench REST API.
+
+        Returns:
+            The downloaded table.
+        """
+        response = json.loads(mwrest._read_url(base_url + "refmet/all"))
+        # Responses with more than 1 row are dictionaries of rows keyed by "1", "2", and so on.
+        if isinstance(response, dict):
+            records = [response] if "name" in response else list(response.values())
+        else:
+            records = response
+        refmet = cls(records, datetime.datetime.now(datetime.timezone.utc).isoformat())
+        if path:
+            refmet.save(path)
+        return refmet
+
+    @classmethod
+    def load(cls, path: str) -> 'RefMetDictionary':
+        """Load a table saved by :meth:`save` or :meth:`download`.
+
+        Args:
+            path: The path the table was saved to.
+
+        Returns:
+            The loaded table.
+        """
+        open_function = gzip.open if path.endswith(".gz") else open
+        with open_function(path, "rt", encoding="utf-8") as fh:
+            saved = json.load(fh)
+        return cls(saved["records"], saved.get("fetched_at"))
+
+    def save(self, path: str):
+        """Save the table to path, gzip compressed if path ends in ".gz".
+
+        Args:
+            path: The path to save the table to.
+        """
+        content = json.dumps({"fetched_at": self.fetched_at, "records": self.records}).encode("utf-8")
+        if path.endswith(".gz"):
+            content = gzip.compress(content)
+        _write_atomic(path, content)
+
+    def resolve(self, name: str, fuzzy: bool = False, threshold: float = 0.8) -> dict|None:
+        """Return the RefMet entry for name, or None if there isn't one.
+
+        Args:
+            name: The metabolite name to look up.
+            fuzzy: If True, use the most similar RefMet name if there isn't an exact, case insensitive, or normalized match.
+            threshold: The lowest similarity, from 0 to 1, for a fuzzy match.
+
+        Returns:
+            The matching RefMet entry.
+        """
+        record_id, _, _ = self._resolve(name, fuzzy, threshold)
+        return None if record_id is None else self.records[record_id]
+
+    def _resolve(self, name: str, fuzzy: bool, threshold: float) -> tuple[int|None, str|None, float]:
+        """Return the index of the entry matching name, how it matched, and the similarity."""
+        for match_type, key in zip(self.match_types, (name, name.casefold(), normalize_name(name))):
+            record_id = self._name_indexes[match_type].get(key)
+            if record_id is not None:
+                return record_id, match_type, 1.0
+        if fuzzy:
+            matches = self._similar(name, 1, threshold)
+            if matches:
+                return matches[0][0], "fuzzy", matches[0][1]
+        return None, None, 0.0
+
+    def match(self, name: str, limit: int = 5, threshold: float = 0.5) -> list[tuple[dict, float]]:
+        """Return the RefMet entries with the names most similar to name.
+
+        Similarity is the Dice coefficient of the character trigrams of the normalized names, from 0 to 1.
+
+        Args:
+            name: The metabolite name to look up.
+            limit: The most entries to return.
+            threshold: The lowest similarity to return.
+
+        Returns:
+            A list of entries and their similarity, most similar first.
+        """
+        return [(self.records[record_id], score) for record_id, score in self._similar(name, limit, threshold)]
+
+    def _similar(self, name: str, limit: int, threshold: float) -> list[tuple[int, float]]:
+        """Return the indexes and similarities of the entries most similar to name, using the trigram index."""
+        if self._ngram_index is None:
+            self._ngram_index = {}
+            for key in self._name_indexes["normalized"]:
+                for ngram in _ngrams(key):
+                    self._ngram_index.setdefault(ngram, []).append(key)
+
+        query_ngrams = _ngrams(normalize_name(name))
+        # A name with a similarity of at least threshold shares at least this many trigrams, so it has
+        # to share 1 of the len(query_ngrams) - min_shared + 1 least common trigrams. Only those are used
+        # to find candidates, which skips the long lists for trigrams that are in many names.
+        min_shared = max(math.ceil(threshold * len(query_ngrams) / (2 - threshold)), 1)
+        rarest = sorted(query_ngrams, key=lambda ngram: len(self._ngram_index.get(ngram, ())))
+        candidates = set()
+        for ngram in rarest[:len(query_ngrams) - min_shared + 1]:
+            candidates.update(self._ngram_index.get(ngram, ()))
+
+        scored = []
+        for key in candidates:
+            key_ngrams = _ngrams(key)
+            score = 2 * len(query_ngrams & key_ngrams) / (len(query_ngrams) + len(key_ngrams))
+            if score >= threshold:
+                scored.append((score, key))
+        scored.sort(key=lambda item: (-item[0], self._name_indexes["normalized"][item[1]]))
+        return [(self._name_indexes["normalized"][key], score) for score, key in scored[:limit]]
+
+    def standardize(self, names: list[str], fuzzy: bool = False, threshold: float = 0.8) -> dict[str, str|None]:
+        """Return the RefMet name for each of names, or None for names that couldn't be resolved.
+
+        Args:
+            names: The metabolite names to standardize, such as the names in a METABOLITES table.
+            fuzzy: If True, use the most similar RefMet name for names that don't otherwise match.
+            threshold: The lowest similarity, from 0 to 1, for a fuzzy match.
+
+        Returns:
+            A dictionary of each distinct name to its RefMet name.
+        """
+        standardized = {}
+        for name in names:
+            if name not in standardized:
+                record = self.resolve(name, fuzzy, threshold)
+                standardized[name] = None if record is None else record["name"]
+        return standardized
+
+    def query(self, input_item: str, input_value: str, output_item: str = "all") -> dict|None:
+        """Look up input_value the same way as the refmet context of the REST API, but from the local table.
+
+        Args:
+            input_item: What input_value is. "name" matches names without regard to case, "match" resolves
+              input_value with :meth:`resolve`, allowing fuzzy matches, and other items, such as "inchi_key",
+              "regno", "pubchem_cid", "formula", "main_class", and "sub_class", match that field exactly.
+              "all" returns every entry.
+            input_value: The value to look up.
+            output_item: The field to return, a comma separated list of fields, or "all" for every field.
+
+        Returns:
+            The matching entry, in the same form as the parsed JSON from the REST API. If more than 1 entry
+            matches, they are in a dictionary keyed by "1", "2", and so on. None if nothing matches.
+        """
+        if input_item == "all":
+            record_ids = range(len(self.records))
+        elif input_item == "name":
+            record_id = self._name_indexes["casefold"].get(input_value.casefold())
+            record_ids = [] if record_id is None else [record_id]
+        elif input_item == "match":
+            record_id, _, _ = self._resolve(input_value, True, 0.8)
+            record_ids = [] if record_id is None else [record_id]
+        else:
+            if input_item not in self._field_indexes:
+                field_index = {}
+                for record_id, record in enumerate(self.records):
+                    if record.get(input_item) not in (None, ""):
+                        field_index.setdefault(str(record[input_item]), []).append(record_id)
+                self._field_indexes[input_item] = field_index
+            record_ids = self._field_indexes[input_item].get(str(input_value), [])
+
+        fields = None if output_item == "all" else output_item.split(",")
+        rows = [self.records[record_id] if fields is None else
+                {field: self.records[record_id].get(field) for field in fields}
+                for record_id in record_ids]
+        if not rows:
+            return None
+        if len(rows) == 1:
+            return rows[0]
+        return {str(count): row for count, row in enumerate(rows, 1)}
+
+    def batch_query(self, input_item: str, values: list[str], output_item: str = "all") -> tuple[dict, dict]:
+        """Look up many values with :meth:`query`, a local replacement for :func:`~mwtab.mwrest.batch_query` with the refmet context.
+
+        Args:
+            input_item: What the values are, as for :meth:`query`.
+            values: The input values to look up.
+            output_item: The field to return, a comma separated list of fields, or "all" for every field.
+
+        Returns:
+            A dictionary of each distinct value to its result, and a dictionary of errors, which is always empty,
+            so it can be used in place of :func:`~mwtab.mwrest.batch_query`.
+        """
+        results = {}
+        for value in values:
+            if value not in results:
+                results[value] = self.query(input_item, value, output_item)
+        return results, {}
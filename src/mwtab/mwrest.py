@@ -14,6 +14,14 @@ from collections import OrderedDict
 from . import fileio
 import re
 import json
+import time
+import threading
+import urllib.parse
+import os
+import gzip
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 VERBOSE = False
@@ -66,12 +74,7 @@ def _pull_study_analysis(base_url=BASE_URL):
     :return: Dictionary of study ids (keys) and lists of analyses (value).
     :rtype: :py:class:`dict`
     """
-    url = GenericMWURL(
-        {"context": "study", "input_item": "study_id", "input_value": "ST", "output_item": "analysis"},
-        base_url
-    ).url
-    mwrestfile = next(fileio.read_mwrest(url))
-    json_object = mwrestfile._is_json(mwrestfile.text)
+    json_object = _pull_analysis_records(base_url)
 
     study_analysis_dict = dict()
     for k in json_object.keys():
@@ -83,6 +86,23 @@ def _pull_study_analysis(base_url=BASE_URL):
     return study_analysis_dict
 
 
+def _pull_analysis_records(base_url=BASE_URL):
+    """
+    Method for requesting the record of every analysis in Metabolomics Workbench, which has the study id,
+    analysis id, and summary information like the analysis type. Used by :func:`~mwtab.mwrest._pull_study_analysis`.
+
+    :param str base_url: Base url to Metabolomics Workbench REST API.
+    :return: Dictionary of the analysis records, keyed by their position in the response.
+    :rtype: :py:class:`dict`
+    """
+    url = GenericMWURL(
+        {"context": "study", "input_item": "study_id", "input_value": "ST", "output_item": "analysis"},
+        base_url
+    ).url
+    mwrestfile = next(fileio.read_mwrest(url))
+    return mwrestfile._is_json(mwrestfile.text)
+
+
 def generate_mwtab_urls(input_items, base_url=BASE_URL, output_format='txt', return_exceptions=False):
     """
     Method for generating URLS to be used to retrieve `mwtab` files for analyses and
@@ -162,6 +182,232 @@ def generate_mwtab_urls(input_items, base_url=BASE_URL, output_format='txt', ret
 #                                                return_exceptions=return_exceptions)
 
 
+#: The default average number of requests per second, 1 every 3 seconds, the same as sleeping 3 seconds
+#: after every download did before requests were made concurrently. Faster rates have to be asked for.
+DEFAULT_RATE = 1 / 3
+
+#: HTTP status codes that are likely to succeed if the request is tried again later.
+RETRY_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class TokenBucket(object):
+    """TokenBucket class that limits how often requests are made, so many requests can be made politely.
+
+    Requests are allowed at rate per second on average, with up to burst of them at once after a pause.
+    It is thread safe, and each call to :meth:`~mwtab.mwrest.TokenBucket.acquire` reserves its own time,
+    so waiting threads don't all go at once when a token is available.
+    """
+
+    def __init__(self, rate, burst=1):
+        """TokenBucket initializer.
+
+        :param float rate: Average number of requests per second. For example, 1/3 is 1 request every 3 seconds.
+        :param int burst: Number of requests that can be made at once.
+        """
+        if rate <= 0:
+            raise ValueError("The rate must be greater than 0.")
+        if burst < 1:
+            raise ValueError("The burst must be at least 1.")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until it is available.
+
+        :return: The number of seconds slept.
+        :rtype: :py:class:`float`
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens can go negative, which reserves the next ones for this call.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def is_transient_error(e):
+    """Test if an exception from a request is one that is likely to succeed if the request is tried again.
+
+    :param Exception e: The exception raised by the request.
+    :return: True for connection errors, timeouts, and HTTP errors with a status in :data:`RETRY_STATUS_CODES`.
+    :rtype: :py:obj:`bool`
+    """
+    # Imported here, because they are only needed once a request has failed, and take a while to import.
+    import http.client
+    import urllib.error
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code in RETRY_STATUS_CODES
+    return isinstance(e, (urllib.error.URLError, TimeoutError, ConnectionError, http.client.HTTPException))
+
+
+def call_with_retries(function, *args, retries=3, backoff=1, limiter=None, **kwds):
+    """Call function, trying again with exponential backoff if it raises a transient error.
+
+    :param function: The function to call with args and kwds.
+    :param int retries: The number of times to try again after the first try.
+    :param float backoff: Seconds to wait before the first retry, which doubles for each retry after.
+                          A Retry-After header in an HTTP error is used if it is longer.
+    :param limiter: If given, a token is acquired from it before every try.
+    :type limiter: :class:`~mwtab.mwrest.TokenBucket` or :py:obj:`None`
+    :return: What function returns.
+    :raises Exception: The exception from the last try, or the first one that isn't transient.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return function(*args, **kwds)
+        except Exception as e:
+            if attempt == retries or not is_transient_error(e):
+                raise
+            wait = backoff * 2 ** attempt
+            import urllib.error
+            retry_after = e.headers.get("Retry-After") if isinstance(e, urllib.error.HTTPError) and e.headers else None
+            if retry_after and retry_after.strip().isdigit():
+                wait = max(wait, int(retry_after))
+            time.sleep(wait)
+
+
+#: The number of bytes copied at a time by :func:`~mwtab.mwrest.download_to_file`.
+CHUNK_SIZE = 1 << 16
+
+
+def download_to_file(url, path, chunk_size=CHUNK_SIZE):
+    """Download url straight to a file, copying the response in chunks instead of reading it all into memory.
+
+    The response is written to a temporary file next to path, which is renamed to path once the download is
+    complete, so path is never left partially written. If path ends in ".gz", the file is gzip compressed as
+    it is written. If the response is empty, which is what the Metabolomics Workbench returns when there is
+    nothing for a request, no file is created. A response of only whitespace is saved, the same as
+    :func:`~mwtab.cli.save_mwrest_file` does.
+
+    :param str url: The URL to download.
+    :param str path: The path of the file to save to.
+    :param int chunk_size: The number of bytes to copy at a time.
+    :return: The number of bytes downloaded and their SHA-256 hash, or :py:obj:`None` if the response was empty.
+    :rtype: :py:class:`tuple` or :py:obj:`None`
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    size = 0
+    sha256 = hashlib.sha256()
+    try:
+        with os.fdopen(file_descriptor, "wb") as raw_file:
+            outfile = gzip.GzipFile(filename="", mode="wb", fileobj=raw_file) if path.endswith(".gz") else raw_file
+            response = fileio.urlopen(url)
+            try:
+                while chunk := response.read(chunk_size):
+                    outfile.write(chunk)
+                    size += len(chunk)
+                    sha256.update(chunk)
+            finally:
+                response.close()
+            if outfile is not raw_file:
+                outfile.close()
+        if not size:
+            os.remove(temp_path)
+            return None
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return size, sha256.hexdigest()
+
+
+def batch_query(context, input_item, values, output_item, output_format="json", base_url=BASE_URL, cache=None,
+                workers=4, rate=DEFAULT_RATE, burst=1, retries=3):
+    """Look up many input values with the same context, input item, and output item.
+
+    Repeated values are only requested once, and values whose URL is already in cache aren't requested at all.
+    The rest are requested by a pool of worker threads, limited to an average of rate requests per second,
+    and requests that fail with a transient error are tried again, the same as
+    :func:`~mwtab.cli.download_and_save_ID_list`. Every URL is validated with
+    :class:`~mwtab.mwrest.GenericMWURL` before anything is requested, and values that don't make a valid URL
+    are put in the errors instead of being requested, so 1 bad value doesn't stop the rest.
+
+    :param str context: The context, such as "refmet" or "compound".
+    :param str input_item: The input item, such as "name".
+    :param values: The input values to look up.
+    :type values: :py:class:`~collections.abc.Iterable`
+    :param str output_item: The output item, such as "all".
+    :param str output_format: The output format, "json" or "txt".
+    :param str base_url: Base url to Metabolomics Workbench REST API.
+    :param cache: A dictionary of URLs to response text that is used instead of requesting them, and that
+                  new responses are added to. Blank responses are cached too, failed requests are not.
+    :type cache: :py:class:`dict` or :py:obj:`None`
+    :param int workers: The number of requests to make at the same time.
+    :param float rate: The average number of requests per second, including retries.
+    :param int burst: The number of requests that can be made at once.
+    :param int retries: The number of times to try a request again after a transient error.
+    :return: A dictionary of each distinct value to its response, and a dictionary of each value that couldn't be
+             requested to its exception. JSON responses are parsed, and blank responses are :py:obj:`None`.
+    :rtype: :py:class:`tuple`
+    """
+    cache = {} if cache is None else cache
+    urls = {}
+    errors = {}
+    for value in values:
+        if value not in urls and value not in errors:
+            try:
+                urls[value] = GenericMWURL({"context": context,
+                                            "input_item": input_item,
+                                            "input_value": urllib.parse.quote(value, safe=""),
+                                            "output_item": output_item,
+                                            "output_format": output_format}, base_url).url
+            except (KeyError, ValueError) as e:
+                errors[value] = e
+
+    limiter = TokenBucket(rate, burst)
+    to_request = [url for url in dict.fromkeys(urls.values()) if url not in cache]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {url: executor.submit(call_with_retries, _read_url, url, retries=retries, limiter=limiter) 
+                   for url in to_request}
+    url_errors = {}
+    for url, future in futures.items():
+        try:
+            cache[url] = future.result()
+        except Exception as e:
+            url_errors[url] = e
+
+    results = {}
+    for value, url in urls.items():
+        if url in url_errors:
+            errors[value] = url_errors[url]
+        else:
+            results[value] = _parse_response(cache[url], output_format)
+    return results, errors
+
+
+def _read_url(url):
+    """Return the response to url as a string."""
+    response = fileio.urlopen(url)
+    try:
+        return response.read().decode("utf-8")
+    finally:
+        response.close()
+
+
+def _parse_response(text, output_format):
+    """Parse a JSON response, returning None if it is blank and the text if it isn't JSON."""
+    if not text.strip():
+        return None
+    if output_format != "json":
+        return text
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
 class GenericMWURL(object):
     """GenericMWURL class that stores and validates parameters specifying a Metabolomics Workbench REST URL.
 
@@ -541,7 +787,23 @@ class MWRESTFile(object):
         :param str source: Source a `MWRESTFile` instance was created from.
         """
         self.source = source
-        self.text = ""
+        self.content = b""
+        self._text = None
+
+    @property
+    def text(self):
+        """The downloaded data as a string. It is only decoded from :attr:`content` the first time it is used.
+
+        :rtype: :py:class:`str`
+        """
+        if self._text is None:
+            self._text = self.content.decode("utf-8")
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self.content = value.encode("utf-8")
 
     def read(self, filehandle):
         """Read data into a :class:`~mwtab.mwrest.MWRESTFile` instance.
@@ -552,7 +814,8 @@ class MWRESTFile(object):
         :return: None
         :rtype: :py:obj:`None`
         """
-        self.text = filehandle.read().decode("utf-8")
+        self.content = filehandle.read()
+        self._text = None
         # input_str = input_str.replace("\r\n", "\n")
         # self.text = re.sub(r"</br>", "", self.text)  # included to remove remaining HTML tags
         filehandle.close()
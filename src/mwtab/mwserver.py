@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+mwtab.mwserver
+~~~~~~~~~~~~~~
+
+This module provides the :class:`~mwtab.mwserver.MWTabServer` class, a long running local server
+that keeps worker processes with pandas, jsonschema, and the rest of mwtab already imported, so
+validating, converting, or extracting a file doesn't pay for starting Python and importing them
+every time. It is started with ``mwtab serve``, and the validate, convert, and extract commands
+send their work to it with ``--server``.
+
+The server reads and writes files as the user running it, so only that user may use it. By default it
+listens on a Unix socket that only its user can connect to. It can listen on a port on 127.0.0.1
+instead, but any local user, and any web page open in a browser, can connect to that, so every request
+to a port must have the token the server writes to a file only its user can read, in an
+"Authorization: Bearer <token>" header. :func:`request` reads the token file itself. Requests with an
+Origin header, which browsers send, a Host other than localhost, or a POST body that isn't
+"Content-Type: application/json", are refused either way.
+
+The server speaks JSON over HTTP:
+
+    GET /status
+        Returns {"status": "ok", "workers": <number of workers>, "commands": [<commands /run accepts>]}.
+    POST /validate
+        Takes {"path": <file, directory, or archive>} or {"text": <file contents>, "source": <name>},
+        and optionally "profile", "include", "exclude", "max_errors", and "force", the same as the
+        validate command. Returns {"files": [{"source", "validation_log", "errors"}], "read_errors": [{"source", "error"}]},
+        where "errors" is the same list of errors the validate command saves with --to-path.
+    POST /run
+        Takes {"cmdargs": <parsed command line arguments>, "cwd": <directory>} for a validate, convert,
+        or extract command, runs it in the directory, and returns {"returncode", "stdout", "stderr"}.
+
+Errors are returned as {"error": <message>} with a 4xx or 5xx status.
+"""
+
+import contextlib
+import hmac
+import http.client
+import http.server
+import io
+import json
+import os
+import secrets
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+import multiprocessing
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+#: The directory with the default Unix socket and the token files of servers listening on ports.
+SERVER_DIRECTORY = os.path.join(os.path.expanduser("~"), ".mwtab")
+
+#: The Unix socket the server listens on if a socket path or port isn't given.
+DEFAULT_SOCKET_PATH = os.path.join(SERVER_DIRECTORY, "server.sock")
+
+#: The port of "http://127.0.0.1" addresses that don't have one.
+DEFAULT_PORT = 8765
+
+#: The Host headers the server accepts, without the port.
+_LOCAL_HOSTS = ("localhost", "127.0.0.1")
+
+#: The commands that can be run with POST /run.
+RUN_COMMANDS = ("convert", "validate", "extract")
+
+#: The other commands of the command line interface, which are refused by POST /run.
+_OTHER_COMMANDS = ("download", "index", "query", "mirror", "duplicates", "serve")
+
+
+def token_path(port: int) -> str:
+    """Return the path of the token file of a server listening on port."""
+    return os.path.join(SERVER_DIRECTORY, "server-{}.token".format(port))
+
+
+def _private_directory(path: str):
+    """Create the directory at path, if it doesn't exist, so only the user can use it."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+
+def _warm_up():
+    """Import everything the commands use when a worker process starts, instead of on its first request."""
+    import jsonschema
+    import numpy
+    import pandas
+    import pyarrow.compute
+    from . import cli
+
+
+def _ping() -> int:
+    """Return the process ID of the worker, used to start the workers before the first request."""
+    return os.getpid()
+
+
+def _error_text(e: BaseException) -> str:
+    """Return the exception type and message of e, like the last line of a traceback."""
+    return "".join(traceback.format_exception_only(type(e), e)).strip()
+
+
+def _validate(request: dict) -> dict:
+    """Validate the file or files in a POST /validate request in a worker process."""
+    from . import fileio, mwschema
+    from .mwtab import MWTabFile
+    from .validator import validate_file
+
+    force = bool(request.get("force"))
+    if "text" in request:
+        mwtabfile = MWTabFile(request.get("source") or "<request>", duplicate_keys=True, force=force)
+        try:
+            mwtabfile.read_from_str(request["text"])
+            files = [(mwtabfile, None)]
+        except Exception as e:
+            files = [(mwtabfile.source, e)]
+    else:
+        files = fileio.read_with_class(request["path"], MWTabFile, {'duplicate_keys': True, 'force': force}, return_exceptions=True)
+
+    response = {"files": [], "read_errors": []}
+    for mwtabfile, e in files:
+        if e is not None:
+            response["read_errors"].append({"source": mwtabfile if isinstance(mwtabfile, str) else str(request.get("path")),
+                                            "error": _error_text(e)})
+            continue
+        validation_log, errors = validate_file(mwtabfile,
+                                               ms_schema=mwschema.ms_required_schema,
+                                               nmr_schema=mwschema.nmr_required_schema,
+                                               verbose=False,
+                                               profile=request.get("profile") or "full",
+                                               include=request.get("include"),
+                                               exclude=request.get("exclude"),
+                                               max_errors=request.get("max_errors"))
+        response["files"].append({"source": mwtabfile.source, "validation_log": validation_log, "errors": errors})
+    return response
+
+
+def _run_command(cmdargs: dict, cwd: str) -> dict:
+    """Run a command line interface command in a worker process and return its exit code and output."""
+    from . import cli
+
+    os.chdir(cwd)
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    returncode = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            cli.cli(cmdargs)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                returncode = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+    return {"returncode": returncode, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+class _RequestError(Exception):
+    """A request that can't be done, with the HTTP status to return."""
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the requests for a :class:`MWTabServer`, which is self.server.mwtab_server."""
+    server_version = "mwtab"
+
+    def do_GET(self):
+        self._respond(self._get)
+
+    def do_POST(self):
+        self._respond(self._post)
+
+    def _check_request(self):
+        """Refuse requests that might not be from the user running the server."""
+        # Browsers send Origin with cross site requests, and the Host of the page's site, such as a
+        # domain that was pointed at 127.0.0.1, so neither comes from a local client.
+        if self.headers.get("Origin") is not None:
+            raise _RequestError(403, "Requests from web pages are not accepted.")
+        host = (self.headers.get("Host") or "").strip()
+        if host.rsplit(":", 1)[0] not in _LOCAL_HOSTS:
+            raise _RequestError(403, 'The Host header must be localhost or 127.0.0.1, not "' + host + '".')
+        token = self.server.mwtab_server._token
+        if token is not None:
+            authorization = self.headers.get("Authorization") or ""
+            if not hmac.compare_digest(authorization.encode("utf-8"), ("Bearer " + token).encode("utf-8")):
+                raise _RequestError(401, "The request doesn't have the server's token.")
+        if self.command == "POST":
+            content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            if content_type != "application/json":
+                raise _RequestError(415, "The Content-Type of the request must be application/json.")
+
+    def _get(self) -> dict:
+        if self.path != "/status":
+            raise _RequestError(404, 'Unknown path, "' + self.path + '".')
+        return {"status": "ok", "workers": self.server.mwtab_server.workers, "commands": list(RUN_COMMANDS)}
+
+    def _post(self) -> dict:
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError as e:
+            raise _RequestError(400, "The request is not valid JSON: " + str(e))
+        if not isinstance(request, dict):
+            raise _RequestError(400, "The request must be a JSON object.")
+
+        if self.path == "/validate":
+            if "path" not in request and "text" not in request:
+                raise _RequestError(400, 'A validate request needs a "path" or "text".')
+            return self.server.mwtab_server.submit(_validate, request)
+
+        if self.path == "/run":
+            cmdargs = request.get("cmdargs")
+            if not isinstance(cmdargs, dict) or not any(cmdargs.get(command) for command in RUN_COMMANDS) or \
+               any(cmdargs.get(command) for command in _OTHER_COMMANDS):
+                raise _RequestError(400, "Only " + ", ".join(RUN_COMMANDS) + " commands can be run by the server.")
+            # Don't let the worker send the command on to a server again.
+            cmdargs = dict(cmdargs, **{"--server": None})
+            return self.server.mwtab_server.submit(_run_command, cmdargs, request.get("cwd") or os.getcwd())
+
+        raise _RequestError(404, 'Unknown path, "' + self.path + '".')
+
+    def _respond(self, method):
+        try:
+            self._check_request()
+            status, response = 200, method()
+        except _RequestError as e:
+            status, response = e.status, {"error": str(e)}
+        except Exception as e:
+            status, response = 500, {"error": _error_text(e)}
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.mwtab_server.verbose:
+            # Clients of Unix sockets don't have an address.
+            client = self.client_address[0] if isinstance(self.client_address, tuple) else "unix socket"
+            print("{} - {}".format(client, format % args), flush=True)
+
+
+class _TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MWTabServer:
+    """A local server that validates, converts, and extracts files in warm worker processes.
+
+    The worker processes are started, and pandas, jsonschema, and mwtab imported in them, when the server
+    is created, so the first request doesn't wait for them. Each request is run in 1 worker, so up to
+    workers requests are run at the same time, and the rest wait. If a worker dies, the workers are
+    started again and the request it was running returns an error.
+
+    Parameters:
+        socket_path: The Unix socket to listen on. The socket can only be used by the user running the server.
+          A file left at the path by a server that stopped is replaced. Defaults to DEFAULT_SOCKET_PATH
+          if port isn't given.
+        port: If given, and socket_path isn't, listen on this port on 127.0.0.1 instead. 0 picks a free port.
+          A new token is written to the file at :func:`token_path` and removed when the server is closed.
+        workers: The number of worker processes.
+        verbose: If True, print each request.
+
+    Examples:
+        Basic usage.
+
+        >>> server = MWTabServer(socket_path='/path/to/mwtab.sock', workers=2)
+        >>> server.serve_forever()
+
+        In another process.
+
+        >>> request('/path/to/mwtab.sock', '/validate', {'path': '/path/to/ST000001_AN000001.txt'})['files'][0]['errors']
+        []
+
+    Attributes:
+        address: The address clients connect to, "http://127.0.0.1:<port>" or the socket path.
+        workers: The number of worker processes.
+        verbose: If True, print each request.
+    """
+    def __init__(self, socket_path: str|None = None, port: int|None = None, workers: int = 2, verbose: bool = False):
+        if workers < 1:
+            raise ValueError("workers must be at least 1.")
+        self.workers = workers
+        self.verbose = verbose
+        if not socket_path and port is None:
+            socket_path = DEFAULT_SOCKET_PATH
+            _private_directory(SERVER_DIRECTORY)
+        self._socket_path = socket_path
+        self._token = None
+        self._token_path = None
+        self._pool_lock = threading.Lock()
+        self._pool = self._start_pool()
+
+        if socket_path:
+            if os.path.exists(socket_path):
+                if _is_listening(socket_path):
+                    raise ValueError('Another server is already listening on "' + socket_path + '".')
+                os.remove(socket_path)
+            # Only the user running the server can connect to the socket.
+            umask = os.umask(0o177)
+            try:
+                self._server = _UnixServer(socket_path, _RequestHandler)
+            finally:
+                os.umask(umask)
+            self.address = socket_path
+        else:
+            self._server = _TCPServer(("127.0.0.1", port), _RequestHandler)
+            self.address = "http://127.0.0.1:{}".format(self._server.server_address[1])
+            self._token = secrets.token_urlsafe(32)
+            self._token_path = token_path(self._server.server_address[1])
+            _private_directory(SERVER_DIRECTORY)
+            # Create the file so only the user can read it before the token is written to it.
+            with os.fdopen(os.open(self._token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fh:
+                os.fchmod(fh.fileno(), 0o600)
+                fh.write(self._token)
+        self._server.mwtab_server = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        """Start the worker processes and wait for them to be ready."""
+        # Workers are spawned instead of forked, because the server has threads running when they are restarted.
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_warm_up)
+        for future in [pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+        return pool
+
+    def submit(self, function, *args):
+        """Run function with args in a worker process and return its result.
+
+        Raises:
+            RuntimeError: If the worker process died. The workers are started again.
+        """
+        pool = self._pool
+        try:
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            with self._pool_lock:
+                if self._pool is pool:
+                    pool.shutdown(wait=False)
+                    self._pool = self._start_pool()
+            raise RuntimeError("The worker process stopped unexpectedly while handling the request. The workers were restarted.")
+
+    def serve_forever(self):
+        """Handle requests until :meth:`shutdown` is called."""
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stop :meth:`serve_forever`, from another thread."""
+        self._server.shutdown()
+
+    def close(self):
+        """Close the socket, stop the worker processes, and remove the Unix socket file or token file."""
+        self._server.server_close()
+        self._pool.shutdown()
+        for path in (self._socket_path, self._token_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+def _is_listening(socket_path: str) -> bool:
+    """Return True if a server is accepting connections on the Unix socket at socket_path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTPConnection to a server listening on a Unix socket."""
+    def __init__(self, socket_path: str, **kwds):
+        super().__init__("localhost", **kwds)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _read_token(port: int) -> str:
+    """Return the token of the server listening on port from its token file."""
+    try:
+        with open(token_path(port), encoding="utf-8") as fh:
+            return fh.read().strip()
+    except FileNotFoundError:
+        raise FileNotFoundError('The token file, "' + token_path(port) + '", of a server on port ' + str(port) +
+                                " doesn't exist. Is the server running as this user?")
+
+
+def request(address: str, path: str, payload: dict|None = None, timeout: float|None = None, token: str|None = None) -> dict:
+    """Send a request to a :class:`MWTabServer` and return its response.
+
+    Args:
+        address: The address of the server, "http://127.0.0.1:<port>" or the path to its Unix socket.
+        path: The path to request, such as "/status" or "/validate".
+        payload: The JSON body of a POST request. If None, a GET request is sent.
+        timeout: The most seconds to wait for the connection and the response. None waits as long as it takes.
+        token: The token of a server listening on a port. Defaults to the one in its token file.
+
+    Returns:
+        The parsed JSON response.
+
+    Raises:
+        OSError: If the server can't be connected to, or its token file can't be read.
+        RuntimeError: If the server returned an error.
+    """
+    kwds = {} if timeout is None else {"timeout": timeout}
+    headers = {}
+    if address.startswith("http://"):
+        parsed = urllib.parse.urlsplit(address)
+        port = parsed.port or DEFAULT_PORT
+        headers["Authorization"] = "Bearer " + (token if token is not None else _read_token(port))
+        connection = http.client.HTTPConnection(parsed.hostname, port, **kwds)
+    else:
+        connection = _UnixHTTPConnection(address, **kwds)
+    try:
+        if payload is None:
+            connection.request("GET", path, headers=headers)
+        else:
+            headers["Content-Type"] = "application/json"
+            connection.request("POST", path, json.dumps(payload).encode("utf-8"), headers)
+        response = connection.getresponse()
+        body = json.loads(response.read() or b"{}")
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError("The mwtab server returned an error ({}): {}".format(response.status, body.get("error")))
+    return body
+
+
+def run_remote(address: str, cmdargs: dict) -> dict:
+    """Run a validate, convert, or extract command on a :class:`MWTabServer`.
+
+    Relative paths in the command are relative to the current directory, the same as running it here.
+
+    Args:
+        address: The address of the server, "http://127.0.0.1:<port>" or the path to its Unix socket.
+        cmdargs: The command line arguments parsed by docopt.
+
+    Returns:
+        A dictionary with the command's "returncode", and what it printed to "stdout" and "stderr".
+    """
+    return request(address, "/run", {"cmdargs": cmdargs, "cwd": os.getcwd()})
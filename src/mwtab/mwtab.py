@@ -17,7 +17,7 @@ formatted ``SUBJECT_SAMPLE_FACTOR`` block and blocks of data between
 ``*_START`` and ``*_END``.
 """
 
-from __future__ import print_function, division, unicode_literals
+from __future__ import print_function, division, unicode_literals, annotations
 import io
 import sys
 import json
@@ -25,12 +25,13 @@ import re
 import copy
 from itertools import zip_longest
 
-import pandas
-
 from .tokenizer import tokenizer, _results_file_line_to_dict
 from .validator import validate_file
 from .mwschema import ms_required_schema, nmr_required_schema
 from .duplicates_dict import DuplicatesDict, DUPLICATE_KEY_REGEX
+from ._lazy import LazyModule
+
+pandas = LazyModule("pandas")
 
 SORT_KEYS = False
 INDENT = 4
@@ -11,21 +11,27 @@ identifiers are consistent across the file, and make sure that all
 required key-value pairs are present.
 """
 
+from __future__ import annotations
+
 from datetime import datetime
 from re import match
+import functools
+import hashlib
 import io
+import json
 import sys
 import traceback
 from collections.abc import Iterable
 
-import jsonschema
-import pandas
-
 from .mwschema import ms_required_schema, nmr_required_schema, METABOLITE_NA_VALUES
 from .mwschema import NA_VALUES as SCHEMA_NA_VALUES
 
 import mwtab
 from mwtab import metadata_column_matching
+from ._lazy import LazyModule
+
+jsonschema = LazyModule("jsonschema")
+pandas = LazyModule("pandas")
 
 column_finders = metadata_column_matching.column_finders
 NA_VALUES = metadata_column_matching.NA_VALUES
@@ -345,37 +351,41 @@ def validate_metabolites(mwtabfile, data_section_key, mwtabfile_tables):
     columns = {column:column.lower().strip() for column in df.columns}
     found_columns = {}
     columns_to_standard_columns = {}
-    for name, finder in column_finders.items():
-        if column_matches := finder.name_dict_match(columns):
-            found_columns[name] = column_matches
-            if name not in df.columns:
-                for column_name in column_matches:
-                    # We ignore if the column name is only off due to capitalization because lowering is common and easy.
-                    if column_name.lower() != name:
-                        message = (f'Warning: {format_column_name(column_name, df.columns.get_loc(column_name)+1)} '
-                                   f'in the {metabolites_location} table, '
-                                   f'matches a standard column name, "{name}". '
-                                   'If this match was not in error, the column should be renamed to '
-                                   'the standard name or a name that doesn\'t resemble the standard name.')
-                        metabolites_errors.append({'message': message, 'tags': ['value'], 'section': data_section_key, 'sub-section': 'Metabolites',
-                                                   'ID': '15', 'name': 'Standard Column Name Match'})
+    # A column can match more than one standard name, so only preprocess its values once.
+    prepared_columns = {}
+    for name, column_matches in metadata_column_matching.column_finder_set.dict_match(columns).items():
+        finder = column_finders[name]
+        found_columns[name] = column_matches
+        if name not in df.columns:
             for column_name in column_matches:
-                if column_name in columns_to_standard_columns:
-                    columns_to_standard_columns[column_name].append(name)
-                else:
-                    columns_to_standard_columns[column_name] = [name]
-                
-                value_mask = finder.values_series_match(df.loc[:, column_name].astype('string[pyarrow]'), na_values = NA_VALUES)
-                if not value_mask.all():
+                # We ignore if the column name is only off due to capitalization because lowering is common and easy.
+                if column_name.lower() != name:
                     message = (f'Warning: {format_column_name(column_name, df.columns.get_loc(column_name)+1)} '
                                f'in the {metabolites_location} table, '
-                               f'matches a standard column name, "{name}", '
-                               'and some of the values in the column do not match the expected type or format for that column. '
-                               'The non-matching values are:\n')
-                    message += df.loc[~value_mask, column_name].to_string()
+                               f'matches a standard column name, "{name}". '
+                               'If this match was not in error, the column should be renamed to '
+                               'the standard name or a name that doesn\'t resemble the standard name.')
                     metabolites_errors.append({'message': message, 'tags': ['value'], 'section': data_section_key, 'sub-section': 'Metabolites',
-                                               'ID': '16', 'name': 'METABOLITES Bad Standard Values'})
-    
+                                               'ID': '15', 'name': 'Standard Column Name Match'})
+        for column_name in column_matches:
+            if column_name in columns_to_standard_columns:
+                columns_to_standard_columns[column_name].append(name)
+            else:
+                columns_to_standard_columns[column_name] = [name]
+            
+            if column_name not in prepared_columns:
+                prepared_columns[column_name] = metadata_column_matching.PreparedColumn(df.loc[:, column_name].astype('string[pyarrow]'))
+            value_mask = finder.values_series_match(prepared_columns[column_name], na_values = NA_VALUES)
+            if not value_mask.all():
+                message = (f'Warning: {format_column_name(column_name, df.columns.get_loc(column_name)+1)} '
+                           f'in the {metabolites_location} table, '
+                           f'matches a standard column name, "{name}", '
+                           'and some of the values in the column do not match the expected type or format for that column. '
+                           'The non-matching values are:\n')
+                message += df.loc[~value_mask, column_name].to_string()
+                metabolites_errors.append({'message': message, 'tags': ['value'], 'section': data_section_key, 'sub-section': 'Metabolites',
+                                           'ID': '16', 'name': 'METABOLITES Bad Standard Values'})
+
     # When certain columns are found in METABOLITES, look for the implied pair and warn if it isn't there. 
     # For example, other_id and other_id_type and retention_index and retention_index_type.
     # Also check that they both have data in the same rows.
@@ -660,6 +670,41 @@ VALIDATOR_TO_TAG = {
     'uniqueItems': ['value'],
     'not': ['value']
     }
+def _not_keyword(base_not, validator, not_schema, instance, schema):
+    """The 'not' keyword, which also records the schema in a 'not': {'oneOf': [...]} that caused an error.
+    
+    'not': {'oneOf': [...]} fails when the instance is valid against exactly 1 of the schemas in the 'oneOf', 
+    so each schema is validated once, the same as the 'oneOf' itself would, and the one the instance is valid 
+    against is saved on the error as "not_oneOf_schema" for :func:`create_better_error_messages`. Any other 
+    'not' is validated by base_not, the 'not' of the validator class that was extended.
+    """
+    if not isinstance(not_schema, dict) or set(not_schema) != {'oneOf'}:
+        yield from base_not(validator, not_schema, instance, schema)
+        return
+    
+    valid_branches = []
+    for branch_schema in not_schema['oneOf']:
+        if validator.evolve(schema=branch_schema).is_valid(instance):
+            valid_branches.append(branch_schema)
+            if len(valid_branches) > 1:
+                return
+    if len(valid_branches) == 1:
+        error = jsonschema.ValidationError(f"{instance!r} should not be valid under {not_schema!r}")
+        error.not_oneOf_schema = valid_branches[0]
+        yield error
+
+
+#: The validator classes of schemas, extended with :func:`_not_keyword`, keyed by the class they extend.
+_VALIDATOR_CLASSES = {}
+def _validator_class(schema: dict) -> type:
+    """Return the validator class for schema, with the 'not' keyword replaced by :func:`_not_keyword`."""
+    base_class = jsonschema.validators.validator_for(schema)
+    if (validator_class := _VALIDATOR_CLASSES.get(base_class)) is None:
+        not_keyword = functools.partial(_not_keyword, base_class.VALIDATORS['not'])
+        validator_class = _VALIDATOR_CLASSES[base_class] = jsonschema.validators.extend(base_class, {'not': not_keyword})
+    return validator_class
+
+
 def create_better_error_messages(errors_generator: Iterable[jsonschema.exceptions.ValidationError], 
                                  mwtabfile: 'mwtab.mwtab.MWTabFile',
                                  schema: dict) -> list[str]:
@@ -704,22 +749,16 @@ def create_better_error_messages(errors_generator: Iterable[jsonschema.exception
         # This is for IONIZATION in the MS section. This code is a more generalized approach to determine 
         # which schema within a 'oneOf' is the one that actually triggered the validation error. It 
         # is probably overkill for this special case, but might be relevant in the future.
+        # The schema is found when the error is made by _not_keyword, so it doesn't have to be validated again.
         if validator == "not" and 'oneOf' in error.schema['not']:
-            real_schema_found = False
-            i = 0
-            while not real_schema_found and i < len(error.schema['not']['oneOf']):
-                try:
-                    jsonschema.validate(error.instance, {'not':error.schema['not']['oneOf'][i]})
-                except jsonschema.ValidationError as error2:
-                    real_schema_found = True
-                    custom_message_keys = [key for key in error2.schema['not'] if 'custom_message' in key]
-                    error.schema = error2.schema['not']
-                    if custom_message_keys:
-                        validator = match(r'(.*)_custom_message', custom_message_keys[0]).group(1)
-                    else:
-                        # Assuming that the schema is only a single keyword.
-                        validator = list(error2.schema['not'].keys())[0]
-                i += 1
+            if (branch_schema := getattr(error, 'not_oneOf_schema', None)) is not None:
+                custom_message_keys = [key for key in branch_schema if 'custom_message' in key]
+                error.schema = branch_schema
+                if custom_message_keys:
+                    validator = match(r'(.*)_custom_message', custom_message_keys[0]).group(1)
+                else:
+                    # Assuming that the schema is only a single keyword.
+                    validator = list(branch_schema.keys())[0]
         
         
         if custom_message_attr := error.schema.get(f'{validator}_custom_message'):
@@ -826,7 +865,7 @@ def validate_schema(mwtabfile, schema):
     :return: JSON Schema errors.
     :rtype: :py:class:`list`
     """
-    validator = jsonschema.validators.validator_for(schema)
+    validator = _validator_class(schema)
     format_checker = jsonschema.FormatChecker()
     validator = validator(schema=schema, format_checker=format_checker)
     # errors_generator = validator.iter_errors(mwtabfile)
@@ -991,10 +1030,271 @@ def validate_polarity(mwtabfile, data_section_key, mwtabfile_tables):
     return errors
 
 
+def _run_schema_rule(mwtabfile, context):
+    """Run the JSON schema validation, choosing the MS or NMR schema based on the file."""
+    errors = []
+    if 'NM' in mwtabfile:
+        errors.extend(validate_schema(mwtabfile, context['nmr_schema']))
+    else:
+        if 'MS' not in mwtabfile:
+            message = ('Error: No "MS" or "NM" section was found, '
+                       'so analysis type could not be determined. '
+                       'Mass spec will be assumed.')
+            errors.append({'message': message, 'tags': ['format'], 'section': None, 
+                           'sub-section': None, 'ID': '32', 'name': 'No MS or NM Section'})
+        errors.extend(validate_schema(mwtabfile, context['ms_schema']))
+    return errors
+
+def _run_metabolites_rule(mwtabfile, context):
+    """Run validate_metabolites, or report that the METABOLITES section is missing."""
+    data_section_key = context['data_section_key']
+    if data_section_key not in ("MS_METABOLITE_DATA", "NMR_METABOLITE_DATA"):
+        return []
+    
+    if "Metabolites" in mwtabfile[data_section_key].keys():
+        return validate_metabolites(mwtabfile, data_section_key, context['tables'])
+    
+    if mwtabfile._input_format == 'mwtab':
+        location = 'METABOLITES'
+    else:
+        location = f'["{data_section_key}"]["Metabolites"]'
+    message = f"Warning: Missing {location} section."
+    return [{'message': message, 'tags': ['format'], 'section': None, 
+             'sub-section': None, 'ID': '33', 'name': 'Missing METABOLITES Section'}]
+
+def _run_extended_rule(mwtabfile, context):
+    """Run validate_extended if there is an Extended table."""
+    data_section_key = context['data_section_key']
+    if "Extended" in mwtabfile[data_section_key].keys():
+        return validate_extended(mwtabfile, data_section_key, context['tables'])
+    return []
+
+
+#: Relative cost of each cost class. Lower cost rules are run first when stopping early.
+COST_CLASSES = {'low': 0, 'medium': 1, 'high': 2}
+
+class ValidationRule:
+    """A single check that :func:`validate_file` can run.
+    
+    Bundles a check with the error IDs it can produce, so callers can select 
+    which checks to run by the same 'ID' field that appears in the returned errors.
+    
+    Parameters:
+        name: A unique name for the rule.
+        check: A callable taking the mwtabfile and a context dictionary and returning a list of error dictionaries. 
+          The context has the keys "data_section_key", "tables", "ms_schema", and "nmr_schema".
+        IDs: The values of the 'ID' field in the errors this rule can produce.
+        cost: The cost class of the rule, one of the keys in ``COST_CLASSES``. "low" rules only look at 
+          metadata, "medium" rules run the JSON schema, and "high" rules work on the pandas tables.
+        needs_data_section: If True, the rule is only run when the file has a data section.
+        needs_tables: If True, the tables of the data section are converted to pandas DataFrames for this rule.
+        sections: The parts of the file the rule reads. Top level sections are given by their key, such as 
+          "SUBJECT_SAMPLE_FACTORS", and the tables in the data section by their table name, "Data", "Metabolites", 
+          or "Extended". "_parse" stands for the problems recorded while parsing, such as short headers. 
+          None means the rule reads the whole file. Used by :class:`ValidationCache` to decide when to re-run the rule.
+    
+    Attributes:
+        name: The name of the rule.
+        check: The callable that does the validation.
+        IDs: The error IDs this rule can produce.
+        cost: The cost class of the rule.
+        needs_data_section: Whether the rule is only run when the file has a data section.
+        needs_tables: Whether the rule needs the tables as pandas DataFrames.
+        sections: The parts of the file the rule reads, or None for the whole file.
+    """
+    def __init__(self, name: str, check, IDs: list[str], cost: str = 'low', needs_data_section: bool = False, needs_tables: bool = False, sections: list[str]|None = None):
+        if cost not in COST_CLASSES:
+            raise ValueError(f'Unknown cost class, "{cost}". It must be one of {list(COST_CLASSES)}.')
+        self.name = name
+        self.check = check
+        self.IDs = IDs
+        self.cost = cost
+        self.needs_data_section = needs_data_section
+        self.needs_tables = needs_tables
+        self.sections = sections
+    
+    def __call__(self, mwtabfile, context):
+        """Run the check and return its errors."""
+        return self.check(mwtabfile, context)
+
+
+# The order of this list is the order the rules run in and their errors are reported.
+VALIDATION_RULES = [
+    ValidationRule('schema', _run_schema_rule, ['24', '32'], 'medium'),
+    ValidationRule('subject_sample_factors', lambda mwtabfile, context: validate_subject_samples_factors(mwtabfile), 
+                   ['4', '5', '6'], sections=['SUBJECT_SAMPLE_FACTORS']),
+    ValidationRule('factors', lambda mwtabfile, context: validate_factors(mwtabfile), ['3'], 
+                   sections=['SUBJECT_SAMPLE_FACTORS', 'Data']),
+    ValidationRule('data', lambda mwtabfile, context: validate_data(mwtabfile, context['data_section_key'], context['tables']), 
+                   ['7', '8', '9', '10', '11'], 'high', needs_data_section=True, needs_tables=True, 
+                   sections=['SUBJECT_SAMPLE_FACTORS', 'Data', 'Metabolites']),
+    ValidationRule('metabolites', _run_metabolites_rule, 
+                   ['12', '13', '14', '15', '16', '17', '18', '19', '20', '33'], 'high', needs_data_section=True, needs_tables=True,
+                   sections=['Data', 'Metabolites']),
+    ValidationRule('extended', _run_extended_rule, ['21', '22', '35', '36'], 'high', needs_data_section=True, needs_tables=True, 
+                   sections=['SUBJECT_SAMPLE_FACTORS', 'Extended']),
+    ValidationRule('metabolite_names', lambda mwtabfile, context: validate_metabolite_names(mwtabfile, context['data_section_key']), 
+                   ['23'], needs_data_section=True, sections=['Data', 'Metabolites', 'Extended']),
+    ValidationRule('table_values', lambda mwtabfile, context: validate_table_values(mwtabfile, context['data_section_key'], context['tables']), 
+                   ['25', '26', '27', '28', '29', '30', '34'], 'high', needs_data_section=True, needs_tables=True, 
+                   sections=['Data', 'Metabolites', 'Extended']),
+    ValidationRule('polarity', lambda mwtabfile, context: validate_polarity(mwtabfile, context['data_section_key'], context['tables']), 
+                   ['31'], 'high', needs_data_section=True, needs_tables=True, sections=['Metabolites']),
+    ValidationRule('header_lengths', lambda mwtabfile, context: validate_header_lengths(mwtabfile), ['2'], sections=['_parse']),
+    ValidationRule('sub_section_uniqueness', lambda mwtabfile, context: validate_sub_section_uniqueness(mwtabfile), ['1'], 
+                   sections=['_parse']),
+]
+VALIDATION_RULES = {rule.name: rule for rule in VALIDATION_RULES}
+
+# The attributes set while parsing that rules read along with each table.
+_TABLE_ATTRIBUTES = {
+    'Data': ['_samples', '_raw_samples', '_binned_header', '_raw_binned_header', '_factors'],
+    'Metabolites': ['_metabolite_header', '_raw_metabolite_header'],
+    'Extended': ['_extended_metabolite_header', '_raw_extended_metabolite_header'],
+}
+
+def _hash_content(content) -> str:
+    """Return a hash of JSON serializable content."""
+    return hashlib.blake2b(json.dumps(content, default=repr).encode('utf-8'), digest_size=16).hexdigest()
+
+def _section_hash(mwtabfile: 'mwtab.mwtab.MWTabFile', section: str, data_section_key: str|None) -> str:
+    """Return a hash of the content of a section, table, or "_parse" as named in ValidationRule.sections."""
+    if section == '_parse':
+        content = [sorted(mwtabfile._short_headers), mwtabfile._duplicate_sub_sections]
+    elif section in _TABLE_ATTRIBUTES:
+        table = mwtabfile[data_section_key].get(section) if data_section_key else None
+        content = [table] + [getattr(mwtabfile, attribute) for attribute in _TABLE_ATTRIBUTES[section]]
+    else:
+        content = mwtabfile.get(section)
+    return _hash_content(content)
+
+
+class ValidationCache:
+    """Holds the errors from previous validations so rules whose sections have not changed are not re-run.
+    
+    Pass the same instance to :func:`validate_file` each time a file is re-validated. 
+    Each rule's errors are stored with a key built from content hashes of the sections 
+    listed in :attr:`ValidationRule.sections`, so after a section is edited only the 
+    rules that read it are run again and the stored errors are reused for the rest. 
+    Only the most recent result of each rule is kept.
+    
+    Examples:
+        >>> cache = ValidationCache()
+        >>> _, errors = validate_file(mwtabfile, cache=cache)
+        >>> mwtabfile['SUBJECT_SAMPLE_FACTORS'][0]['Sample ID'] = 'new_id'
+        >>> _, errors = validate_file(mwtabfile, cache=cache)
+        
+        The second call only re-runs the rules that read SUBJECT_SAMPLE_FACTORS.
+    
+    Attributes:
+        entries: A dictionary of rule names to a tuple of the key and the errors for that rule.
+        hits: The number of times a rule's errors were reused.
+        misses: The number of times a rule had to be run.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def key(self, rule: ValidationRule, mwtabfile: 'mwtab.mwtab.MWTabFile', context: dict, section_hashes: dict) -> tuple:
+        """Build the key for a rule from the content of the sections it reads.
+        
+        Args:
+            rule: The rule to build a key for.
+            mwtabfile: The file being validated.
+            context: The context given to rules. The data section key and schemas are part of the key.
+            section_hashes: A dictionary to reuse section hashes in, so each section is only hashed once per validation.
+        
+        Returns:
+            A tuple that is equal for 2 validations only if the rule would give the same errors.
+        """
+        if rule.sections is None:
+            if None not in section_hashes:
+                section_hashes[None] = _hash_content([mwtabfile] + [getattr(mwtabfile, attribute) 
+                                                                    for attributes in _TABLE_ATTRIBUTES.values() 
+                                                                    for attribute in attributes])
+            hashes = (section_hashes[None],)
+        else:
+            for section in rule.sections:
+                if section not in section_hashes:
+                    section_hashes[section] = _section_hash(mwtabfile, section, context['data_section_key'])
+            hashes = tuple(section_hashes[section] for section in rule.sections)
+        
+        return (mwtabfile._input_format, context['data_section_key'], 
+                id(context['ms_schema']), id(context['nmr_schema'])) + hashes
+    
+    def get(self, rule_name: str, key: tuple) -> list[dict]|None:
+        """Return a copy of the stored errors for the rule if the key matches, None otherwise."""
+        if (entry := self.entries.get(rule_name)) and entry[0] == key:
+            self.hits += 1
+            return [dict(error) for error in entry[1]]
+        self.misses += 1
+        return None
+    
+    def set(self, rule_name: str, key: tuple, errors: list[dict]):
+        """Store the errors for the rule under the key, replacing any previous entry."""
+        self.entries[rule_name] = (key, [dict(error) for error in errors])
+    
+    def clear(self):
+        """Remove all stored errors."""
+        self.entries = {}
+
+
+#: Named sets of rules for validate_file. None means every rule.
+VALIDATION_PROFILES = {
+    'quick': ['schema', 'subject_sample_factors', 'factors'],
+    'full': None,
+}
+
+
+def _select_rules(profile: str, include: list[str]|None, exclude: list[str]|None, 
+                  cost_order: bool) -> tuple[list[ValidationRule], set[str]]:
+    """Determine which rules to run and which error IDs to report.
+    
+    Args:
+        profile: A key in VALIDATION_PROFILES.
+        include: Error IDs to check in addition to the ones in the profile.
+        exclude: Error IDs to not check or report.
+        cost_order: If True, order the rules from cheapest to most expensive, otherwise keep the order of VALIDATION_RULES.
+    
+    Returns:
+        The list of rules in the order they should be run and the set of error IDs to report.
+    """
+    if profile not in VALIDATION_PROFILES:
+        raise ValueError(f'Unknown validation profile, "{profile}". It must be one of {list(VALIDATION_PROFILES)}.')
+    
+    rule_names = VALIDATION_PROFILES[profile]
+    if rule_names is None:
+        rule_names = list(VALIDATION_RULES)
+    
+    known_IDs = {ID for rule in VALIDATION_RULES.values() for ID in rule.IDs}
+    unknown_IDs = set(include if include else []) | set(exclude if exclude else [])
+    unknown_IDs = unknown_IDs - known_IDs
+    if unknown_IDs:
+        raise ValueError(f'Unknown validation ID(s): {sorted(unknown_IDs)}.')
+    
+    selected_IDs = {ID for name in rule_names for ID in VALIDATION_RULES[name].IDs}
+    if include:
+        selected_IDs.update(include)
+    if exclude:
+        selected_IDs.difference_update(exclude)
+    
+    rules = [rule for rule in VALIDATION_RULES.values() if selected_IDs.intersection(rule.IDs)]
+    if cost_order:
+        rules = sorted(rules, key=lambda rule: COST_CLASSES[rule.cost])
+    
+    return rules, selected_IDs
+
+
 def validate_file(mwtabfile: 'mwtab.mwtab.MWTabFile', 
                   ms_schema: dict = ms_required_schema,
                   nmr_schema: dict = nmr_required_schema,
-                  verbose: bool = False) -> (str, list[dict]):
+                  verbose: bool = False,
+                  profile: str = 'full',
+                  include: list[str]|None = None,
+                  exclude: list[str]|None = None,
+                  max_errors: int|None = None,
+                  cache: ValidationCache|None = None) -> (str, list[dict]):
     """Validate ``mwTab`` formatted file.
     
     Note that some of the validations are pretty strict to account for the majority of cases, 
@@ -1006,15 +1306,30 @@ def validate_file(mwtabfile: 'mwtab.mwtab.MWTabFile',
     describe the COLUMN_PRESSURE, and would be valid. So in these kinds of situations 
     the warning printed can safely be ignored.
     
+    The checks that are run are the rules in ``VALIDATION_RULES``. Which ones run can be 
+    narrowed with a profile from ``VALIDATION_PROFILES`` and adjusted with the include 
+    and exclude parameters, which take the same values as the 'ID' field of the returned 
+    errors. The "quick" profile only runs the schema and SUBJECT_SAMPLE_FACTORS checks 
+    and never converts the tables to pandas DataFrames.
+    
     Args:
         mwtabfile: The file to be validated.
         ms_schema: jsonschema to validate both the base parts of the file and the MS specific parts of the file.
         nmr_schema: jsonschema to validate both the base parts of the file and the NMR specific parts of the file.
         verbose: whether to be verbose or not.
+        profile: The name of the profile in VALIDATION_PROFILES to use.
+        include: Error IDs to check in addition to the ones in the profile.
+        exclude: Error IDs to not check or report.
+        max_errors: If given, stop validating once this many errors have been found. Rules are run 
+                    from cheapest to most expensive in this case, and only the first max_errors errors are returned.
+        cache: If given, rules whose sections have not changed since the last validation with this cache 
+               are not run again and their previous errors are reused.
     
     Returns:
         Error messages as a single string and error messages in JSON form. If verbose is True, then the single string will be None.
     """
+    rules, selected_IDs = _select_rules(profile, include, exclude, max_errors is not None)
+    
     # setup
     if not verbose:
         error_stout = io.StringIO()
@@ -1036,57 +1351,44 @@ def validate_file(mwtabfile: 'mwtab.mwtab.MWTabFile',
     # create list to collect validation errors
     errors = list()
     
-    # Get tables as dataframes.
-    mwtabfile_tables = {}
-    for table_name in mwtabfile.table_names:
-        mwtabfile_tables[table_name] = mwtabfile.get_table_as_pandas(table_name)
-    
-    if 'NM' in mwtabfile:
-        errors.extend(validate_schema(mwtabfile, nmr_schema))
-    else:
-        if 'MS' not in mwtabfile:
-            message = ('Error: No "MS" or "NM" section was found, '
-                       'so analysis type could not be determined. '
-                       'Mass spec will be assumed.')
-            errors.append({'message': message, 'tags': ['format'], 'section': None, 
-                           'sub-section': None, 'ID': '32', 'name': 'No MS or NM Section'})
-        errors.extend(validate_schema(mwtabfile, ms_schema))
-    
-    # validate SUBJECT_SAMPLE_FACTORS
-    errors.extend(validate_subject_samples_factors(mwtabfile))
-    errors.extend(validate_factors(mwtabfile))
-
-    # validate ..._DATA sections
     data_section_key = mwtabfile.data_section_key
-    if data_section_key:
-        errors.extend(validate_data(mwtabfile, data_section_key, mwtabfile_tables))
-
-        if data_section_key in ("MS_METABOLITE_DATA", "NMR_METABOLITE_DATA"):
-            if "Metabolites" in mwtabfile[data_section_key].keys():
-                errors.extend(validate_metabolites(mwtabfile, data_section_key, mwtabfile_tables))
-            else:
-                if mwtabfile._input_format == 'mwtab':
-                    location = 'METABOLITES'
-                else:
-                    location = f'["{data_section_key}"]["Metabolites"]'
-                message = f"Warning: Missing {location} section."
-                errors.append({'message': message, 'tags': ['format'], 'section': None, 
-                               'sub-section': None, 'ID': '33', 'name': 'Missing METABOLITES Section'})
+    context = {'data_section_key': data_section_key, 'tables': None, 
+               'ms_schema': ms_schema, 'nmr_schema': nmr_schema}
+    
+    stopped_early = False
+    section_hashes = {}
+    for rule in rules:
+        if rule.needs_data_section and not data_section_key:
+            continue
         
-        if "Extended" in mwtabfile[data_section_key].keys():
-            errors.extend(validate_extended(mwtabfile, data_section_key, mwtabfile_tables))
+        rule_errors = None
+        if cache is not None:
+            cache_key = cache.key(rule, mwtabfile, context, section_hashes)
+            rule_errors = cache.get(rule.name, cache_key)
         
-        errors.extend(validate_metabolite_names(mwtabfile, data_section_key))
-        errors.extend(validate_table_values(mwtabfile, data_section_key, mwtabfile_tables))
-        errors.extend(validate_polarity(mwtabfile, data_section_key, mwtabfile_tables))
-    
-    errors.extend(validate_header_lengths(mwtabfile))
-    errors.extend(validate_sub_section_uniqueness(mwtabfile))
+        if rule_errors is None:
+            # Get tables as dataframes, but only if a rule needs them.
+            if rule.needs_tables and context['tables'] is None:
+                context['tables'] = {table_name: mwtabfile.get_table_as_pandas(table_name) 
+                                     for table_name in mwtabfile.table_names}
+            
+            rule_errors = rule(mwtabfile, context)
+            if cache is not None:
+                cache.set(rule.name, cache_key, rule_errors)
+        
+        errors.extend(error for error in rule_errors if error['ID'] in selected_IDs)
+        
+        if max_errors is not None and len(errors) >= max_errors:
+            stopped_early = True
+            errors = errors[:max_errors]
+            break
     
 
     # finish writing validation/error log
     if errors:
         print("Status: Contains Validation Issues", file=error_stout)
+        if stopped_early:
+            print("Validation stopped early after reaching the maximum number of issues.", file=error_stout)
         print("Number of Issues: {}\n".format(len(errors)), file=error_stout)
         tags = []
         warning_count = 0
@@ -1,16 +1,18 @@
 from __future__ import unicode_literals
+import ast
 import csv
 import json
 import mwtab
 import os
 import pytest
 import time
+import urllib.error
 import pathlib
 import subprocess
 
 from fixtures import teardown_module
 
-from mwtab import cli
+from mwtab import cli, mwindex
 
 teardown_module = teardown_module
 
@@ -312,6 +314,144 @@ def test_download_all_download_error(teardown_module, disable_network_calls, dis
     assert 'AN000002' in captured.out
     assert 'Something went wrong and AN000001 could not be downloaded.' in captured.out
 
+def test_download_all_workers_and_retries(teardown_module, disable_network_calls, disable_sleep, capsys, mocker):
+    cmdargs = {
+        '--verbose': False,
+        '--force': False,
+        '--silent': False,
+        '--mw-rest': 'https://www.metabolomicsworkbench.org/rest/',
+        'convert': False,
+        'validate': False,
+        'download': True,
+        '<url>': None,
+        'study': True,
+        'all': True,
+        '--input-item': 'analysis_id',
+        '--workers': '3',
+        '--rate': '100',
+        '--burst': '2',
+        '--retries': '1'
+        }
+    an_ids = ['AN00000' + str(i) for i in range(1, 7)]
+    mocker.patch('mwtab.cli.mwrest.analysis_ids', side_effect = [an_ids])
+    attempts = []
+    def download(rest_params, *args):
+        attempts.append(rest_params['input_value'])
+        # Each ID fails with a transient error the first time, and AN000001 always fails.
+        if attempts.count(rest_params['input_value']) == 1 or rest_params['input_value'] == 'AN000001':
+            raise urllib.error.URLError('timed out')
+    mocker.patch('mwtab.cli.download_and_save_mwrest_file', side_effect = download)
+    
+    cli.cli(cmdargs)
+    captured = capsys.readouterr()
+    assert sorted(attempts) == sorted(an_ids * 2)
+    assert 'Something went wrong and AN000001 could not be downloaded.' in captured.out
+    assert 'AN000002 could not be downloaded' not in captured.out
+
+def test_mirror_command(tmp_path, disable_network_calls, disable_sleep, capsys, mocker):
+    cmdargs = {
+        '--verbose': False,
+        '--force': False,
+        '--silent': False,
+        '--mw-rest': 'https://www.metabolomicsworkbench.org/rest/',
+        'convert': False,
+        'validate': False,
+        'download': False,
+        'extract': False,
+        'index': False,
+        'query': False,
+        'mirror': True,
+        '<mirror-path>': str(tmp_path),
+        '--output-format': 'json',
+        '--workers': '2'
+        }
+    mocker.patch('mwtab.mwmirror.mwrest._pull_analysis_records', 
+                 return_value = {'1': {'study_id': 'ST000001', 'analysis_id': 'AN000001'}})
+    mocker.patch('mwtab.mwmirror.MWTabMirror._download', 
+                 return_value = {'study_id': 'ST000001', 'analysis_id': 'AN000001', 'file': 'ST000001_AN000001.json'})
+    
+    cli.cli(cmdargs)
+    assert 'Downloaded 1 analyses, 0 unchanged, 0 failed, 0 no longer listed.' in capsys.readouterr().out
+    assert (tmp_path / 'manifest.json').exists()
+
+def test_download_default_rate():
+    """Without --rate, downloads are no faster than the 1 every 3 seconds of the old sleep between downloads."""
+    import docopt
+    import inspect
+    for argv in (["download", "study", "all"], ["mirror", "path"], ["download", "batch", "refmet", "name", "values.txt", "all"]):
+        assert docopt.docopt(cli.__doc__, argv=argv)["--rate"] is None
+    assert mwtab.mwrest.DEFAULT_RATE == 1 / 3
+    for function in (cli.download_and_save_ID_list, cli.download_and_save_batch, mwtab.mwrest.batch_query, mwtab.mwmirror.MWTabMirror.sync):
+        assert inspect.signature(function).parameters["rate"].default == mwtab.mwrest.DEFAULT_RATE
+        assert inspect.signature(function).parameters["burst"].default == 1
+
+
+def test_download_batch(tmp_path, disable_network_calls, disable_sleep, capsys, mocker):
+    values_path = tmp_path / 'names.txt'
+    values_path.write_text('Glucose\nCitric acid\n\nGlucose\n')
+    cmdargs = {
+        '--verbose': True,
+        '--force': False,
+        '--silent': False,
+        '--mw-rest': 'https://www.metabolomicsworkbench.org/rest/',
+        'convert': False,
+        'validate': False,
+        'download': True,
+        '<url>': None,
+        'study': False,
+        'batch': True,
+        'refmet': True,
+        '<input-item>': 'name',
+        '<values-path>': str(values_path),
+        '<output-item>': 'formula',
+        '--to-path': str(tmp_path / 'output'),
+        '--cache': str(tmp_path / 'cache.json'),
+        '--rate': '100'
+        }
+    batch_query = mocker.patch('mwtab.cli.mwrest.batch_query', return_value = ({'Glucose': {'formula': 'C6H12O6'}}, 
+                                                                                {'Citric acid': urllib.error.URLError('timed out')}))
+    
+    cli.cli(cmdargs)
+    args, kwds = batch_query.call_args
+    assert args[:5] == ('refmet', 'name', ['Glucose', 'Citric acid', 'Glucose'], 'formula', 'json')
+    assert kwds['rate'] == 100
+    with open(tmp_path / 'output' / 'refmet_name_formula.json') as fh:
+        assert json.load(fh) == {'Glucose': {'formula': 'C6H12O6'}}
+    assert (tmp_path / 'cache.json').exists()
+    captured = capsys.readouterr()
+    assert 'Something went wrong and Citric acid could not be downloaded.' in captured.out
+    assert 'for 2 distinct value(s)' in captured.out
+
+def test_download_batch_refmet(tmp_path, disable_network_calls, disable_sleep, mocker):
+    refmet_path = str(tmp_path / 'refmet.json')
+    mwtab.mwrefmet.RefMetDictionary([{'name': 'Glucose', 'formula': 'C6H12O6'}]).save(refmet_path)
+    values_path = tmp_path / 'names.json'
+    values_path.write_text('["glucose", "Sucrose"]')
+    cmdargs = {
+        '--verbose': False,
+        '--force': False,
+        '--silent': False,
+        '--mw-rest': 'https://www.metabolomicsworkbench.org/rest/',
+        'convert': False,
+        'validate': False,
+        'download': True,
+        '<url>': None,
+        'study': False,
+        'batch': True,
+        'refmet': True,
+        '<input-item>': 'name',
+        '<values-path>': str(values_path),
+        '<output-item>': 'formula',
+        '--to-path': str(tmp_path / 'output.json'),
+        '--refmet': refmet_path
+        }
+    batch_query = mocker.patch('mwtab.cli.mwrest.batch_query')
+    
+    cli.cli(cmdargs)
+    assert not batch_query.called
+    with open(tmp_path / 'output.json') as fh:
+        assert json.load(fh) == {'glucose': {'formula': 'C6H12O6'}, 'Sucrose': None}
+
 def test_download_all_bad_input_item(teardown_module, disable_network_calls, disable_sleep):
     cmdargs = {
         '--verbose': True,
@@ -594,6 +734,62 @@ def test_extract_metabolites_stdout():
     assert '{\n    "17-hydroxypregnenolone": {\n        "ST000122": {' in subp.stdout
 
 
+@pytest.mark.parametrize("arguments", [
+    "metabolites tests/example_data/mwtab_files/ - SU:SUBJECT_TYPE Human --to-format=json",
+    "metadata tests/example_data/mwtab_files/ - SUBJECT_TYPE INSTRUMENT_TYPE --to-format=json"
+])
+def test_extract_jobs(arguments):
+    """Test that extracting with multiple processes prints the same thing as extracting in 1."""
+    command = "python -m mwtab extract " + arguments
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    parallel_subp = subprocess.run((command + " --jobs=2").split(" "), capture_output=True, encoding="UTF-8")
+    assert parallel_subp.returncode == 0
+    # Sets are printed in hash order, which is different for every process, so compare them unordered.
+    def normalize(value):
+        if isinstance(value, dict):
+            return {key: normalize(val) for key, val in value.items()}
+        return set(value)
+    assert normalize(ast.literal_eval(parallel_subp.stdout)) == normalize(ast.literal_eval(subp.stdout))
+
+
+@pytest.mark.parametrize("arguments, message", [
+    ("metabolites tests/example_data/mwtab_files/ - SU:SUBJECT_TYPE Human --jobs=0", '--jobs must be a whole number of at least 1, not "0".'),
+    ("metadata tests/example_data/mwtab_files/ - SUBJECT_TYPE --jobs=-2", '--jobs must be a whole number of at least 1, not "-2".'),
+    ("metadata tests/example_data/mwtab_files/ - SUBJECT_TYPE --jobs=two", '--jobs must be a whole number of at least 1, not "two".'),
+    ("metadata tests/example_data/mwtab_files/ - SUBJECT_TYPE --jobs=2 --index=tests/example_data/tmp/jobs_index.sqlite",
+     "--jobs can't be used with --index, the index is updated in a single process."),
+])
+def test_extract_jobs_errors(arguments, message):
+    command = "python -m mwtab extract " + arguments
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 1
+    assert subp.stderr.strip() == message
+
+
+def test_extract_metabolites_jsonl(teardown_module):
+    """Test that metabolites written as JSON Lines have the same values as JSON."""
+    command = "python -m mwtab extract metabolites tests/example_data/mwtab_files/ tests/example_data/tmp/metabolites SU:SUBJECT_TYPE Human --to-format="
+    assert subprocess.run((command + "json").split(" ")).returncode == 0
+    assert subprocess.run((command + "jsonl").split(" ")).returncode == 0
+    
+    with open("tests/example_data/tmp/metabolites.json") as f:
+        expected = json.load(f)
+    with open("tests/example_data/tmp/metabolites.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["metabolite"] for record in records] == sorted(expected)
+    for record in records:
+        for study, analyses in record["studies"].items():
+            for analysis, samples in analyses.items():
+                assert sorted(samples) == sorted(expected[record["metabolite"]][study][analysis])
+
+
+def test_extract_metadata_jsonl():
+    command = "python -m mwtab extract metadata tests/example_data/mwtab_files/ - SUBJECT_TYPE --to-format=jsonl"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert subp.stdout.splitlines() == ['{"analysis_id": "AN000204", "metadata": {"SUBJECT_TYPE": ["Human"]}, "study_id": "ST000122"}'] * 2
+
+
 def test_extract_metabolites_error_recovery(teardown_module):
     """Test that the extract metabolites command can recover from an error."""
     command = "python -m mwtab extract metabolites tests/example_data/files_to_test_error_recovery tests/example_data/tmp/ SU:SUBJECT_TYPE Human"
@@ -624,3 +820,133 @@ def test_extract_metabolites_no_data_extracted(teardown_module):
             "Check your key value pairs and data.") in subp.stdout
 
 
+
+
+def test_index_and_query_commands(teardown_module):
+    command = "python -m mwtab index tests/example_data/mwtab_files/ tests/example_data/tmp/index.sqlite"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert "Indexed 2 file(s), 0 file(s) unchanged, 0 file(s) removed." in subp.stdout
+    
+    command = "python -m mwtab query metabolite tests/example_data/tmp/index.sqlite - Cortisol"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert '{\n    "Cortisol": {\n        "ST000122": {' in subp.stdout
+    
+    command = "python -m mwtab query metabolite tests/example_data/tmp/index.sqlite tests/example_data/tmp/query.csv Cortisol --to-format=csv"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    with open("tests/example_data/tmp/query.csv", "r") as fh:
+        data = list(csv.reader(fh))
+    assert data[1] == ['Cortisol', '1', '1', '42']
+    
+    command = "python -m mwtab query metabolite tests/example_data/tmp/index.sqlite - NotAMetabolite"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert "None of the metabolites were found in the index. No file was saved." in subp.stdout
+    
+    command = "python -m mwtab query identifier tests/example_data/tmp/index.sqlite tests/example_data/tmp/identifiers.csv 5754 --id-type=pubchem_id --to-format=csv"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    with open("tests/example_data/tmp/identifiers.csv", "r") as fh:
+        data = list(csv.reader(fh))
+    assert data[0] == ["query", "id_type", "identifier", "study_id", "analysis_id", "metabolite", "row"]
+    assert data[1:] == [["5754", "pubchem_id", "5754", "ST000122", "AN000204", "Cortisol", "8"]] * 2
+    
+    command = "python -m mwtab query identifier tests/example_data/tmp/index.sqlite - C99999"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert "None of the identifiers were found in the index. No file was saved." in subp.stdout
+    
+    command = ["python", "-m", "mwtab", "query", "samples", "tests/example_data/tmp/index.sqlite", "tests/example_data/tmp/samples.csv", 
+               "tissue/fluid:serum AND NOT tissue/fluid:plasma", "--to-format=csv", "--ignore-case"]
+    subp = subprocess.run(command, capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    with open("tests/example_data/tmp/samples.csv", "r") as fh:
+        data = list(csv.reader(fh))
+    assert data[0] == ["study_id", "analysis_id", "sample_id"]
+    assert len(data) == 43
+    assert data[1][:2] == ["ST000122", "AN000204"]
+    
+    command = ["python", "-m", "mwtab", "query", "samples", "tests/example_data/tmp/index.sqlite", "-", "Tissue/Fluid:Plasma"]
+    subp = subprocess.run(command, capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert "No samples matched the query in the index. No file was saved." in subp.stdout
+    
+    for query, message in [("NOT (", 'The sample query, "NOT (", ended unexpectedly.'),
+                           ("(Treatment:Control", 'Missing ")" in the sample query, "(Treatment:Control".')]:
+        command = ["python", "-m", "mwtab", "query", "samples", "tests/example_data/tmp/index.sqlite", "-", query]
+        subp = subprocess.run(command, capture_output=True, encoding="UTF-8")
+        assert subp.returncode == 1
+        assert subp.stderr.strip() == message
+
+
+def test_duplicates_command(teardown_module):
+    command = "python -m mwtab duplicates tests/example_data/mwtab_files/ -"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert json.loads(subp.stdout) == [{"analysis_id_1": "AN000204",
+                                        "analysis_id_2": "AN000204 (tests/example_data/mwtab_files/ST000122_AN000204.txt)",
+                                        "similarity": 1.0}]
+    
+    command = "python -m mwtab duplicates tests/example_data/mwtab_files/ tests/example_data/tmp/duplicates.csv --to-format=csv --include-samples --similarity=0.95"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    with open("tests/example_data/tmp/duplicates.csv", "r") as fh:
+        data = list(csv.reader(fh))
+    assert data[0] == ["analysis_id_1", "analysis_id_2", "similarity"]
+    assert data[1][2] == "1.0"
+
+
+def test_extract_metadata_index_and_query_commands(teardown_module):
+    command = "python -m mwtab extract metadata tests/example_data/mwtab_files/ - SUBJECT_TYPE --index=tests/example_data/tmp/index.sqlite"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert "{'SUBJECT_TYPE': {'Human'}}" in subp.stdout
+    
+    command = "python -m mwtab query metadata tests/example_data/tmp/index.sqlite tests/example_data/tmp/metadata.json SU:SUBJECT_ --match=prefix"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    with open("tests/example_data/tmp/metadata.json", "r") as fh:
+        assert json.load(fh) == {"SUBJECT:SUBJECT_SPECIES": ["Homo sapiens"], "SUBJECT:SUBJECT_TYPE": ["Human"]}
+    
+    command = "python -m mwtab query metadata tests/example_data/tmp/index.sqlite - NOT_A_KEY"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    assert "None of the metadata keys were found in the index. No file was saved." in subp.stdout
+    
+    # An index built with another threshold keeps it and isn't rebuilt.
+    command = "python -m mwtab index tests/example_data/mwtab_files/ tests/example_data/tmp/threshold_index.sqlite --threshold=1"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    command = "python -m mwtab extract metadata tests/example_data/mwtab_files/ - SUBJECT_TYPE --index=tests/example_data/tmp/threshold_index.sqlite"
+    subp = subprocess.run(command.split(" "), capture_output=True, encoding="UTF-8")
+    assert subp.returncode == 0
+    with mwindex.MWTabIndex("tests/example_data/tmp/threshold_index.sqlite") as index:
+        assert index.threshold == 1
+        assert index.update("tests/example_data/mwtab_files/")["indexed"] == 0
+
+
+def test_serve_command(teardown_module):
+    # Keep the token file out of the real home directory.
+    env = dict(os.environ, HOME=os.path.abspath("tests/example_data/tmp"))
+    server = subprocess.Popen(["python", "-m", "mwtab", "serve", "--port=0", "--workers=1"], stdout=subprocess.PIPE, encoding="UTF-8", env=env)
+    try:
+        address = server.stdout.readline().strip().split("Serving on ")[-1]
+        assert address.startswith("http://127.0.0.1:")
+        
+        command = ["python", "-m", "mwtab", "validate", "tests/example_data/mwtab_files/ST000122_AN000204.json",
+                   "--to-path=tests/example_data/tmp/served_validation.json", "--silent", "--server=" + address]
+        subp = subprocess.run(command, capture_output=True, encoding="UTF-8", env=env)
+        assert subp.returncode == 0
+        with open("tests/example_data/tmp/served_validation.json", "r") as fh:
+            assert list(json.load(fh)) == ["ST000122_AN000204"]
+    finally:
+        server.terminate()
+        assert server.wait(timeout=30) == 0
+        server.stdout.close()
+    
+    command = ["python", "-m", "mwtab", "validate", "tests/example_data/mwtab_files/ST000122_AN000204.json", "--server=" + address]
+    subp = subprocess.run(command, capture_output=True, encoding="UTF-8", env=env)
+    assert subp.returncode == 1
+    assert "Could not connect to the mwtab server at " + address in subp.stderr
@@ -0,0 +1,136 @@
+import gzip
+import http.server
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mwtab import fileio
+from mwtab.httpsession import HTTPSession
+
+
+BODY = b"#METABOLOMICS WORKBENCH STUDY_ID:ST000001 ANALYSIS_ID:AN000001\n" * 100
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """A local stand-in for the Metabolomics Workbench that counts connections and gzips if asked."""
+    protocol_version = "HTTP/1.1"
+    # Otherwise the separate header and body writes wait on delayed ACKs when the connection is kept open.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.accept_encodings.append(self.headers.get("Accept-Encoding"))
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/file")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/missing":
+            self.send_response(404)
+            self.send_header("Content-Length", "9")
+            self.end_headers()
+            self.wfile.write(b"not found")
+            return
+
+        body = BODY
+        self.send_response(200)
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        if self.path == "/close":
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.connections = 0
+    server.accept_encodings = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path):
+    return "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+
+
+def test_connections_are_reused(server):
+    with HTTPSession() as session:
+        for _ in range(5):
+            with session.urlopen(url(server, "/file")) as response:
+                assert response.status == 200
+                assert response.read() == BODY
+        assert session.requests == 5
+        assert session.connections_opened == 1
+    assert server.connections == 1
+    assert server.accept_encodings == ["gzip"] * 5
+
+    # urllib opens a new connection for every request.
+    for _ in range(5):
+        with urllib.request.urlopen(url(server, "/file")) as response:
+            response.read()
+    assert server.connections == 6
+
+
+def test_closed_connections(server):
+    with HTTPSession() as session:
+        for _ in range(3):
+            with session.urlopen(url(server, "/close")) as response:
+                assert response.read() == BODY
+        assert session.connections_opened == 3
+
+        # A response that isn't read completely can't give its connection back.
+        with session.urlopen(url(server, "/file"), {"Accept-Encoding": "identity"}) as response:
+            response.read(10)
+        with session.urlopen(url(server, "/file")) as response:
+            assert response.read() == BODY
+        assert session.connections_opened == 5
+
+
+def test_stale_connection(server):
+    with HTTPSession() as session:
+        with session.urlopen(url(server, "/file")) as response:
+            response.read()
+        # Close the idle connection from the server's side.
+        for connection in session._idle[("http", "127.0.0.1", server.server_address[1])]:
+            connection.sock.shutdown(2)
+        with session.urlopen(url(server, "/file")) as response:
+            assert response.read() == BODY
+        assert session.connections_opened == 2
+
+
+def test_redirects_and_errors(server):
+    with HTTPSession() as session:
+        with session.urlopen(url(server, "/redirect")) as response:
+            assert response.read() == BODY
+            assert response.url.endswith("/file")
+
+        with pytest.raises(urllib.error.HTTPError, match = "HTTP Error 404") as e:
+            session.urlopen(url(server, "/missing"))
+        assert e.value.read() == b"not found"
+        assert session.connections_opened == 1
+
+    with HTTPSession(timeout=5) as session:
+        with pytest.raises(urllib.error.URLError, match = "urlopen error"):
+            session.urlopen("http://127.0.0.1:1/file")
+
+
+def test_fileio_uses_session(server):
+    mwrestfile = next(fileio.read_mwrest(url(server, "/file")))
+    assert mwrestfile.text == BODY.decode("utf-8")
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+#: Packages that take most of the import time, which shouldn't be imported until they are used.
+#: http.client and urllib.request are only needed to open URLs.
+HEAVY_MODULES = ["pandas", "pyarrow", "numpy", "jsonschema", "setuptools_scm", "http.client", "urllib.request"]
+
+#: The target for the wall time of "mwtab --help", not counting starting Python itself.
+HELP_TARGET_SECONDS = 0.150
+
+
+def run_python(arguments):
+    # Let Python write bytecode caches, like an installed package has, so compiling isn't measured.
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    return subprocess.run([sys.executable] + arguments, capture_output=True, encoding="UTF-8", env=env)
+
+
+@pytest.mark.parametrize("code", [
+    "import mwtab",
+    "import mwtab.cli",
+    "import sys; sys.argv = ['mwtab', '--help']\ntry:\n    import mwtab.__main__; mwtab.__main__.main()\nexcept SystemExit:\n    pass",
+    "import mwtab; mwtab.read_files; mwtab.GenericMWURL",
+    "import mwtab.mwfeatures, mwtab.mwduplicates, mwtab.mwindex",
+])
+def test_heavy_modules_are_not_imported(code):
+    subp = run_python(["-c", code + "\nimport sys; print(sorted(name for name in " + repr(HEAVY_MODULES) + " if name in sys.modules))"])
+    assert subp.returncode == 0, subp.stderr
+    assert subp.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_heavy_modules_are_imported_when_used():
+    code = ("import sys, mwtab\n"
+            "mwtabfile = next(mwtab.read_files('tests/example_data/mwtab_files/ST000122_AN000204.json'))\n"
+            "mwtabfile.get_metabolites_as_pandas()\n"
+            "print('pandas' in sys.modules)")
+    subp = run_python(["-c", code])
+    assert subp.returncode == 0, subp.stderr
+    assert subp.stdout.strip() == "True"
+
+
+def best_time(arguments, runs=5):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subp = run_python(arguments)
+        times.append(time.perf_counter() - start)
+        assert subp.returncode == 0, subp.stderr
+    return min(times)
+
+
+# Wall time depends on how busy the machine is, so this only runs when asked for.
+@pytest.mark.skipif(not os.environ.get("MWTAB_TIMING_TESTS"), reason="Set MWTAB_TIMING_TESTS=1 to run timing tests.")
+def test_help_import_time():
+    startup = best_time(["-c", "pass"])
+    help_time = best_time(["-m", "mwtab", "--help"])
+    assert help_time - startup < HELP_TARGET_SECONDS, \
+        "mwtab --help took {:.0f} ms more than starting Python.".format((help_time - startup) * 1000)
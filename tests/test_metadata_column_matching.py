@@ -41,3 +41,73 @@ def test_ValueMatcher():
 
 
 
+
+
+def test_NameMatcher_compile():
+    nm = metadata_column_matching.NameMatcher(regex_search_strings=['foo'])
+    assert nm.dict_match({'foo bar': 'foo bar', 'baz': 'baz'}) == ['foo bar']
+    
+    nm.regex_search_strings = ['baz']
+    nm.compile()
+    assert nm.dict_match({'foo bar': 'foo bar', 'baz': 'baz'}) == ['baz']
+
+
+def test_ColumnFinderSet():
+    names = ['retention time', 'RT (min)', 'm/z', 'moverz_quant', 'kegg id', 'kegg_id', 'pubchem',
+             'inchi key', 'inchikey', 'other id', 'other id type', 'formula', 'smiles', 'hmdb',
+             'compound name', 'refmet name', 'quantified m/z', 'ri', 'ri type', 'mass error ppm']
+    name_map = {name.lower(): name for name in names}
+    
+    expected = {}
+    for name, finder in metadata_column_matching.column_finders.items():
+        matches = finder.name_dict_match(name_map)
+        if matches:
+            expected[name] = matches
+    
+    assert metadata_column_matching.column_finder_set.dict_match(name_map) == expected
+    assert list(metadata_column_matching.column_finder_set.dict_match(name_map)) == list(expected)
+
+
+def test_PreparedColumn():
+    series = pandas.Series(['a', ' 1 ', '2.3', None, 'NA', '‎4'], dtype='string[pyarrow]', index=range(3, 9))
+    column = metadata_column_matching.PreparedColumn(series)
+    
+    for vm in [metadata_column_matching.ValueMatcher('integer', None, None),
+               metadata_column_matching.ValueMatcher('numeric', None, None),
+               metadata_column_matching.ValueMatcher('non-numeric', None, None),
+               metadata_column_matching.ValueMatcher(None, r'\d+', None),
+               metadata_column_matching.ValueMatcher(None, None, r'a')]:
+        for match_na_values in [True, False]:
+            expected_match = vm.series_match(series, ['NA'], match_na_values)
+            series_match = vm.series_match(column, ['NA'], match_na_values)
+            assert series_match.equals(expected_match)
+    
+    assert column.stripped.to_pylist() == ['a', '1', '2.3', None, 'NA', '4']
+    assert column.na_mask(['NA']).tolist() == [False, False, False, True, True, False]
+    assert column.numeric_na_mask().tolist() == [True, False, False, True, True, False]
+    assert column.decimal_point_mask().tolist() == [False, False, True, False, False, False]
+
+
+def test_ColumnFinderSet_cache(tmp_path):
+    finder_set = metadata_column_matching.ColumnFinderSet(metadata_column_matching.column_finders.values(), cache_size = 2)
+    
+    assert finder_set.dict_match({'RT': 'retention time', 'Retention Time': 'retention time'}) == \
+        {'retention_time': ['RT', 'Retention Time']}
+    assert finder_set.cache_hits == 1
+    assert finder_set.cache_misses == 1
+    
+    finder_set.name_match('kegg id')
+    finder_set.name_match('m/z')
+    # The cache is limited to 2 names, so "retention time" is the least recently used and should be dropped.
+    finder_set.name_match('retention time')
+    assert finder_set.cache_misses == 4
+    
+    path = tmp_path / 'column_cache.json'
+    finder_set.save_cache(path)
+    new_finder_set = metadata_column_matching.ColumnFinderSet(metadata_column_matching.column_finders.values())
+    assert new_finder_set.load_cache(path)
+    assert new_finder_set.name_match('retention time') == ['retention_time']
+    assert new_finder_set.cache_hits == 1
+    
+    different_finder_set = metadata_column_matching.ColumnFinderSet(list(metadata_column_matching.column_finders.values())[:3])
+    assert not different_finder_set.load_cache(path)
@@ -0,0 +1,107 @@
+import json
+import random
+
+import pytest
+
+from mwtab.mwduplicates import MinHashLSH, analysis_items, find_near_duplicates
+from mwtab.fileio import read_files
+
+
+def write_file(directory, study_id, analysis_id, metabolites, samples):
+    with open("tests/example_data/mwtab_files/ST000122_AN000204.json", encoding="utf-8") as fh:
+        mwtab_json = json.load(fh)
+    mwtab_json["METABOLOMICS WORKBENCH"]["STUDY_ID"] = study_id
+    mwtab_json["METABOLOMICS WORKBENCH"]["ANALYSIS_ID"] = analysis_id
+    mwtab_json["MS_METABOLITE_DATA"]["Data"] = [dict({"Metabolite": metabolite}, **{sample: "1.0" for sample in samples})
+                                                for metabolite in metabolites]
+    mwtab_json["SUBJECT_SAMPLE_FACTORS"] = [{"Subject ID": "-", "Sample ID": sample, "Factors": {"Group": "A"}}
+                                            for sample in samples]
+    path = directory / (study_id + "_" + analysis_id + ".json")
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(mwtab_json, fh)
+    return path
+
+
+def test_MinHashLSH():
+    lsh = MinHashLSH(threshold=0.8)
+    assert lsh.bands * lsh.rows == lsh.num_perm == 128
+    assert (1 / lsh.bands) ** (1 / lsh.rows) <= 0.8
+    
+    metabolites = ["Metabolite " + str(i) for i in range(100)]
+    lsh.add("AN000001", metabolites)
+    lsh.add("AN000002", list(reversed(metabolites)) + metabolites[:10])
+    lsh.add("AN000003", metabolites[:95] + ["Other " + str(i) for i in range(5)])
+    lsh.add("AN000004", ["Other " + str(i) for i in range(100)])
+    assert len(lsh) == 4
+    
+    duplicates = lsh.duplicates()
+    assert [pair[:2] for pair in duplicates] == [("AN000001", "AN000002"),
+                                                 ("AN000001", "AN000003"),
+                                                 ("AN000002", "AN000003")]
+    assert duplicates[0][2] == 1.0
+    # The true Jaccard similarity is 95/105.
+    assert duplicates[1][2] == pytest.approx(95 / 105, abs=0.1)
+    assert lsh.similarity("AN000001", "AN000004") < 0.2
+    
+    assert [key for key, _ in lsh.query(metabolites)] == ["AN000001", "AN000002", "AN000003"]
+    assert lsh.query(["Something else"]) == []
+
+
+def test_MinHashLSH_recall():
+    # Near duplicates hidden among unrelated sets that share some of the same metabolites.
+    generator = random.Random(0)
+    sets = [generator.sample(range(2000), 50) for _ in range(500)]
+    lsh = MinHashLSH(threshold=0.9)
+    for i, metabolites in enumerate(sets):
+        lsh.add("AN{:06}".format(i), ["Metabolite " + str(metabolite) for metabolite in metabolites])
+    expected = set()
+    for i in range(0, 500, 25):
+        lsh.add("Copy of AN{:06}".format(i), ["Metabolite " + str(metabolite) for metabolite in sets[i][:-1]] + ["New metabolite"])
+        expected.add(("AN{:06}".format(i), "Copy of AN{:06}".format(i)))
+    
+    found = {pair[:2] for pair in lsh.duplicates()}
+    assert found == expected
+    # Only a small fraction of the pairs are compared.
+    assert len(lsh.candidates()) < 1000
+
+
+def test_MinHashLSH_errors():
+    with pytest.raises(ValueError, match = "threshold must be"):
+        MinHashLSH(threshold=0)
+    with pytest.raises(ValueError, match = "num_perm must be"):
+        MinHashLSH(num_perm=0)
+    
+    lsh = MinHashLSH()
+    with pytest.raises(ValueError, match = "empty set"):
+        lsh.add("AN000001", [])
+    lsh.add("AN000001", ["Glucose"])
+    with pytest.raises(ValueError, match = "was already added"):
+        lsh.add("AN000001", ["Glucose"])
+
+
+def test_MinHashLSH_signatures_are_stable():
+    assert (MinHashLSH().signature(["Glucose", "Citrate"]) == MinHashLSH().signature(["Citrate", "Glucose"])).all()
+    assert not (MinHashLSH(seed=2).signature(["Glucose", "Citrate"]) == MinHashLSH().signature(["Glucose", "Citrate"])).all()
+
+
+def test_find_near_duplicates(tmp_path):
+    metabolites = ["Metabolite " + str(i) for i in range(40)]
+    write_file(tmp_path, "ST000001", "AN000001", metabolites, ["S1", "S2", "S3"])
+    write_file(tmp_path, "ST000002", "AN000002", [" " + metabolite.upper() for metabolite in metabolites], ["T1", "T2", "T3"])
+    write_file(tmp_path, "ST000003", "AN000003", ["Glucose", "Citric acid"], ["S1", "S2", "S3"])
+    write_file(tmp_path, "ST000004", "AN000004", [], ["S1"])
+    
+    assert find_near_duplicates(str(tmp_path)) == [("AN000001", "AN000002", 1.0)]
+    # The sample IDs are different, so including them lowers the similarity below the threshold.
+    assert find_near_duplicates(str(tmp_path), include_samples=True) == []
+    assert find_near_duplicates(str(tmp_path), threshold=0.8, include_samples=True)[0][:2] == ("AN000001", "AN000002")
+    
+    mwtabfile = next(read_files(str(tmp_path / "ST000003_AN000003.json")))
+    assert analysis_items(mwtabfile) == {"metabolite:glucose", "metabolite:citric acid"}
+    assert analysis_items(mwtabfile, True) == {"metabolite:glucose", "metabolite:citric acid",
+                                               "sample:S1", "sample:S2", "sample:S3"}
+
+
+def test_find_near_duplicates_same_analysis_id():
+    duplicates = find_near_duplicates("tests/example_data/mwtab_files")
+    assert duplicates == [("AN000204", "AN000204 (tests/example_data/mwtab_files/ST000122_AN000204.txt)", 1.0)]
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 
 from mwtab import mwextract
@@ -18,6 +20,22 @@ def test_extract_metabolites_exception():
     mwtabfile = mwtab.mwtab.MWTabFile('asdf') 
     mwtabfile['MS_METABOLITE_DATA'] = {'Data':[{'key1':'asdf'}]}
     assert mwextract.extract_metabolites([(mwtabfile, None)], [lambda x: True]) == {}
+
+def test_extract_metabolites_threshold():
+    mwtabfile = mwtab.mwtab.MWTabFile('asdf')
+    mwtabfile['METABOLOMICS WORKBENCH'] = {'STUDY_ID': 'ST000001', 'ANALYSIS_ID': 'AN000001'}
+    mwtabfile['MS_METABOLITE_DATA'] = {'Data':[{'Metabolite': 'a', 'sample1': '1.5', 'sample2': ' 10 ', 'sample3': 'NA'},
+                                               {'Metabolite': 'b', 'sample1': '0', 'sample2': '-1', 'sample3': ''},
+                                               {'Metabolite': 'c', 'sample2': '1e3', 'sample1': 'inf'},
+                                               {'sample1': '5'}]}
+    
+    assert mwextract.extract_metabolites([(mwtabfile, None)], []) == \
+        {'a': {'ST000001': {'AN000001': {'sample1', 'sample2'}}}, 
+         'c': {'ST000001': {'AN000001': {'sample1', 'sample2'}}}}
+    
+    assert mwextract.extract_metabolites([(mwtabfile, None)], [], threshold = 5) == \
+        {'a': {'ST000001': {'AN000001': {'sample2'}}}, 
+         'c': {'ST000001': {'AN000001': {'sample1', 'sample2'}}}}
     
 
 
@@ -28,3 +46,136 @@ def test_extract_metabolites_exception():
 
 
 
+
+
+def test_extract_metabolites_duplicate_samples():
+    """Duplicate sample names use the value of the first column with that name."""
+    mwtabfile = mwtab.mwtab.MWTabFile('asdf', duplicate_keys=True)
+    mwtabfile['METABOLOMICS WORKBENCH'] = {'STUDY_ID': 'ST000001', 'ANALYSIS_ID': 'AN000001'}
+    row1 = mwtab.duplicates_dict.DuplicatesDict()
+    row1['Metabolite'] = 'a'
+    row1['sample1'] = '0'
+    row1['sample1'] = '5'
+    row1['sample2'] = '3'
+    row2 = mwtab.duplicates_dict.DuplicatesDict()
+    row2['Metabolite'] = 'b'
+    row2['sample1'] = '4'
+    row2['sample1'] = '0'
+    row2['sample2'] = '0'
+    mwtabfile['MS_METABOLITE_DATA'] = {'Data': [row1, row2]}
+    
+    assert mwextract.extract_metabolites([(mwtabfile, None)], []) == \
+        {'a': {'ST000001': {'AN000001': {'sample2'}}}, 
+         'b': {'ST000001': {'AN000001': {'sample1'}}}}
+
+
+@pytest.mark.parametrize("value, fully_parsed", [
+    ("Human", True),
+    ("Plant", False)
+])
+def test_MatcherFilteredMWTabFile(value, fully_parsed):
+    matchers = list(mwextract.generate_matchers([("SU:SUBJECT_TYPE", value)]))
+    mwtabfile = next(mwtab.fileio.read_with_class("tests/example_data/mwtab_files/ST000122_AN000204.txt", 
+                                                  mwextract.MatcherFilteredMWTabFile, 
+                                                  {"matchers": matchers, "duplicate_keys": True}))
+    assert mwtabfile.fully_parsed == fully_parsed
+    assert ("MS_METABOLITE_DATA" in mwtabfile) == fully_parsed
+    assert mwtabfile["SUBJECT"]["SUBJECT_TYPE"] == "Human"
+    assert mwtabfile.study_id == "ST000122"
+
+
+def test_MatcherFilteredMWTabFile_full_parse():
+    """Files that can't be filtered using only the metadata are parsed fully."""
+    matchers = list(mwextract.generate_matchers([("SU:SUBJECT_TYPE", "Plant")]))
+    mwtabfile = next(mwtab.fileio.read_with_class("tests/example_data/mwtab_files/ST000122_AN000204.json", 
+                                                  mwextract.MatcherFilteredMWTabFile, 
+                                                  {"matchers": matchers}))
+    assert mwtabfile.fully_parsed
+    
+    # The matcher raises a KeyError for the missing key, so the file should be fully parsed.
+    matchers = list(mwextract.generate_matchers([("SU:MISSING_KEY", "Plant")]))
+    mwtabfile = next(mwtab.fileio.read_with_class("tests/example_data/mwtab_files/ST000122_AN000204.txt", 
+                                                  mwextract.MatcherFilteredMWTabFile, 
+                                                  {"matchers": matchers}))
+    assert mwtabfile.fully_parsed
+
+
+def test_extract_parallel():
+    """The parallel extraction should give the same results as extracting in order."""
+    sources = ["tests/example_data/mwtab_files/", "tests/example_data/files_to_test_error_recovery/"]
+    matchers = list(mwextract.generate_matchers([("SU:SUBJECT_TYPE", "Human")]))
+    mwfiles = mwtab.fileio.read_with_class(sources, mwtab.mwtab.MWTabFile, {"duplicate_keys": True}, return_exceptions=True)
+    expected = mwextract.extract_metabolites(mwfiles, matchers)
+    assert expected
+    assert mwextract.extract_metabolites_parallel(sources, matchers, jobs=2) == expected
+    
+    keys = ["SUBJECT_TYPE", "INSTRUMENT_TYPE"]
+    expected = {}
+    for mwtabfile in mwtab.fileio.read_files(sources[0]):
+        for key, values in mwextract.extract_metadata(mwtabfile, keys).items():
+            expected.setdefault(key, set()).update(values)
+    assert mwextract.extract_metadata_parallel(sources[0], keys, jobs=2) == expected
+
+
+def test_extract_parallel_errors(capsys):
+    matchers = list(mwextract.generate_matchers([("SU:SUBJECT_TYPE", "Human")]))
+    assert mwextract.extract_metabolites_parallel("tests/example_data/missing_file.txt", matchers, jobs=1) == {}
+    assert "Something went wrong when trying to read tests/example_data/missing_file.txt" in capsys.readouterr().out
+
+
+def test_merge_metabolite_rows(tmp_path):
+    """Spilling rows to temporary files should give the same results as extracting into a dictionary."""
+    sources = ["tests/example_data/mwtab_files/", "tests/example_data/files_to_test_error_recovery/"]
+    matchers = list(mwextract.generate_matchers([("SU:SUBJECT_TYPE", "Human")]))
+    mwfiles = mwtab.fileio.read_with_class(sources, mwtab.mwtab.MWTabFile, {"duplicate_keys": True}, return_exceptions=True)
+    expected = mwextract.extract_metabolites(mwfiles, matchers)
+    
+    mwfiles = mwtab.fileio.read_with_class(sources, mwtab.mwtab.MWTabFile, {"duplicate_keys": True}, return_exceptions=True)
+    rows = list(mwextract.metabolite_rows(mwfiles, matchers))
+    merged = list(mwextract.merge_metabolite_rows(rows, max_rows=10, temp_dir=tmp_path))
+    assert [metabolite for metabolite, studies in merged] == sorted(expected)
+    assert dict(merged) == expected
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_write_jsonl(tmp_path):
+    to_path = tmp_path / "records"
+    assert mwextract.write_jsonl(str(to_path), iter([])) == 0
+    assert not list(tmp_path.iterdir())
+    
+    records = [{"metadata": {"SUBJECT_TYPE": {"Human"}}}, {"metadata": {"SUBJECT_TYPE": {"Plant"}}}]
+    assert mwextract.write_jsonl(str(to_path), iter(records)) == 2
+    with open(str(to_path) + ".jsonl") as f:
+        assert f.read() == '{"metadata": {"SUBJECT_TYPE": ["Human"]}}\n{"metadata": {"SUBJECT_TYPE": ["Plant"]}}\n'
+
+
+def test_MetaboliteTable():
+    sources = ["tests/example_data/mwtab_files/"]
+    matchers = list(mwextract.generate_matchers([("SU:SUBJECT_TYPE", "Human")]))
+    mwfiles = mwtab.fileio.read_with_class(sources, mwtab.mwtab.MWTabFile, {"duplicate_keys": True}, return_exceptions=True)
+    rows = list(mwextract.metabolite_rows(mwfiles, matchers))
+    mwfiles = mwtab.fileio.read_with_class(sources, mwtab.mwtab.MWTabFile, {"duplicate_keys": True}, return_exceptions=True)
+    expected = mwextract.extract_metabolites(mwfiles, matchers)
+    
+    table = mwextract.MetaboliteTable.from_rows(rows)
+    assert table == expected
+    assert list(table) == list(expected)
+    assert table.to_dict() == expected
+    assert "17-hydroxypregnenolone" in table
+    assert "ST000122" not in table
+    with pytest.raises(KeyError):
+        table["missing"]
+    
+    # Samples for the same metabolite and analysis are combined, even after the table has been looked up.
+    table.add("17-hydroxypregnenolone", "ST000122", "AN000204", ["new_sample", "new_sample"])
+    table.add("new_metabolite", "ST000001", "AN000001", [])
+    assert table["17-hydroxypregnenolone"]["ST000122"]["AN000204"] == \
+           expected["17-hydroxypregnenolone"]["ST000122"]["AN000204"] | {"new_sample"}
+    assert table["new_metabolite"] == {"ST000001": {"AN000001": set()}}
+    assert len(table) == len(expected) + 1
+
+
+def test_MetaboliteTable_json():
+    table = mwextract.MetaboliteTable.from_rows([("Glucose", "ST000001", "AN000001", ["sample1"])])
+    assert json.dumps(table, cls=mwextract.SetEncoder) == '{"Glucose": {"ST000001": {"AN000001": ["sample1"]}}}'
+    assert not mwextract.MetaboliteTable()
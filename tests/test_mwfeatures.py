@@ -0,0 +1,80 @@
+import json
+
+import numpy
+import pytest
+
+from mwtab.mwfeatures import FeatureIndex
+
+
+def write_file(directory, study_id, analysis_id, metabolites):
+    with open("tests/example_data/mwtab_files/ST000122_AN000204.json", encoding="utf-8") as fh:
+        mwtab_json = json.load(fh)
+    mwtab_json["METABOLOMICS WORKBENCH"]["STUDY_ID"] = study_id
+    mwtab_json["METABOLOMICS WORKBENCH"]["ANALYSIS_ID"] = analysis_id
+    mwtab_json["MS_METABOLITE_DATA"]["Metabolites"] = metabolites
+    path = directory / (study_id + "_" + analysis_id + ".json")
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(mwtab_json, fh)
+    return path
+
+
+@pytest.fixture()
+def feature_files(tmp_path):
+    write_file(tmp_path, "ST000001", "AN000001", [
+        {"Metabolite": "Glucose", "m/z": "180.0634", "Retention Time": "5.1"},
+        {"Metabolite": "Fructose", "m/z": "180.0639", "Retention Time": "6.3"},
+        {"Metabolite": "Leucine", "m/z": "132.1019", "Retention Time": ""},
+        {"Metabolite": "Unknown", "m/z": "101.1/102.2", "Retention Time": "1.0"},
+    ])
+    write_file(tmp_path, "ST000002", "AN000002", [
+        {"Metabolite": "Glucose", "moverz_quant": "180.0630", "rt_min": "5.3"},
+        {"Metabolite": "Citric acid", "moverz_quant": "193.0343", "rt_min": "2.2"},
+    ])
+    write_file(tmp_path, "ST000003", "AN000003", [
+        {"Metabolite": "Glucose", "pubchem_id": "5793"},
+    ])
+    return tmp_path
+
+
+def test_query(feature_files):
+    index = FeatureIndex()
+    assert index.add_files(str(feature_files)) == 2
+    assert len(index) == 5
+    assert sorted(index.analyses) == [("ST000001", "AN000001"), ("ST000002", "AN000002")]
+    
+    results = index.query([180.0634, 132.1019, 500.0], ppm=5)
+    assert results["query"].tolist() == [0, 0, 0, 1]
+    assert results["metabolite"].tolist() == ["Glucose", "Glucose", "Fructose", "Leucine"]
+    assert results["analysis_id"].tolist() == ["AN000002", "AN000001", "AN000001", "AN000001"]
+    assert (results["ppm_error"].abs() <= 5).all()
+    assert numpy.isnan(results["rt"].iloc[3])
+    
+    # A narrower tolerance and a retention time window.
+    assert index.query(180.0634, ppm=1)["metabolite"].tolist() == ["Glucose"]
+    results = index.query([180.0634, 132.1019], ppm=5, rt=[5.0, 1.0], rt_window=0.35)
+    assert results[["query", "study_id", "rt"]].values.tolist() == [[0, "ST000002", 5.3], [0, "ST000001", 5.1]]
+    
+    with pytest.raises(ValueError, match = "rt_window must be given"):
+        index.query(180.0634, rt=5.0)
+
+
+def test_empty_and_incremental(feature_files):
+    index = FeatureIndex()
+    assert len(index.query([180.0634])) == 0
+    
+    index.add_files(str(feature_files / "ST000001_AN000001.json"))
+    assert len(index.query(180.0634, ppm=5)) == 2
+    index.add_files(str(feature_files / "ST000002_AN000002.json"))
+    assert len(index.query(180.0634, ppm=5)) == 3
+    assert index.metabolites == ["Glucose", "Fructose", "Leucine", "Citric acid"]
+
+
+def test_save_and_load(tmp_path, feature_files):
+    index = FeatureIndex()
+    index.add_files(str(feature_files))
+    index.save(str(tmp_path / "features.npz"))
+    
+    loaded = FeatureIndex.load(str(tmp_path / "features.npz"))
+    query = numpy.array([180.0634, 193.0343, 132.1019])
+    assert loaded.query(query, ppm=5).equals(index.query(query, ppm=5))
+    assert loaded.analyses == index.analyses
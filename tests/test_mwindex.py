@@ -0,0 +1,184 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from mwtab import mwindex, mwextract
+import mwtab
+
+
+def test_MWTabIndex(tmp_path):
+    shutil.copy("tests/example_data/mwtab_files/ST000122_AN000204.txt", tmp_path / "ST000122_AN000204.txt")
+    index_path = str(tmp_path / "index.sqlite")
+    
+    with mwindex.MWTabIndex(index_path) as index:
+        assert index.update(str(tmp_path)) == {'indexed': 1, 'unchanged': 0, 'removed': 0}
+        expected = mwextract.extract_metabolites(mwtab.read_files(str(tmp_path / "ST000122_AN000204.txt"), return_exceptions=True), [])
+        assert index.query_metabolites(list(expected)) == expected
+        assert index.query_metabolites(['cortisol']) == {}
+        assert index.query_metabolites(['cortisol'], ignore_case=True) == {'Cortisol': expected['Cortisol']}
+    
+    # Unchanged files aren't read again and the index persists.
+    with mwindex.MWTabIndex(index_path) as index:
+        assert index.update(str(tmp_path)) == {'indexed': 0, 'unchanged': 1, 'removed': 0}
+        assert index.query_metabolites(['Cortisol']) == {'Cortisol': expected['Cortisol']}
+    
+    os.remove(tmp_path / "ST000122_AN000204.txt")
+    with mwindex.MWTabIndex(index_path) as index:
+        assert index.update(str(tmp_path)) == {'indexed': 0, 'unchanged': 0, 'removed': 1}
+        assert index.query_metabolites(['Cortisol']) == {}
+
+
+def test_MWTabIndex_threshold(tmp_path):
+    shutil.copy("tests/example_data/mwtab_files/ST000122_AN000204.txt", tmp_path / "ST000122_AN000204.txt")
+    index_path = str(tmp_path / "index.sqlite")
+    
+    with mwindex.MWTabIndex(index_path) as index:
+        index.update(str(tmp_path))
+        samples = index.query_metabolites(['Cortisol'])['Cortisol']['ST000122']['AN000204']
+    
+    # A different threshold means every file has to be read again.
+    with mwindex.MWTabIndex(index_path, threshold=1e12) as index:
+        assert index.update(str(tmp_path)) == {'indexed': 1, 'unchanged': 0, 'removed': 0}
+        assert index.query_metabolites(['Cortisol']) == {}
+    assert samples
+    
+    # Rows from files removed before the next update don't stay in the index when it's rebuilt.
+    with mwindex.MWTabIndex(index_path, threshold=0) as index:
+        index.update(str(tmp_path))
+        with index.connection:
+            index.connection.execute("UPDATE properties SET value = '3' WHERE name = 'version'")
+    os.remove(tmp_path / "ST000122_AN000204.txt")
+    with mwindex.MWTabIndex(index_path, threshold=1) as index:
+        assert dict(index.connection.execute("SELECT * FROM properties")) == {'threshold': '1.0', 'version': str(mwindex.INDEX_VERSION)}
+        assert index.update(str(tmp_path)) == {'indexed': 0, 'unchanged': 0, 'removed': 0}
+        for table in mwindex._FILE_TABLES:
+            assert index.connection.execute("SELECT COUNT(*) FROM " + table).fetchone() == (0,)
+
+
+def test_MWTabIndex_read_error(tmp_path, capsys):
+    with open(tmp_path / "bad.json", "w") as open_file:
+        open_file.write("")
+    
+    with mwindex.MWTabIndex(str(tmp_path / "index.sqlite")) as index:
+        index.update(str(tmp_path))
+    assert "Something went wrong when trying to read" in capsys.readouterr().out
+
+
+def test_MWTabIndex_query_metadata(tmp_path):
+    with mwindex.MWTabIndex(str(tmp_path / "index.sqlite")) as index:
+        index.update("tests/example_data/mwtab_files/ST000122_AN000204.txt")
+        
+        expected = mwextract.extract_metadata(next(mwtab.read_files("tests/example_data/mwtab_files/ST000122_AN000204.txt")), 
+                                              ["SUBJECT_TYPE", "INSTRUMENT_TYPE"])
+        assert index.query_metadata(["SUBJECT_TYPE", "INSTRUMENT_TYPE"]) == expected
+        assert index.query_metadata(["SU:SUBJECT_TYPE"]) == {"SUBJECT:SUBJECT_TYPE": {"Human"}}
+        assert index.query_metadata(["SUBJECT:SUBJECT_TYPE"]) == {"SUBJECT:SUBJECT_TYPE": {"Human"}}
+        assert index.query_metadata(["SUBJECT:SUBJECT_"], match="prefix") == \
+            {"SUBJECT:SUBJECT_TYPE": {"Human"}, "SUBJECT:SUBJECT_SPECIES": {"Homo sapiens"}}
+        assert index.query_metadata(["SUBJECT_"], match="prefix") == \
+            {"SUBJECT_TYPE": {"Human"}, "SUBJECT_SPECIES": {"Homo sapiens"}}
+        assert index.query_metadata([r"^MS:.*_TYPE$"], match="regex") == \
+            {"MS:INSTRUMENT_TYPE": {"Triple quadrupole"}, "MS:MS_TYPE": {"ESI"}}
+        assert index.query_metadata(["NOT_A_KEY"]) == {}
+        
+        with pytest.raises(ValueError, match=r'Unknown metadata match, "fuzzy".'):
+            index.query_metadata(["SUBJECT_TYPE"], match="fuzzy")
+    
+    # Opening an index without a threshold keeps the one it was built with.
+    with mwindex.MWTabIndex(str(tmp_path / "index.sqlite"), threshold=1) as index:
+        index.update("tests/example_data/mwtab_files/ST000122_AN000204.txt")
+    with mwindex.MWTabIndex(str(tmp_path / "index.sqlite")) as index:
+        assert index.threshold == 1
+        assert index.update("tests/example_data/mwtab_files/ST000122_AN000204.txt")['unchanged'] == 1
+
+
+def test_MWTabIndex_query_identifiers(tmp_path):
+    shutil.copy("tests/example_data/mwtab_files/ST000122_AN000204.txt", tmp_path / "ST000122_AN000204.txt")
+    with open("tests/example_data/mwtab_files/ST000122_AN000204.json", encoding="utf-8") as fh:
+        mwtab_json = json.load(fh)
+    mwtab_json["METABOLOMICS WORKBENCH"]["STUDY_ID"] = "ST000999"
+    mwtab_json["METABOLOMICS WORKBENCH"]["ANALYSIS_ID"] = "AN000999"
+    mwtab_json["MS_METABOLITE_DATA"]["Metabolites"] = [
+        {"Metabolite": "cortisol", "PubChem CID": 5754, "HMDB ID": "HMDB00063", "KEGG": "cpd:C00735"},
+        {"Metabolite": "Estrone", "PubChem CID": "CID5870", "HMDB ID": "HMDB0000145/HMDB00146", "KEGG": ""},
+        {"Metabolite": "Glucose", "PubChem CID": 5793.0, "HMDB ID": "HMDB0000122", "KEGG": "C00031"},
+        {"Metabolite": "Not glucose", "PubChem CID": "122", "HMDB ID": "", "KEGG": ""},
+        {"Metabolite": "Not glucose either", "PubChem CID": 31, "HMDB ID": "", "KEGG": ""},
+    ]
+    with open(tmp_path / "ST000999_AN000999.json", "w", encoding="utf-8") as fh:
+        json.dump(mwtab_json, fh)
+    
+    with mwindex.MWTabIndex(str(tmp_path / "index.sqlite")) as index:
+        index.update(str(tmp_path))
+        assert index.query_identifiers(["5754"], "pubchem_id") == {"5754": [
+            {"id_type": "pubchem_id", "identifier": "5754", "study_id": "ST000122", "analysis_id": "AN000204", "metabolite": "Cortisol", "row": 8},
+            {"id_type": "pubchem_id", "identifier": "5754", "study_id": "ST000999", "analysis_id": "AN000999", "metabolite": "cortisol", "row": 0},
+        ]}
+        
+        results = index.query_identifiers(["hmdb63", "HMDB0000146", "c00735", "NOT_AN_ID"])
+        assert [match["metabolite"] for match in results["hmdb63"]] == ["cortisol"]
+        assert [match["identifier"] for match in results["HMDB0000146"]] == ["HMDB0000146"]
+        assert [match["id_type"] for match in results["c00735"]] == ["kegg_id"]
+        assert "NOT_AN_ID" not in results
+        
+        # Digits in other kinds of IDs aren't looked up as PubChem or ChEBI IDs.
+        results = index.query_identifiers(["HMDB0000122", "C00031", "CID122", "31"])
+        assert [(match["id_type"], match["metabolite"]) for match in results["HMDB0000122"]] == [("hmdb_id", "Glucose")]
+        assert [(match["id_type"], match["metabolite"]) for match in results["C00031"]] == [("kegg_id", "Glucose")]
+        assert [(match["id_type"], match["metabolite"]) for match in results["CID122"]] == [("pubchem_id", "Not glucose")]
+        assert [(match["id_type"], match["metabolite"]) for match in results["31"]] == [("pubchem_id", "Not glucose either")]
+        
+        # A float PubChem CID is indexed as the integer, without the digits after the decimal point.
+        assert [match["metabolite"] for match in index.query_identifiers(["5793"], "pubchem_id")["5793"]] == ["Glucose"]
+        assert index.query_identifiers(["0"], "pubchem_id") == {}
+        
+        assert index.shared_identifiers("AN000204") == {"AN000999": {"5754", "5870"}}
+        assert index.shared_identifiers("AN000999", "hmdb_id") == {}
+        
+        with pytest.raises(ValueError, match=r'Unknown identifier type, "cas".'):
+            index.query_identifiers(["50-00-0"], "cas")
+
+
+
+def test_MWTabIndex_query_samples(tmp_path):
+    with open("tests/example_data/mwtab_files/ST000122_AN000204.json", encoding="utf-8") as fh:
+        mwtab_json = json.load(fh)
+    mwtab_json["METABOLOMICS WORKBENCH"]["STUDY_ID"] = "ST000001"
+    mwtab_json["METABOLOMICS WORKBENCH"]["ANALYSIS_ID"] = "AN000001"
+    mwtab_json["SUBJECT_SAMPLE_FACTORS"] = [
+        {"Subject ID": "-", "Sample ID": "S1", "Factors": {"Treatment": "Control", "Tissue": "Plasma"}},
+        {"Subject ID": "-", "Sample ID": "S2", "Factors": {"Treatment": "High fat diet", "Tissue": "Plasma"}},
+        {"Subject ID": "-", "Sample ID": "S3", "Factors": {"Treatment": "Control", "Tissue": "Serum"}, 
+         "Additional sample data": {"Sex": "Male"}},
+        {"Subject ID": "-", "Sample ID": "S4", "Factors": {"Treatment": "control", "Tissue": "Liver"}},
+    ]
+    with open(tmp_path / "ST000001_AN000001.json", "w", encoding="utf-8") as fh:
+        json.dump(mwtab_json, fh)
+    
+    with mwindex.MWTabIndex(str(tmp_path / "index.sqlite")) as index:
+        index.update(str(tmp_path))
+        assert index.query_samples("Treatment:Control Tissue:Plasma") == {"ST000001": {"AN000001": {"S1"}}}
+        assert index.query_samples("Treatment:Control AND (Tissue:Plasma OR Tissue:Serum) AND NOT Sex:Male") == \
+            {"ST000001": {"AN000001": {"S1"}}}
+        assert index.query_samples('treatment:control OR Treatment:"High fat diet"', ignore_case=True) == \
+            {"ST000001": {"AN000001": {"S1", "S2", "S3", "S4"}}}
+        assert index.query_samples("NOT Tissue:Plasma AND Sex:*") == {"ST000001": {"AN000001": {"S3"}}}
+        assert index.query_samples("Tissue:Brain") == {}
+        assert index.sample_factors(["Sex", "tissue"], ignore_case=True) == \
+            {"Sex": {"Male": 1}, "Tissue": {"Liver": 1, "Plasma": 2, "Serum": 1}}
+        
+        for query, message in [("Tissue", "Terms must be written as FACTOR:VALUE"), ("(Tissue:Plasma", 'Missing "\\)"'),
+                               ("Tissue:Plasma OR", "ended unexpectedly"), ("Tissue:Plasma )", 'Unexpected "\\)"'), 
+                               (" ", "is empty")]:
+            with pytest.raises(ValueError, match=message):
+                index.query_samples(query)
+        
+        # Updates only change the samples of the new and changed files.
+        shutil.copy("tests/example_data/mwtab_files/ST000122_AN000204.txt", tmp_path / "ST000122_AN000204.txt")
+        assert index.update(str(tmp_path)) == {'indexed': 1, 'unchanged': 1, 'removed': 0}
+        assert list(index.query_samples("Tissue/Fluid:Serum OR Tissue:Serum")) == ["ST000001", "ST000122"]
+        os.remove(tmp_path / "ST000001_AN000001.json")
+        assert index.update(str(tmp_path)) == {'indexed': 0, 'unchanged': 1, 'removed': 1}
+        assert index.query_samples("Tissue:Plasma") == {}
@@ -0,0 +1,84 @@
+import io
+import json
+import os
+
+import pytest
+
+from mwtab import mwmirror, mwrest
+
+
+RECORDS = {
+    "1": {"study_id": "ST000001", "analysis_id": "AN000001", "analysis_type": "MS"},
+    "2": {"study_id": "ST000001", "analysis_id": "AN000002", "analysis_type": "MS"},
+    "3": {"study_id": "ST000002", "analysis_id": "AN000003", "analysis_type": "NMR"},
+}
+
+
+@pytest.fixture()
+def workbench(mocker, monkeypatch):
+    """Stand in for the Metabolomics Workbench listing and downloads, and record what is downloaded."""
+    state = {"records": json.loads(json.dumps(RECORDS)), "downloads": [], "fail": set()}
+    monkeypatch.setattr(mwrest.time, "sleep", lambda seconds: None)
+    mocker.patch("mwtab.mwmirror.mwrest._pull_analysis_records", side_effect = lambda base_url: state["records"])
+    def urlopen(url):
+        analysis_id = url.split("/")[-3]
+        state["downloads"].append(analysis_id)
+        if analysis_id in state["fail"]:
+            raise ValueError("Download failed.")
+        return io.BytesIO(("#METABOLOMICS WORKBENCH ANALYSIS_ID:" + analysis_id + "\n").encode("utf-8"))
+    mocker.patch("mwtab.mwrest.fileio.urlopen", side_effect = urlopen)
+    return state
+
+
+def test_sync(tmp_path, workbench):
+    mirror = mwmirror.MWTabMirror(str(tmp_path))
+    assert mirror.sync(workers=2) == {"downloaded": 3, "unchanged": 0, "failed": 0, "unlisted": 0}
+    assert sorted(workbench["downloads"]) == ["AN000001", "AN000002", "AN000003"]
+    assert sorted(os.listdir(tmp_path)) == ["ST000001_AN000001.txt", "ST000001_AN000002.txt", 
+                                            "ST000002_AN000003.txt", mwmirror.MANIFEST_NAME]
+    
+    with open(tmp_path / mwmirror.MANIFEST_NAME) as fh:
+        manifest = json.load(fh)
+    entry = manifest["AN000001"]
+    assert entry["study_id"] == "ST000001"
+    assert entry["file"] == "ST000001_AN000001.txt"
+    assert entry["size"] == os.path.getsize(tmp_path / "ST000001_AN000001.txt")
+    assert len(entry["sha256"]) == 64
+    
+    # Nothing has changed, so nothing is downloaded.
+    workbench["downloads"].clear()
+    mirror = mwmirror.MWTabMirror(str(tmp_path))
+    assert mirror.sync() == {"downloaded": 0, "unchanged": 3, "failed": 0, "unlisted": 0}
+    assert workbench["downloads"] == []
+    
+    # A changed listing record, a new analysis, a deleted file, and an analysis that is no longer listed.
+    workbench["records"]["1"]["analysis_type"] = "NMR"
+    workbench["records"]["4"] = {"study_id": "ST000003", "analysis_id": "AN000004", "analysis_type": "MS"}
+    del workbench["records"]["3"]
+    os.remove(tmp_path / "ST000001_AN000002.txt")
+    assert mirror.sync() == {"downloaded": 3, "unchanged": 0, "failed": 0, "unlisted": 1}
+    assert sorted(workbench["downloads"]) == ["AN000001", "AN000002", "AN000004"]
+    
+    # Everything is downloaded again after refresh_after days.
+    workbench["downloads"].clear()
+    assert mirror.sync(refresh_after=0)["downloaded"] == 3
+
+
+def test_sync_failures(tmp_path, workbench, capsys):
+    workbench["fail"].add("AN000002")
+    mirror = mwmirror.MWTabMirror(str(tmp_path))
+    assert mirror.sync() == {"downloaded": 2, "unchanged": 0, "failed": 1, "unlisted": 0}
+    assert "Something went wrong and AN000002 could not be downloaded." in capsys.readouterr().out
+    assert "AN000002" not in mirror.manifest
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+    
+    # The failed analysis is tried again on the next sync.
+    workbench["fail"].clear()
+    workbench["downloads"].clear()
+    assert mwmirror.MWTabMirror(str(tmp_path)).sync()["downloaded"] == 1
+    assert workbench["downloads"] == ["AN000002"]
+
+
+def test_bad_output_format(tmp_path):
+    with pytest.raises(ValueError, match = r'Unknown output format, "csv"'):
+        mwmirror.MWTabMirror(str(tmp_path), "csv")
@@ -0,0 +1,83 @@
+import io
+import json
+
+import pytest
+
+from mwtab.mwrefmet import RefMetDictionary, normalize_name
+
+
+RECORDS = [
+    {"name": "Glutamic acid", "refmet_id": "RM0008", "formula": "C5H9NO4", "inchi_key": "WHUUTDBJXJRKMK-VKHMYHEASA-N", "main_class": "Amino acids"},
+    {"name": "Glucose", "refmet_id": "RM0001", "formula": "C6H12O6", "inchi_key": "WQZGKKKJIJFFOK-GASJEMHNSA-N", "main_class": "Hexoses"},
+    {"name": "Fructose", "refmet_id": "RM0002", "formula": "C6H12O6", "inchi_key": "RFSUNEUAIZKAJO-ARQDHWQXSA-N", "main_class": "Hexoses"},
+    {"name": "alpha-Tocopherol", "refmet_id": "RM0003", "formula": "C29H50O2", "inchi_key": "GVJHHUAWPYXKBD-IEOSBIPESA-N", "main_class": "Vitamin E"},
+    {"name": "PC 34:1", "refmet_id": "RM0004", "formula": "C42H82NO8P", "inchi_key": "", "main_class": "PC"},
+    {"name": "Citric acid", "refmet_id": "RM0005", "formula": "C6H8O7", "inchi_key": "KRKNYBCHXYNGOX-UHFFFAOYSA-N", "main_class": "TCA acids"},
+]
+
+
+@pytest.mark.parametrize("name, normalized", [
+    ("L-Glutamic acid", "lglutamicacid"),
+    ("α-Tocopherol", "alphatocopherol"),
+    ("Glucose 6’-phosphate", "glucose6phosphate"),
+    ("PC 34:1", "pc34:1"),
+    ("1,2-Diacylglycerol", "1,2diacylglycerol"),
+])
+def test_normalize_name(name, normalized):
+    assert normalize_name(name) == normalized
+
+
+def test_resolve():
+    refmet = RefMetDictionary(RECORDS)
+    assert len(refmet) == 6
+    assert refmet.resolve("Glucose")["refmet_id"] == "RM0001"
+    assert refmet.resolve("GLUCOSE")["refmet_id"] == "RM0001"
+    assert refmet.resolve("α-Tocopherol")["refmet_id"] == "RM0003"
+    assert refmet.resolve("pc 34:1")["refmet_id"] == "RM0004"
+    assert refmet.resolve("PC 3:41") is None
+    
+    assert refmet.resolve("Glutamate acid") is None
+    assert refmet.resolve("Glutamate acid", fuzzy=True, threshold=0.6)["refmet_id"] == "RM0008"
+    assert refmet.resolve("Sucrose", fuzzy=True) is None
+    
+    matches = refmet.match("Citrate", threshold=0.3)
+    assert matches[0][0]["name"] == "Citric acid"
+    assert all(0.3 <= score < 1 for record, score in matches)
+    assert [score for record, score in matches] == sorted([score for record, score in matches], reverse=True)
+    
+    assert refmet.standardize(["D-Glucose", "glucose", "Citric-acid", "Sucrose"]) == \
+        {"D-Glucose": None, "glucose": "Glucose", "Citric-acid": "Citric acid", "Sucrose": None}
+
+
+def test_query():
+    refmet = RefMetDictionary(RECORDS)
+    assert refmet.query("name", "glucose") == RECORDS[1]
+    assert refmet.query("name", "glucose", "formula,refmet_id") == {"formula": "C6H12O6", "refmet_id": "RM0001"}
+    assert refmet.query("formula", "C6H12O6", "name") == {"1": {"name": "Glucose"}, "2": {"name": "Fructose"}}
+    assert refmet.query("inchi_key", "KRKNYBCHXYNGOX-UHFFFAOYSA-N", "name") == {"name": "Citric acid"}
+    assert refmet.query("match", "Glutamic-acids", "name") == {"name": "Glutamic acid"}
+    assert refmet.query("inchi_key", "", "name") is None
+    assert len(refmet.query("all", "", "name")) == 6
+    
+    results, errors = refmet.batch_query("name", ["Glucose", "Sucrose", "Glucose"], "refmet_id")
+    assert results == {"Glucose": {"refmet_id": "RM0001"}, "Sucrose": None}
+    assert errors == {}
+
+
+@pytest.mark.parametrize("file_name", ["refmet.json", "refmet.json.gz"])
+def test_download_and_load(tmp_path, monkeypatch, file_name):
+    urls = []
+    def urlopen(url):
+        urls.append(url)
+        return io.BytesIO(json.dumps({str(i): record for i, record in enumerate(RECORDS, 1)}).encode("utf-8"))
+    monkeypatch.setattr("mwtab.fileio.urlopen", urlopen)
+    
+    path = str(tmp_path / file_name)
+    refmet = RefMetDictionary.download(path, "https://www.test.org/rest/")
+    assert urls == ["https://www.test.org/rest/refmet/all"]
+    assert refmet.records == RECORDS
+    
+    loaded = RefMetDictionary.load(path)
+    assert loaded.records == RECORDS
+    assert loaded.fetched_at == refmet.fetched_at
+    assert loaded.resolve("citric acid")["refmet_id"] == "RM0005"
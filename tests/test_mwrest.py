@@ -1,5 +1,13 @@
 import pytest
-from mwtab.mwrest import GenericMWURL, analysis_ids, study_ids, generate_mwtab_urls, MWRESTFile
+from mwtab.mwrest import GenericMWURL, analysis_ids, study_ids, generate_mwtab_urls, MWRESTFile, TokenBucket, call_with_retries
+from mwtab import mwrest
+import urllib.error
+import urllib.parse
+import json
+import gzip
+import hashlib
+import io
+import os
 
 
 def test_study_analysis():
@@ -360,6 +368,66 @@ def test_MWRESTFile_is_json():
     assert mwfile._is_json('[]]') == False
 
 
+def test_MWRESTFile_lazy_text():
+    mwfile = MWRESTFile('asdf')
+    mwfile.read(io.BytesIO("Glucose \u00b5M".encode("utf-8")))
+    assert mwfile._text is None
+    assert mwfile.content == "Glucose \u00b5M".encode("utf-8")
+    assert mwfile.text == "Glucose \u00b5M"
+    
+    mwfile.text = "Fructose"
+    assert mwfile.content == b"Fructose"
+
+
+@pytest.mark.parametrize("file_name, open_function", [
+    ("ST000001.txt", open),
+    ("ST000001.txt.gz", gzip.open),
+])
+def test_download_to_file(tmp_path, monkeypatch, file_name, open_function):
+    body = b"#METABOLOMICS WORKBENCH STUDY_ID:ST000001\n" * 10000
+    chunk_sizes = []
+    class Response(io.BytesIO):
+        def read(self, size=-1):
+            chunk_sizes.append(size)
+            return super().read(size)
+    monkeypatch.setattr("mwtab.fileio.urlopen", lambda url: Response(body))
+    
+    path = str(tmp_path / "files" / file_name)
+    assert mwrest.download_to_file("https://www.test.org/rest/", path, chunk_size=1000) == (len(body), hashlib.sha256(body).hexdigest())
+    with open_function(path, "rb") as fh:
+        assert fh.read() == body
+    assert max(chunk_sizes) == 1000
+    assert os.listdir(tmp_path / "files") == [file_name]
+
+
+def test_download_to_file_blank(tmp_path, monkeypatch):
+    monkeypatch.setattr("mwtab.fileio.urlopen", lambda url: io.BytesIO(b""))
+    assert mwrest.download_to_file("https://www.test.org/rest/", str(tmp_path / "blank.txt")) is None
+    assert os.listdir(tmp_path) == []
+    
+    # Only empty responses are skipped, whitespace is saved like it was before downloads were streamed.
+    monkeypatch.setattr("mwtab.fileio.urlopen", lambda url: io.BytesIO(b"\n \n"))
+    assert mwrest.download_to_file("https://www.test.org/rest/", str(tmp_path / "whitespace.txt")) == \
+           (3, hashlib.sha256(b"\n \n").hexdigest())
+    with open(tmp_path / "whitespace.txt", "rb") as fh:
+        assert fh.read() == b"\n \n"
+    os.remove(tmp_path / "whitespace.txt")
+    
+    def stunted_read(size):
+        raise urllib.error.URLError("Connection reset")
+    response = io.BytesIO(b"")
+    response.read = stunted_read
+    monkeypatch.setattr("mwtab.fileio.urlopen", lambda url: response)
+    with pytest.raises(urllib.error.URLError):
+        mwrest.download_to_file("https://www.test.org/rest/", str(tmp_path / "error.txt"))
+    assert os.listdir(tmp_path) == []
+
+
+
+
+
+
+
 
 
 
@@ -368,6 +436,111 @@ def test_MWRESTFile_is_json():
 
 
 
+@pytest.fixture()
+def fake_clock(monkeypatch):
+    """Replace time.monotonic and time.sleep with a clock that only moves when sleep is called."""
+    clock = {"now": 0.0, "sleeps": []}
+    def sleep(seconds):
+        clock["sleeps"].append(seconds)
+        clock["now"] += seconds
+    monkeypatch.setattr(mwrest.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(mwrest.time, "sleep", sleep)
+    return clock
 
 
+def test_TokenBucket(fake_clock):
+    limiter = TokenBucket(rate=2, burst=3)
+    # The burst is allowed right away, then 1 every half second.
+    assert [limiter.acquire() for _ in range(5)] == [0, 0, 0, 0.5, 0.5]
+    assert fake_clock["now"] == 1.0
+    
+    # Tokens build up again, but not past the burst.
+    fake_clock["now"] += 10
+    assert [limiter.acquire() for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+@pytest.mark.parametrize("kwds, message", [
+    ({"rate": 0}, "The rate must be greater than 0."),
+    ({"rate": 1, "burst": 0}, "The burst must be at least 1."),
+])
+def test_TokenBucket_bad_values(kwds, message):
+    with pytest.raises(ValueError, match = message):
+        TokenBucket(**kwds)
+
+
+def test_call_with_retries(fake_clock):
+    errors = [urllib.error.HTTPError("url", 503, "Service Unavailable", {}, None), 
+              urllib.error.HTTPError("url", 429, "Too Many Requests", {"Retry-After": "10"}, None), 
+              TimeoutError()]
+    def flaky():
+        if errors:
+            raise errors.pop(0)
+        return "done"
+    
+    assert call_with_retries(flaky, retries=3, backoff=1) == "done"
+    assert fake_clock["sleeps"] == [1, 10, 4]
+
+
+def test_call_with_retries_errors(fake_clock):
+    calls = []
+    def not_found():
+        calls.append(1)
+        raise urllib.error.HTTPError("url", 404, "Not Found", {}, None)
+    with pytest.raises(urllib.error.HTTPError):
+        call_with_retries(not_found, retries=3)
+    assert len(calls) == 1
+    
+    def timeout():
+        calls.append(1)
+        raise TimeoutError()
+    calls.clear()
+    with pytest.raises(TimeoutError):
+        call_with_retries(timeout, retries=2, limiter=TokenBucket(1))
+    assert len(calls) == 3
+    # The limiter doesn't have to wait, because the backoff is longer than its rate.
+    assert fake_clock["sleeps"] == [1, 2]
+
+
+def test_batch_query(fake_clock, monkeypatch):
+    requested = []
+    def urlopen(url):
+        requested.append(url)
+        name = urllib.parse.unquote(url.split("/")[-3])
+        if name == "Unknown":
+            return io.BytesIO(b"")
+        if name == "Broken" or (name == "Flaky" and requested.count(url) == 1):
+            raise urllib.error.URLError("timed out")
+        return io.BytesIO(json.dumps({"name": name}).encode("utf-8"))
+    monkeypatch.setattr("mwtab.fileio.urlopen", urlopen)
+    
+    cache = {}
+    values = ["Glucose", "Citric acid", "Glucose", "Unknown", "Flaky", "Broken"]
+    results, errors = mwrest.batch_query("refmet", "name", values, "all", base_url="https://www.test.org/rest/", 
+                                         cache=cache, rate=100, retries=1)
+    assert results == {"Glucose": {"name": "Glucose"}, "Citric acid": {"name": "Citric acid"}, 
+                       "Unknown": None, "Flaky": {"name": "Flaky"}}
+    assert list(errors) == ["Broken"]
+    assert "https://www.test.org/rest/refmet/name/Citric%20acid/all/json" in cache
+    assert len(requested) == 7
+    
+    # Only the value that failed is requested again.
+    requested.clear()
+    results, errors = mwrest.batch_query("refmet", "name", values, "all", base_url="https://www.test.org/rest/", 
+                                         cache=cache, rate=100, retries=0)
+    assert requested == ["https://www.test.org/rest/refmet/name/Broken/all/json"]
+    assert len(results) == 4
+    
+    # Values that don't make a valid URL are errors, and the rest are still requested.
+    requested.clear()
+    results, errors = mwrest.batch_query("compound", "pubchem_cid", ["5793", "not a CID", "5793"], "all", 
+                                         base_url="https://www.test.org/rest/", rate=100)
+    assert requested == ["https://www.test.org/rest/compound/pubchem_cid/5793/all/json"]
+    assert list(results) == ["5793"]
+    assert list(errors) == ["not a CID"]
+    assert isinstance(errors["not a CID"], ValueError)
+    
+    results, errors = mwrest.batch_query("refmet", "bad_item", values, "all")
+    assert results == {}
+    assert list(errors) == ["Glucose", "Citric acid", "Unknown", "Flaky", "Broken"]
+    assert all(str(e) == "Invalid input item" for e in errors.values())
 
@@ -0,0 +1,144 @@
+import http.client
+import json
+import os
+import stat
+import threading
+
+import pytest
+
+from mwtab import mwserver, cli, fileio, mwschema
+from mwtab.mwtab import MWTabFile
+from mwtab.validator import validate_file
+
+
+EXAMPLE_FILE = os.path.abspath("tests/example_data/mwtab_files/ST000122_AN000204.txt")
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(mwserver, "SERVER_DIRECTORY", str(tmp_path_factory.mktemp("server")))
+        server = mwserver.MWTabServer(port=0, workers=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.close()
+        assert not os.path.exists(server._token_path)
+
+
+def test_status(server):
+    assert server.address.startswith("http://127.0.0.1:")
+    assert mwserver.request(server.address, "/status") == {"status": "ok", "workers": 1, "commands": ["convert", "validate", "extract"]}
+
+
+def test_validate(server):
+    mwtabfile = next(fileio.read_with_class(EXAMPLE_FILE, MWTabFile, {'duplicate_keys': True}))
+    _, expected_errors = validate_file(mwtabfile, mwschema.ms_required_schema, mwschema.nmr_required_schema)
+    
+    response = mwserver.request(server.address, "/validate", {"path": EXAMPLE_FILE})
+    assert response["read_errors"] == []
+    assert [file["source"] for file in response["files"]] == [EXAMPLE_FILE]
+    assert response["files"][0]["errors"] == json.loads(json.dumps(expected_errors))
+    assert "Validation Log" in response["files"][0]["validation_log"]
+    
+    with open(EXAMPLE_FILE, encoding="utf-8") as fh:
+        response = mwserver.request(server.address, "/validate", {"text": fh.read(), "source": "upload.txt", "profile": "quick"})
+    assert response["files"][0]["source"] == "upload.txt"
+    assert {error["ID"] for error in response["files"][0]["errors"]} <= {error["ID"] for error in expected_errors}
+    
+    response = mwserver.request(server.address, "/validate", {"text": "Not a file", "source": "upload.txt"})
+    assert response == {"files": [], "read_errors": [{"source": "upload.txt", "error": "TypeError: Unknown file format"}]}
+
+
+def test_run(server, tmp_path, monkeypatch):
+    cmdargs = {"validate": True, "convert": False, "extract": False, "download": False, "index": False, "query": False,
+               "mirror": False, "duplicates": False, "serve": False, "<from-path>": EXAMPLE_FILE, "--to-path": "remote.json",
+               "--verbose": False, "--force": False, "--silent": True, "--mw-rest": "https://www.metabolomicsworkbench.org/rest/"}
+    monkeypatch.chdir(tmp_path)
+    response = mwserver.run_remote(server.address, dict(cmdargs, **{"--server": server.address}))
+    cli.cli(dict(cmdargs, **{"--to-path": "local.json"}))
+    assert response == {"returncode": 0, "stdout": "", "stderr": ""}
+    with open(tmp_path / "remote.json", encoding="utf-8") as fh, open(tmp_path / "local.json", encoding="utf-8") as local_fh:
+        assert json.load(fh) == json.load(local_fh)
+    
+    response = mwserver.run_remote(server.address, dict(cmdargs, **{"--silent": False, "--to-path": None}))
+    assert response["returncode"] == 0
+    assert "Validation Log" in response["stdout"]
+
+
+def test_errors(server):
+    with pytest.raises(RuntimeError, match = r"\(400\): Only convert, validate, extract commands can be run"):
+        mwserver.run_remote(server.address, {"download": True, "validate": True})
+    with pytest.raises(RuntimeError, match = r'\(400\): A validate request needs a "path" or "text".'):
+        mwserver.request(server.address, "/validate", {})
+    with pytest.raises(RuntimeError, match = r'\(404\): Unknown path, "/other".'):
+        mwserver.request(server.address, "/other")
+
+
+def _post(server, body, headers):
+    host, port = server.address[len("http://"):].split(":")
+    connection = http.client.HTTPConnection(host, int(port))
+    connection.request("POST", "/run", body, headers)
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read())["error"]
+    connection.close()
+    return result
+
+
+def test_refused_requests(server):
+    assert stat.S_IMODE(os.stat(server._token_path).st_mode) == 0o600
+    authorization = "Bearer " + server._token
+    body = json.dumps({"cmdargs": {"convert": True}}).encode("utf-8")
+    
+    status, error = _post(server, b"{not json", {"Content-Type": "application/json", "Authorization": authorization})
+    assert status == 400
+    assert error.startswith("The request is not valid JSON")
+    # A cross site POST from a web page without a CORS preflight.
+    assert _post(server, body, {"Content-Type": "text/plain", "Authorization": authorization}) == \
+           (415, "The Content-Type of the request must be application/json.")
+    assert _post(server, body, {"Authorization": authorization}) == \
+           (415, "The Content-Type of the request must be application/json.")
+    assert _post(server, body, {"Content-Type": "application/json"}) == (401, "The request doesn't have the server's token.")
+    assert _post(server, body, {"Content-Type": "application/json", "Authorization": "Bearer wrong"}) == \
+           (401, "The request doesn't have the server's token.")
+    assert _post(server, body, {"Content-Type": "application/json", "Authorization": authorization,
+                                "Origin": "https://example.com"}) == (403, "Requests from web pages are not accepted.")
+    assert _post(server, body, {"Content-Type": "application/json", "Authorization": authorization,
+                                "Host": "attacker.example.com:8765"}) == \
+           (403, 'The Host header must be localhost or 127.0.0.1, not "attacker.example.com:8765".')
+    
+    with pytest.raises(RuntimeError, match = r"\(401\)"):
+        mwserver.request(server.address, "/status", token="wrong")
+
+
+def test_worker_restart(server):
+    with pytest.raises(RuntimeError, match = "The worker process stopped unexpectedly"):
+        server.submit(os._exit, 1)
+    response = mwserver.request(server.address, "/validate", {"path": EXAMPLE_FILE, "profile": "quick"})
+    assert len(response["files"]) == 1
+
+
+def test_unix_socket(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / "mwtab.sock")
+    monkeypatch.setattr(mwserver, "SERVER_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(mwserver, "DEFAULT_SOCKET_PATH", socket_path)
+    # A file left by a server that stopped is replaced.
+    with open(socket_path, "w") as fh:
+        fh.write("")
+    
+    # The Unix socket is the default.
+    with mwserver.MWTabServer(workers=1) as server:
+        assert server.address == socket_path
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        assert mwserver.request(socket_path, "/status")["workers"] == 1
+        connection = mwserver._UnixHTTPConnection(socket_path)
+        connection.request("POST", "/validate", json.dumps({"path": EXAMPLE_FILE}).encode("utf-8"), {"Content-Type": "text/plain"})
+        assert connection.getresponse().status == 415
+        connection.close()
+        with pytest.raises(ValueError, match = "Another server is already listening"):
+            mwserver.MWTabServer(socket_path=socket_path, workers=1)
+        server.shutdown()
+    assert not os.path.exists(socket_path)
@@ -414,3 +414,96 @@ def test_validation_complete_coverage3():
     """This is just to hit some lines that aren't covered, but also aren't terribly important to test."""
     mwfile = next(mwtab.read_files("tests/example_data/validation_files/complete_coverage3.json"))
     validation_log, _ = mwtab.validate_file(mwfile)
+
+
+def test_validate_file_quick_profile(mocker):
+    mwfile = next(mwtab.read_files("tests/example_data/validation_files/ST000122_AN000204_validate_polarity.json"))
+    get_table_mock = mocker.patch.object(mwfile, 'get_table_as_pandas', wraps=mwfile.get_table_as_pandas)
+    _, errors = mwtab.validate_file(mwfile, profile='quick')
+    assert not any(error['ID'] == '31' for error in errors)
+    assert get_table_mock.call_count == 0
+    
+    _, errors = mwtab.validate_file(mwfile, profile='quick', include=['31'])
+    assert any(error['ID'] == '31' for error in errors)
+    assert get_table_mock.call_count > 0
+
+def test_validate_file_exclude():
+    mwfile = next(mwtab.read_files("tests/example_data/validation_files/ST000122_AN000204_validate_polarity.json"))
+    _, errors = mwtab.validate_file(mwfile, exclude=['31'])
+    assert not any(error['ID'] == '31' for error in errors)
+
+def test_validate_file_max_errors():
+    mwfile = next(mwtab.read_files("tests/example_data/validation_files/ST000122_AN000204_validate_table_values.json"))
+    _, all_errors = mwtab.validate_file(mwfile)
+    assert len(all_errors) > 1
+    validation_log, errors = mwtab.validate_file(mwfile, max_errors=1)
+    assert len(errors) == 1
+    assert 'Validation stopped early after reaching the maximum number of issues.' in validation_log
+
+def test_validate_file_bad_selection():
+    mwfile = next(mwtab.read_files("tests/example_data/mwtab_files/ST000122_AN000204.json"))
+    with pytest.raises(ValueError, match=r'Unknown validation profile'):
+        mwtab.validate_file(mwfile, profile='asdf')
+    with pytest.raises(ValueError, match=r'Unknown validation ID\(s\)'):
+        mwtab.validate_file(mwfile, include=['1000'])
+
+def test_validate_file_cache(mocker):
+    mwfile = next(mwtab.read_files("tests/example_data/validation_files/ST000122_AN000204_validate_polarity.json"))
+    _, expected_errors = mwtab.validate_file(mwfile)
+    
+    cache = mwtab.validator.ValidationCache()
+    _, errors = mwtab.validate_file(mwfile, cache=cache)
+    assert [error['message'] for error in errors] == [error['message'] for error in expected_errors]
+    assert cache.hits == 0
+    
+    polarity_mock = mocker.patch('mwtab.validator.validate_polarity', wraps=mwtab.validator.validate_polarity)
+    ssf_mock = mocker.patch('mwtab.validator.validate_subject_samples_factors', 
+                            wraps=mwtab.validator.validate_subject_samples_factors)
+    _, errors = mwtab.validate_file(mwfile, cache=cache)
+    assert [error['message'] for error in errors] == [error['message'] for error in expected_errors]
+    assert polarity_mock.call_count == 0
+    assert ssf_mock.call_count == 0
+    
+    mwfile['SUBJECT_SAMPLE_FACTORS'].append(copy.deepcopy(mwfile['SUBJECT_SAMPLE_FACTORS'][0]))
+    _, errors = mwtab.validate_file(mwfile, cache=cache)
+    assert polarity_mock.call_count == 0
+    assert ssf_mock.call_count == 1
+    assert any(error['ID'] == '4' for error in errors)
+
+
+def test_not_oneOf_branch():
+    schema = {'type': 'string', 'not': {'oneOf': [{'enum': ['NA']}, {'pattern': '^pos$'}]}}
+    validator_class = mwtab.validator._validator_class(schema)
+    assert mwtab.validator._validator_class(schema) is validator_class
+    
+    # The schema the instance matched is saved on the error when it is made.
+    errors = list(validator_class(schema).iter_errors('pos'))
+    assert len(errors) == 1
+    assert errors[0].validator == 'not'
+    assert errors[0].not_oneOf_schema is schema['not']['oneOf'][1]
+    
+    errors = list(validator_class(schema).iter_errors('NA'))
+    assert errors[0].not_oneOf_schema is schema['not']['oneOf'][0]
+    
+    # Valid against none or more than 1 of the schemas is valid, the same as the default 'not'.
+    assert list(validator_class(schema).iter_errors('neg')) == []
+    schema = {'not': {'oneOf': [{'pattern': '^p'}, {'pattern': 's$'}]}}
+    assert list(mwtab.validator._validator_class(schema)(schema).iter_errors('pos')) == []
+    
+    # Other 'not' schemas are validated normally.
+    schema = {'not': {'enum': ['NA']}}
+    errors = list(mwtab.validator._validator_class(schema)(schema).iter_errors('NA'))
+    assert len(errors) == 1
+    assert not hasattr(errors[0], 'not_oneOf_schema')
+
+
+def test_not_keyword_uses_extended_class(mocker):
+    """Other 'not' schemas are validated by the 'not' of the class being extended, not the default draft's."""
+    def base_not(validator, not_schema, instance, schema):
+        yield mwtab.validator.jsonschema.ValidationError("from the base class")
+    base_class = mwtab.validator.jsonschema.validators.extend(mwtab.validator.jsonschema.Draft4Validator, {'not': base_not})
+    mocker.patch('mwtab.validator.jsonschema.validators.validator_for', return_value=base_class)
+    
+    schema = {'not': {'enum': ['NA']}}
+    validator_class = mwtab.validator._validator_class(schema)
+    assert [error.message for error in validator_class(schema).iter_errors('anything')] == ["from the base class"]